@@ -1,3 +1,16 @@
-# from django.contrib import admin
+from django.contrib import admin
 
-# Register your models here.
+from tom_tns.models import TNSObject, TNSSubmission
+
+
+@admin.register(TNSObject)
+class TNSObjectAdmin(admin.ModelAdmin):
+    list_display = ['objid', 'iau_name', 'ra', 'dec', 'object_type', 'last_modified']
+    search_fields = ['name', 'internal_names']
+
+
+@admin.register(TNSSubmission)
+class TNSSubmissionAdmin(admin.ModelAdmin):
+    list_display = ['id', 'target', 'destination', 'bot_id', 'status', 'attempts', 'iau_name', 'created', 'finished']
+    list_filter = ['status', 'destination', 'bot_id']
+    raw_id_fields = ['target', 'user']
@@ -6,6 +6,14 @@ class TomTnsConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'tom_tns'
 
+    def ready(self):
+        from django.db.models.signals import post_save
+        from tom_dataproducts.models import PhotometryReducedDatum
+        from tom_tns.autoreport import photometry_post_save
+
+        # New photometry triggers automatic TNS reporting, if it is enabled in the TNS settings
+        post_save.connect(photometry_post_save, sender=PhotometryReducedDatum, dispatch_uid='tom_tns_auto_report')
+
     def target_detail_buttons(self):
         """
         Integration point for adding buttons to the target detail view.
@@ -0,0 +1,268 @@
+import math
+import threading
+import time
+from collections import defaultdict
+from datetime import datetime, timedelta, timezone
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+
+from tom_dataproducts.models import PhotometryReducedDatum
+from tom_targets.models import Target
+
+from tom_tns.catalog import crossmatch_targets
+from tom_tns.models import TNSAutoReportCandidate, TNSObject, TNSSubmission
+from tom_tns.reports import ATReport, NonDetection, PhotometryGroup, option_labels, tns_bulk_report
+from tom_tns.status import TNS_STATUS_UNREPORTED, get_tns_statuses
+from tom_tns.tns_api import (choose_tns_bot, default_authors, get_reverse_tns_values, get_tns_credentials, group_names,
+                             get_tns_values, map_filter_to_tns, map_instrument_to_tns, populate_tns_values,
+                             submit_through_hermes)
+from tom_tns.units import AB_MAG, convert_flux, tns_unit_option
+from tom_tns.validation import get_report_validator
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+DEFAULT_AUTO_REPORT_SETTINGS = {
+    'enabled': False,
+    'debounce_seconds': 300,  # wait this long after new photometry before evaluating a Target
+    'min_snr': 5,  # detections must have a brightness error of at most 1.0857 / min_snr mag
+    'min_detections': 2,  # number of significant detections needed to report
+    'max_age_days': 3,  # only report Targets first detected at most this long ago
+    'at_type': '1',  # PSN - Possible SN
+    'flux_unitid': '1',  # TNS ID of AB magnitudes, used if it can't be found by name
+    'reporting_group': None,  # TNS group name, defaults to the first of `group_names`
+    'data_source_group': None,  # TNS group name, defaults to the reporting group
+    'reporter': None,  # defaults to `default_authors`, or the TOM name
+    'archiveid': None,  # archive to give as the last non-detection when there is no earlier upper limit
+    'archival_remarks': '',
+}
+
+# Targets triggered recently in this process, to skip the cache for bursts of photometry of the same Target
+_recent_triggers = {}
+_recent_triggers_lock = threading.Lock()
+
+
+def auto_report_settings():
+    tns_settings = getattr(settings, 'DATA_SERVICES', {}).get('TNS', {})
+    return DEFAULT_AUTO_REPORT_SETTINGS | tns_settings.get('auto_report', {})
+
+
+def trigger_auto_report(target_ids, now=None):
+    """
+    Mark Targets as having new photometry, to be evaluated for automatic reporting after `debounce_seconds`.
+    Repeated triggers for a Target within that time are ignored, so this is cheap to call for every ingested datum.
+    Does nothing unless automatic reporting is enabled.
+    """
+    config = auto_report_settings()
+    if not config['enabled']:
+        return
+    debounce = config['debounce_seconds']
+    monotonic = time.monotonic()
+    with _recent_triggers_lock:
+        if len(_recent_triggers) > 10000:
+            for target_id, expires in list(_recent_triggers.items()):
+                if expires < monotonic:
+                    del _recent_triggers[target_id]
+        target_ids = [target_id for target_id in set(target_ids) if _recent_triggers.get(target_id, 0) < monotonic]
+        for target_id in target_ids:
+            _recent_triggers[target_id] = monotonic + debounce
+    # The cache debounces triggers across processes
+    target_ids = [target_id for target_id in target_ids
+                  if cache.add(f'tns_auto_report_trigger_{target_id}', True, debounce)]
+    if not target_ids:
+        return
+    now = now or datetime.now(timezone.utc)
+    evaluate_after = now + timedelta(seconds=debounce)
+    TNSAutoReportCandidate.objects.bulk_create(
+        [TNSAutoReportCandidate(target_id=target_id, triggered=now, evaluate_after=evaluate_after)
+         for target_id in target_ids],
+        update_conflicts=True, unique_fields=['target'], update_fields=['triggered', 'evaluate_after'])
+
+
+def photometry_post_save(sender, instance, created, **kwargs):
+    """ post_save receiver for PhotometryReducedDatum, connected by the tom_tns app
+    """
+    if created:
+        trigger_auto_report([instance.target_id])
+
+
+def data_product_post_upload(data_product, **kwargs):
+    """
+    Hook for `HOOKS['data_product_post_upload']` in settings.py. Photometry ingested in bulk doesn't send post_save
+    signals, so uploaded data products trigger their Target instead.
+    """
+    trigger_auto_report([data_product.target_id])
+
+
+def tns_option_id(option_list, name, default='0'):
+    """ Returns the TNS ID of an option by name, or `default` if it is unknown
+    """
+    option = get_reverse_tns_values(option_list, name) if name else None
+    return str(option[0]) if option else default
+
+
+def tns_unit_id(unit, default=None):
+    """ Returns the TNS ID of a flux unit in any common spelling (see `units.normalize_unit`), or `default`
+    """
+    option = tns_unit_option(unit, get_tns_values('units'))
+    return str(option[0]) if option else default
+
+
+def to_ab_magnitudes(photometry):
+    """
+    Convert the brightnesses, errors and limits of a light curve (a list of photometry dictionaries) to AB magnitudes
+    in place, in one pass. Values that can't be converted are set to None.
+    """
+    if not photometry:
+        return
+    units = [datum['unit'] for datum in photometry]
+    filters = [datum['bandpass'] for datum in photometry]
+    brightness, errors = convert_flux([datum['brightness'] for datum in photometry],
+                                      [datum['brightness_error'] for datum in photometry], units, AB_MAG, filters)
+    limits, _ = convert_flux([datum['limit'] for datum in photometry], None, units, AB_MAG, filters)
+    for datum, value, error, limit in zip(photometry, brightness.tolist(), errors.tolist(), limits.tolist()):
+        datum['brightness'] = None if math.isnan(value) else value
+        datum['brightness_error'] = None if math.isnan(error) else error
+        datum['limit'] = None if math.isnan(limit) else limit
+
+
+def reporting_config(config):
+    """
+    Resolve the `reporting_group`, `data_source_group` and `reporter` of automatic report settings to the
+    `reporting_groupid`, `data_source_groupid` and `reporter` of the reports. Returns None if a group is unknown.
+    """
+    reporting_group = config['reporting_group'] or next(iter(group_names()), settings.TOM_NAME)
+    reporting_groupid = get_reverse_tns_values('groups', reporting_group)
+    data_source_groupid = get_reverse_tns_values('groups', config['data_source_group'] or reporting_group)
+    if not reporting_groupid or not data_source_groupid:
+        logger.error(f'Cannot report to the TNS automatically: unknown TNS group {reporting_group}')
+        return None
+    return config | {'reporting_groupid': str(reporting_groupid[0]),
+                     'data_source_groupid': str(data_source_groupid[0]),
+                     'reporter': config['reporter'] or default_authors() or settings.TOM_NAME}
+
+
+def build_auto_report(target, photometry, config, now):
+    """
+    Build an ATReport for a Target from its photometry (sorted by timestamp, in AB magnitudes), if it meets the
+    reporting criteria:
+    at least `min_detections` detections with a S/N of `min_snr`, the first of them no older than `max_age_days`, and
+    a last non-detection (an earlier upper limit, or the configured archive). Returns None otherwise.
+    """
+    max_error = 1.0857 / config['min_snr']
+    detections = [datum for datum in photometry
+                  if datum['brightness'] is not None and datum['brightness_error'] is not None
+                  and datum['brightness_error'] <= max_error]
+    if len(detections) < config['min_detections']:
+        return None
+    first = detections[0]
+    if now - first['timestamp'] > timedelta(days=config['max_age_days']):
+        return None
+
+    def instrument_id(datum):
+        return tns_option_id('instruments', map_instrument_to_tns(datum['instrument']) or
+                             map_instrument_to_tns(datum['telescope']))
+
+    limits = [datum for datum in photometry
+              if datum['brightness'] is None and datum['limit'] is not None and datum['timestamp'] < first['timestamp']]
+    if limits:
+        last_limit = limits[-1]
+        nondetection = NonDetection(obsdate=last_limit['timestamp'], limiting_flux=last_limit['limit'],
+                                    flux_unitid=config['flux_unitid'],
+                                    filterid=tns_option_id('filters', map_filter_to_tns(last_limit['bandpass'])),
+                                    instrumentid=instrument_id(last_limit), exptime=last_limit['exposure_time'])
+    elif config['archiveid'] is not None and config['archival_remarks']:
+        nondetection = NonDetection(archiveid=str(config['archiveid']), archival_remarks=config['archival_remarks'])
+    else:
+        return None
+
+    return ATReport(
+        ra=target.ra,
+        dec=target.dec,
+        reporting_groupid=config['reporting_groupid'],
+        data_source_groupid=config['data_source_groupid'],
+        reporter=config['reporter'],
+        discovery_datetime=first['timestamp'],
+        at_type=str(config['at_type']),
+        nondetection=nondetection,
+        photometry=[PhotometryGroup(obsdate=first['timestamp'], flux=first['brightness'],
+                                    flux_error=first['brightness_error'], flux_unitid=config['flux_unitid'],
+                                    filterid=tns_option_id('filters', map_filter_to_tns(first['bandpass'])),
+                                    instrumentid=instrument_id(first), exptime=first['exposure_time'],
+                                    telescope=first['telescope'])],
+        internal_name=target.name,
+        internal_name_format=get_tns_credentials().get('internal_name_format'),
+        name=target.name,
+    )
+
+
+def evaluate_auto_report_candidates(now=None):
+    """
+    Evaluate every Target whose debounce period has passed, in one batch, and queue AT reports for the Targets that
+    meet the reporting criteria and are not already known to the TNS (by name, by a previous submission, or in the
+    local TNS catalogue). The candidates are locked while they are evaluated and only deleted once their reports are
+    queued, in the same transaction, so a worker that dies mid-evaluation leaves them to be evaluated again.
+    Returns the queued TNSSubmissions.
+    """
+    config = auto_report_settings()
+    if not config['enabled']:
+        return []
+    now = now or datetime.now(timezone.utc)
+    with transaction.atomic():
+        due = dict(TNSAutoReportCandidate.objects.select_for_update(skip_locked=True)
+                   .filter(evaluate_after__lte=now).values_list('pk', 'target_id'))
+        if not due:
+            return []
+        config = reporting_config(config)
+        if config is None:
+            return []
+        submissions = queue_auto_reports(due.values(), config, now)
+        TNSAutoReportCandidate.objects.filter(pk__in=due.keys()).delete()
+    if submissions:
+        logger.info(f'Queued automatic TNS reports for {", ".join(str(s.target) for s in submissions)}')
+    return submissions
+
+
+def queue_auto_reports(target_ids, config, now):
+    """ Queue AT reports for the given Targets that are unreported and meet the reporting criteria
+    """
+    targets = Target.objects.filter(pk__in=target_ids, type=Target.SIDEREAL, ra__isnull=False, dec__isnull=False)
+    statuses = get_tns_statuses(targets)
+    candidate_ids = {target_id for target_id, status in statuses.items() if status == TNS_STATUS_UNREPORTED}
+    if candidate_ids and TNSObject.objects.exists():
+        candidate_ids -= {target_id for target_id, _, _ in crossmatch_targets(targets.filter(pk__in=candidate_ids))}
+    if not candidate_ids:
+        return []
+
+    photometry = defaultdict(list)
+    for datum in (PhotometryReducedDatum.objects.filter(target_id__in=candidate_ids).order_by('timestamp')
+                  .values('target_id', 'timestamp', 'brightness', 'brightness_error', 'limit', 'unit', 'bandpass',
+                          'instrument', 'telescope', 'exposure_time')):
+        photometry[datum['target_id']].append(datum)
+    config['flux_unitid'] = tns_unit_id(AB_MAG, default=str(config['flux_unitid']))
+
+    validator = get_report_validator()
+    hermes = submit_through_hermes()
+    labels = option_labels(cache.get('all_tns_values') or populate_tns_values()[0]) if hermes else None
+    submissions = []
+    for target in targets.filter(pk__in=candidate_ids):
+        to_ab_magnitudes(photometry[target.pk])
+        report = build_auto_report(target, photometry[target.pk], config, now)
+        if report is None:
+            continue
+        payload = tns_bulk_report([report])
+        errors = validator.validate(payload)
+        if errors:
+            logger.warning(f'Not auto reporting {target} to the TNS, the report is invalid: {errors}')
+            continue
+        if hermes:
+            submissions.append(TNSSubmission(target=target, destination=TNSSubmission.DESTINATION_HERMES,
+                                             bot_id='hermes', payload=report.to_hermes(labels)))
+        else:
+            # Spread the reports over the configured bots
+            submissions.append(TNSSubmission(target=target, bot_id=str(choose_tns_bot().get('bot_id', '')),
+                                             payload=payload))
+    return TNSSubmission.objects.bulk_create(submissions)
@@ -0,0 +1,248 @@
+import csv
+import io
+import zipfile
+from datetime import datetime, timedelta, timezone
+from urllib.parse import urljoin
+
+import numpy as np
+import requests
+from astropy import units
+from astropy.coordinates import SkyCoord, search_around_sky
+from django.conf import settings
+from django.db import transaction
+
+from tom_targets.models import Target, TargetName
+from tom_tns.metrics import time_request
+from tom_tns.models import TNSCatalogFile, TNSObject, dec_zone, CATALOG_ZONE_HEIGHT
+from tom_tns.tns_api import choose_tns_bot, record_bot_quota
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+TNS_CATALOG_FILE = 'tns_public_objects.csv.zip'
+# strftime patterns of the delta files holding the objects changed during one day / one hour
+TNS_DAILY_DELTA_FILE = 'tns_public_objects_%Y%m%d.csv.zip'
+TNS_HOURLY_DELTA_FILE = 'tns_public_objects_%Y%m%d_%H.csv.zip'
+TNS_CATALOG_TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+# Fields of TNSObject that are refreshed when an existing catalogue row is ingested again
+CATALOG_UPDATE_FIELDS = ['name_prefix', 'name', 'ra', 'dec', 'dec_zone', 'redshift', 'object_type',
+                         'reporting_group', 'internal_names', 'discovery_date', 'last_modified']
+
+
+def crossmatch_radius():
+    """ Returns the crossmatch radius in arcseconds from settings, defaulting to 2"
+    """
+    return settings.DATA_SERVICES.get('TNS', {}).get('crossmatch_radius', 2.0)
+
+
+def download_tns_catalog(filename=TNS_CATALOG_FILE):
+    """
+    Download a file of the TNS public objects catalogue according to:
+    https://www.wis-tns.org/content/tns-getting-started
+    Returns the raw content of the file.
+    """
+    tns_credentials = choose_tns_bot()
+    with time_request('public-objects') as timing:
+        response = requests.post(urljoin(tns_credentials['base_url'], f'system/files/tns_public_objects/{filename}'),
+                                 headers={'User-Agent': tns_credentials['marker']},
+                                 data={'api_key': tns_credentials['api_key']})
+        timing['status'] = response.status_code
+    record_bot_quota(tns_credentials, response)
+    response.raise_for_status()
+    logger.info(f'Downloaded {filename} from the TNS')
+    return response.content
+
+
+def _parse_time(value):
+    """ Parse a TNS catalogue timestamp into an aware datetime, or None if it is empty or malformed
+    """
+    value = (value or '').strip().strip('"')
+    for time_format in (TNS_CATALOG_TIME_FORMAT, '%Y-%m-%d %H:%M:%S.%f'):
+        try:
+            return datetime.strptime(value, time_format).replace(tzinfo=timezone.utc)
+        except ValueError:
+            continue
+    return None
+
+
+def _parse_float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def read_tns_catalog(content):
+    """
+    Parse (optionally zipped) TNS public objects CSV content.
+    The first line of these files is the time the file was generated, followed by a standard CSV header.
+    Returns a tuple of the file timestamp and a list of TNSObject instances (not saved).
+    """
+    if zipfile.is_zipfile(io.BytesIO(content)):
+        with zipfile.ZipFile(io.BytesIO(content)) as archive:
+            content = archive.read(archive.namelist()[0])
+    lines = io.StringIO(content.decode('utf-8'))
+    snapshot_time = None
+    first_line = lines.readline()
+    if first_line.lstrip('"').startswith('objid'):
+        lines.seek(0)
+    else:
+        snapshot_time = _parse_time(first_line)
+    tns_objects = []
+    for row in csv.DictReader(lines):
+        ra = _parse_float(row.get('ra'))
+        dec = _parse_float(row.get('declination'))
+        if ra is None or dec is None:
+            continue
+        tns_objects.append(TNSObject(
+            objid=int(row['objid']),
+            name_prefix=row.get('name_prefix') or '',
+            name=row['name'],
+            ra=ra,
+            dec=dec,
+            dec_zone=dec_zone(dec),
+            redshift=_parse_float(row.get('redshift')),
+            object_type=row.get('type') or '',
+            reporting_group=row.get('reporting_group') or '',
+            internal_names=row.get('internal_names') or '',
+            discovery_date=_parse_time(row.get('discoverydate')),
+            last_modified=_parse_time(row.get('lastmodified')),
+        ))
+    return snapshot_time, tns_objects
+
+
+def ingest_tns_catalog(tns_objects, batch_size=5000):
+    """
+    Insert or update TNSObjects in the local catalogue, keyed by TNS ``objid``.
+    Returns the number of rows written.
+    """
+    with transaction.atomic():
+        TNSObject.objects.bulk_create(tns_objects, batch_size=batch_size, update_conflicts=True,
+                                      unique_fields=['objid'], update_fields=CATALOG_UPDATE_FIELDS)
+    logger.info(f'Ingested {len(tns_objects)} TNS objects into the local catalogue')
+    return len(tns_objects)
+
+
+def apply_tns_catalog_file(filename, content, snapshot_time=None):
+    """
+    Upsert the objects in a full or delta TNS catalogue file into the local catalogue and record it as applied.
+    Only the rows present in the file are written, and their ``dec_zone`` is recomputed on the way in, so the zone
+    index is updated in place rather than rebuilt.
+    ``snapshot_time`` is the end of the period covered by a delta file. It defaults to the timestamp line of the file.
+    Returns the TNSCatalogFile record.
+    """
+    file_time, tns_objects = read_tns_catalog(content)
+    snapshot_time = snapshot_time or file_time or datetime.now(timezone.utc)
+    with transaction.atomic():
+        ingest_tns_catalog(tns_objects)
+        catalog_file = TNSCatalogFile.objects.create(filename=filename, snapshot_time=snapshot_time,
+                                                     rows=len(tns_objects))
+    return catalog_file
+
+
+def pending_tns_deltas(last_snapshot_time, now=None):
+    """
+    List the delta files needed to bring a catalogue synced up to ``last_snapshot_time`` up to date.
+    Whole days since the last sync are covered by daily deltas, and the completed hours of today by hourly deltas.
+    Returns a list of ``(filename, end of the period covered by the file)`` in the order they must be applied.
+    """
+    now = now or datetime.now(timezone.utc)
+    today = now.replace(hour=0, minute=0, second=0, microsecond=0)
+    day = last_snapshot_time.replace(hour=0, minute=0, second=0, microsecond=0)
+    deltas = []
+    while day < today:
+        deltas.append((day.strftime(TNS_DAILY_DELTA_FILE), day + timedelta(days=1)))
+        day += timedelta(days=1)
+    hour = max(today, last_snapshot_time.replace(minute=0, second=0, microsecond=0))
+    while hour + timedelta(hours=1) <= now:
+        deltas.append((hour.strftime(TNS_HOURLY_DELTA_FILE), hour + timedelta(hours=1)))
+        hour += timedelta(hours=1)
+    return [(filename, period_end) for filename, period_end in deltas if period_end > last_snapshot_time]
+
+
+def sync_tns_catalog(now=None):
+    """
+    Bring the local TNS catalogue up to date by applying the daily and hourly delta files published since the last
+    applied file. A full catalogue download is made if nothing has been ingested yet.
+    Stops at the first delta that is not available yet, so the next sync resumes from there.
+    Returns the list of TNSCatalogFile records applied.
+    """
+    try:
+        last_file = TNSCatalogFile.objects.latest()
+    except TNSCatalogFile.DoesNotExist:
+        return [apply_tns_catalog_file(TNS_CATALOG_FILE, download_tns_catalog())]
+    applied = []
+    for filename, period_end in pending_tns_deltas(last_file.snapshot_time, now):
+        try:
+            content = download_tns_catalog(filename)
+        except requests.exceptions.HTTPError as e:
+            logger.warning(f'TNS catalogue delta {filename} is not available: {e}')
+            break
+        applied.append(apply_tns_catalog_file(filename, content, period_end))
+    return applied
+
+
+def crossmatch_targets(targets=None, radius=None):
+    """
+    Crossmatch Targets against the local TNS catalogue.
+    All target and catalogue coordinates are loaded at once and matched with a single vectorized angular-distance
+    search. Only the declination zones touched by the targets are read from the catalogue.
+
+    :param targets: Queryset of Targets to match. Defaults to all sidereal Targets.
+    :param radius: Match radius in arcseconds. Defaults to ``crossmatch_radius`` in settings.
+    :returns: list of ``(target_id, TNS IAU name, separation in arcsec)`` for the closest match of each Target.
+    """
+    if targets is None:
+        targets = Target.objects.filter(type=Target.SIDEREAL)
+    radius = crossmatch_radius() if radius is None else radius
+    target_rows = np.array(list(targets.filter(ra__isnull=False, dec__isnull=False).values_list('id', 'ra', 'dec')),
+                           dtype=float).reshape(-1, 3)
+    if not len(target_rows):
+        return []
+
+    # Select every zone within the match radius of a target
+    radius_deg = radius / 3600.0
+    low_zones = np.floor((np.clip(target_rows[:, 2] - radius_deg, -90, 90) + 90) / CATALOG_ZONE_HEIGHT)
+    high_zones = np.floor((np.clip(target_rows[:, 2] + radius_deg, -90, 90) + 90) / CATALOG_ZONE_HEIGHT)
+    zones = np.unique(np.concatenate([low_zones, high_zones])).astype(int).tolist()
+    catalog = list(TNSObject.objects.filter(dec_zone__in=zones).values_list('name_prefix', 'name', 'ra', 'dec'))
+    if not catalog:
+        return []
+    catalog_names = np.array([prefix + name for prefix, name, _, _ in catalog])
+    catalog_coords = np.array([(ra, dec) for _, _, ra, dec in catalog], dtype=float)
+
+    target_skycoords = SkyCoord(target_rows[:, 1], target_rows[:, 2], unit='deg')
+    catalog_skycoords = SkyCoord(catalog_coords[:, 0], catalog_coords[:, 1], unit='deg')
+    target_idx, catalog_idx, separation, _ = search_around_sky(target_skycoords, catalog_skycoords,
+                                                               radius * units.arcsec)
+    if not len(target_idx):
+        return []
+    # Keep only the closest catalogue entry for each target
+    separation = separation.to_value(units.arcsec)
+    order = np.lexsort((separation, target_idx))
+    target_idx, catalog_idx, separation = target_idx[order], catalog_idx[order], separation[order]
+    _, first = np.unique(target_idx, return_index=True)
+    return [(int(target_rows[target_idx[i], 0]), str(catalog_names[catalog_idx[i]]), float(separation[i]))
+            for i in first]
+
+
+def add_tns_aliases(matches):
+    """
+    Add the TNS IAU names from ``crossmatch_targets`` as TargetName aliases in a single transaction.
+    Names that are already used by any Target or alias are skipped, as is a second Target matching the same object.
+    Returns the list of created TargetNames.
+    """
+    with transaction.atomic():
+        existing_names = {name.upper() for name in Target.objects.values_list('name', flat=True)}
+        existing_names.update(name.upper() for name in TargetName.objects.values_list('name', flat=True))
+        new_aliases = []
+        for target_id, iau_name, _ in sorted(matches, key=lambda match: match[2]):
+            if iau_name.upper() in existing_names:
+                continue
+            existing_names.add(iau_name.upper())
+            new_aliases.append(TargetName(target_id=target_id, name=iau_name))
+        TargetName.objects.bulk_create(new_aliases)
+    logger.info(f'Added {len(new_aliases)} TNS names as target aliases')
+    return new_aliases
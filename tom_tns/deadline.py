@@ -0,0 +1,61 @@
+import time
+
+from django.conf import settings
+
+
+class DeadlineExceeded(Exception):
+    """ Raised when the time budget of a submission runs out before a step could be started """
+    pass
+
+
+class Deadline:
+    """
+    A time budget shared by all the steps of a submission, so that the requests to the TNS or Hermes and the waits
+    between report reply polls never run past it. `seconds=None` is no deadline at all.
+    """
+    def __init__(self, seconds=None):
+        self.expires = None if seconds is None else time.monotonic() + seconds
+
+    def remaining(self):
+        """ Seconds left in the budget (None if there is no deadline), never negative
+        """
+        if self.expires is None:
+            return None
+        return max(self.expires - time.monotonic(), 0.0)
+
+    def expired(self):
+        return self.expires is not None and time.monotonic() >= self.expires
+
+    def check(self, step=''):
+        """ Raise DeadlineExceeded if the budget has run out before `step` """
+        if self.expired():
+            raise DeadlineExceeded(f'The submission deadline passed before {step or "the next step"}')
+
+    def timeout(self, step=''):
+        """
+        The timeout to give a request: the remaining budget, or None if there is no deadline. Raises
+        DeadlineExceeded if nothing is left.
+        """
+        self.check(step)
+        return self.remaining()
+
+    def sleep(self, seconds, step=''):
+        """ Sleep for `seconds`, unless that would run past the deadline, in which case raise DeadlineExceeded
+        """
+        remaining = self.remaining()
+        if remaining is not None and remaining <= seconds:
+            raise DeadlineExceeded(f'The submission deadline would pass waiting for {step or "the next step"}')
+        time.sleep(seconds)
+
+
+def request_timeout(deadline, step=''):
+    """ The timeout of a request made under `deadline`, which may be None """
+    return deadline.timeout(step) if deadline is not None else None
+
+
+def submission_deadline():
+    """
+    The deadline of a submission made from the TNS page, `submission_deadline_seconds` from now (setting of the same
+    name, default no deadline).
+    """
+    return Deadline(getattr(settings, 'DATA_SERVICES', {}).get('TNS', {}).get('submission_deadline_seconds'))
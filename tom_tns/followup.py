@@ -0,0 +1,261 @@
+from itertools import groupby
+from operator import itemgetter
+
+import numpy as np
+import requests.exceptions
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import F, Max, OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from tom_dataproducts.models import PhotometryReducedDatum
+from tom_targets.models import Target
+
+from tom_tns.autoreport import reporting_config, tns_option_id, tns_unit_id
+from tom_tns.hermes_api import submit_batch_to_hermes
+from tom_tns.ledger import WEB_WORKER
+from tom_tns.models import TNSSubmission
+from tom_tns.reports import ATReport, NonDetection, PhotometryGroup, dumps_tns_report, option_labels, tns_bulk_report
+from tom_tns.status import TNS_STATUS_CLASSIFIED, TNS_STATUS_REPORTED, get_tns_statuses
+from tom_tns.submissions import SENT_UNCONFIRMED, TRANSIENT_ERRORS, SubmissionMessages, queue_submissions_enabled
+from tom_tns.tns_api import (BadTnsRequest, choose_tns_bot, get_tns_credentials, get_tns_report_reply,
+                             map_filter_to_tns, map_instrument_to_tns, populate_tns_values, send_tns_report,
+                             submit_through_hermes, use_tns_bot)
+from tom_tns.units import convert_flux
+from tom_tns.validation import get_report_validator
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+DEFAULT_FOLLOWUP_SETTINGS = {
+    'batch_size': 50,  # objects per bulk report
+    'flux_unit': 'AB mag',  # all photometry is converted to this unit
+    'reporting_group': None,  # TNS group name, defaults to the first of `group_names`
+    'data_source_group': None,  # TNS group name, defaults to the reporting group
+    'reporter': None,  # defaults to `default_authors`, or the TOM name
+    'archiveid': '0',  # the TNS requires a last non-detection, even for follow-up photometry
+    'archival_remarks': 'Follow-up photometry of a known transient',
+}
+PHOTOMETRY_FIELDS = ['pk', 'target_id', 'timestamp', 'brightness', 'brightness_error', 'limit', 'unit', 'bandpass',
+                     'instrument', 'telescope', 'exposure_time']
+
+
+def followup_settings():
+    tns_settings = getattr(settings, 'DATA_SERVICES', {}).get('TNS', {})
+    return DEFAULT_FOLLOWUP_SETTINGS | tns_settings.get('followup_photometry', {})
+
+
+def new_followup_photometry(targets):
+    """
+    Select the photometry of many Targets that is newer than their last follow-up photometry report (that didn't
+    fail), in one query. Returns a dictionary of Target id to a list of rows of PHOTOMETRY_FIELDS, by timestamp.
+    """
+    last_reported = (TNSSubmission.objects.filter(target_id=OuterRef('target_id'), last_photometry_id__isnull=False)
+                     .exclude(status=TNSSubmission.STATUS_FAILED).values('target_id')
+                     .annotate(last=Max('last_photometry_id')).values('last'))
+    rows = (PhotometryReducedDatum.objects.filter(target__in=targets)
+            .annotate(last_reported=Coalesce(Subquery(last_reported), Value(0)))
+            .filter(pk__gt=F('last_reported'))
+            .order_by('target_id', 'timestamp').values_list(*PHOTOMETRY_FIELDS))
+    return {target_id: list(target_rows) for target_id, target_rows in groupby(rows, key=itemgetter(1))}
+
+
+def option_ids(values, option_list, mapping, default='0'):
+    """
+    Map an array of TOM names (filters, instruments) to TNS option IDs, looking up each distinct name once.
+    `mapping` maps a TOM name to a TNS option name.
+    """
+    names, inverse = np.unique(np.asarray(values, dtype=str), return_inverse=True)
+    ids = np.array([tns_option_id(option_list, mapping(name), default) for name in names.tolist()], dtype=object)
+    return ids[inverse.ravel()]
+
+
+def photometry_groups(rows, config):
+    """
+    Convert rows of PHOTOMETRY_FIELDS to TNS photometry groups in the `flux_unit` of the settings, mapping filters and
+    instruments to TNS IDs with one lookup per distinct value. Rows with a brightness are detections; rows with only
+    a limit are given as limiting fluxes; other rows (including those that can't be converted) are skipped.
+    """
+    columns = dict(zip(PHOTOMETRY_FIELDS, zip(*rows)))
+    brightness, error = convert_flux(columns['brightness'], columns['brightness_error'], columns['unit'],
+                                     config['flux_unit'], columns['bandpass'])
+    limit, _ = convert_flux(columns['limit'], None, columns['unit'], config['flux_unit'], columns['bandpass'])
+    exposure_time = np.array(columns['exposure_time'], dtype=float)
+    detected = ~np.isnan(brightness)
+    usable = np.flatnonzero(detected | ~np.isnan(limit))
+
+    filter_ids = option_ids(columns['bandpass'], 'filters', map_filter_to_tns)
+    instrument_ids = option_ids(columns['instrument'], 'instruments', map_instrument_to_tns)
+    # Instruments without a mapping may be mapped by their telescope instead
+    telescope_ids = option_ids(columns['telescope'], 'instruments', map_instrument_to_tns)
+    instrument_ids = np.where(instrument_ids == '0', telescope_ids, instrument_ids)
+
+    def nullable(array):
+        return [None if np.isnan(value) else value for value in array[usable].tolist()]
+
+    timestamps = columns['timestamp']
+    telescopes = columns['telescope']
+    return [
+        PhotometryGroup(obsdate=timestamps[i], flux=flux, flux_error=flux_error, flux_unitid=config['flux_unitid'],
+                        filterid=filter_id, instrumentid=instrument_id, limiting_flux=limit_value,
+                        exptime=exptime, telescope=telescopes[i])
+        for i, flux, flux_error, limit_value, exptime, filter_id, instrument_id in zip(
+            usable.tolist(), nullable(brightness), nullable(error), nullable(limit), nullable(exposure_time),
+            filter_ids[usable].tolist(), instrument_ids[usable].tolist())
+    ]
+
+
+def build_followup_reports(targets, config):
+    """
+    Build an ATReport of the new photometry of each Target that is already known to the TNS.
+    Returns a list of (Target, ATReport, id of the newest PhotometryReducedDatum included).
+    """
+    photometry = new_followup_photometry(targets)
+    if not photometry:
+        return []
+    statuses = get_tns_statuses(photometry.keys())
+    known = [target_id for target_id, status in statuses.items()
+             if status in (TNS_STATUS_REPORTED, TNS_STATUS_CLASSIFIED)]
+    internal_name_format = get_tns_credentials().get('internal_name_format')
+    reports = []
+    for target in Target.objects.filter(pk__in=known, ra__isnull=False, dec__isnull=False).order_by('pk'):
+        rows = photometry[target.pk]
+        groups = photometry_groups(rows, config)
+        if not groups:
+            continue
+        report = ATReport(
+            ra=target.ra,
+            dec=target.dec,
+            reporting_groupid=config['reporting_groupid'],
+            data_source_groupid=config['data_source_groupid'],
+            reporter=config['reporter'],
+            discovery_datetime=groups[0].obsdate,
+            at_type='1',
+            nondetection=NonDetection(archiveid=str(config['archiveid']),
+                                      archival_remarks=config['archival_remarks']),
+            photometry=groups,
+            internal_name=target.name,
+            internal_name_format=internal_name_format,
+            remarks=f'Follow-up photometry of {target.name}',
+            name=target.name,
+            new_discovery=False,
+        )
+        reports.append((target, report, max(row[0] for row in rows)))
+    return reports
+
+
+def send_followup_batch(batch, reports, recorder):
+    """
+    Send the follow-up reports of a batch of recorded TNSSubmissions as one bulk report, with the bot of the batch,
+    and wait for the TNS reply. Returns the (status, worker, error) to give the submissions: a report that may have
+    reached the TNS without a report ID is left running (see `submissions.SENT_UNCONFIRMED`), and one whose reply
+    couldn't be had is left pending with its report ID, for the `tns_worker` command to get the reply.
+    """
+    sending = False
+    try:
+        with use_tns_bot(batch[0].bot_id):
+            sending = True
+            report_id = send_tns_report(dumps_tns_report(reports))
+            sending = False
+            TNSSubmission.objects.filter(pk__in=[submission.pk for submission in batch]).update(report_id=report_id)
+            for submission in batch:
+                submission.report_id = report_id
+            get_tns_report_reply(report_id, recorder)
+        return TNSSubmission.STATUS_SUCCEEDED, WEB_WORKER, ''
+    except (requests.exceptions.RequestException, BadTnsRequest) as e:
+        objects = ", ".join(str(submission.target) for submission in batch)
+        if batch[0].report_id is not None:
+            logger.warning(f'Sent the follow-up photometry of {objects} as TNS report {batch[0].report_id}, but '
+                           f'failed to get its reply: {e}')
+            return TNSSubmission.STATUS_PENDING, '', str(e)
+        if (sending and isinstance(e, TRANSIENT_ERRORS)
+                and not isinstance(e, requests.exceptions.ConnectTimeout)):
+            logger.error(f'The follow-up photometry of {objects} may or may not have been sent: {repr(e)}')
+            return TNSSubmission.STATUS_RUNNING, SENT_UNCONFIRMED, repr(e)
+        logger.error(f'Failed to report follow-up photometry of {objects}: {e}')
+        return TNSSubmission.STATUS_FAILED, WEB_WORKER, str(e)
+
+
+def report_followup_photometry(targets, batch_size=None):
+    """
+    Report the photometry of Targets known to the TNS that is newer than their last follow-up report.
+    Reports are sent as one bulk report (or one batched Hermes message) per batch of `batch_size` objects (setting
+    `batch_size` of `followup_photometry`, default 50). Each batch is recorded as running before it is sent, so its
+    photometry is never reported twice. If submissions are queued, one submission per object is queued for the
+    `tns_worker` command instead.
+    Returns the TNSSubmissions recording each object's report.
+    """
+    config = reporting_config(followup_settings())
+    if config is None:
+        return []
+    config['flux_unitid'] = tns_unit_id(config['flux_unit'])
+    if config['flux_unitid'] is None:
+        logger.error(f'Cannot report follow-up photometry: the TNS has no unit {config["flux_unit"]}')
+        return []
+    validator = get_report_validator()
+    reports = []
+    for target, report, last_photometry_id in build_followup_reports(targets, config):
+        errors = validator.validate(tns_bulk_report([report]))
+        if errors:
+            logger.warning(f'Not reporting follow-up photometry of {target}, the report is invalid: {errors}')
+            continue
+        reports.append((target, report, last_photometry_id))
+    if not reports:
+        return []
+
+    hermes = submit_through_hermes()
+    labels = option_labels(cache.get('all_tns_values') or populate_tns_values()[0]) if hermes else None
+    submissions = [
+        TNSSubmission(target=target, bot_id='hermes' if hermes else '', last_photometry_id=last_photometry_id,
+                      destination=TNSSubmission.DESTINATION_HERMES if hermes else TNSSubmission.DESTINATION_TNS,
+                      payload=report.to_hermes(labels) if hermes else tns_bulk_report([report]))
+        for target, report, last_photometry_id in reports
+    ]
+    if queue_submissions_enabled():
+        if not hermes:
+            # Spread the reports over the configured bots
+            for submission in submissions:
+                submission.bot_id = str(choose_tns_bot().get('bot_id', ''))
+        submissions = TNSSubmission.objects.bulk_create(submissions)
+        logger.info(f'Queued follow-up photometry reports of {len(submissions)} objects')
+        return submissions
+
+    batch_size = batch_size or config['batch_size']
+    recorded = []
+    for start in range(0, len(submissions), batch_size):
+        batch = submissions[start:start + batch_size]
+        # Each batch is sent by the bot with the most quota left
+        bot_id = 'hermes' if hermes else str(choose_tns_bot().get('bot_id', ''))
+        started = timezone.now()
+        for submission in batch:
+            submission.bot_id = bot_id
+            submission.status = TNSSubmission.STATUS_RUNNING
+            submission.worker = WEB_WORKER
+            submission.attempts = 1
+            submission.started = started
+        batch = TNSSubmission.objects.bulk_create(batch)
+        recorder = SubmissionMessages()
+        if hermes:
+            # One batched Hermes message per batch of objects, each object with its own TNS object name
+            results = [(TNSSubmission.STATUS_FAILED if error else TNSSubmission.STATUS_SUCCEEDED, WEB_WORKER, error,
+                        iau_name or '')
+                       for iau_name, error in submit_batch_to_hermes([submission.payload for submission in batch],
+                                                                     request=recorder, max_targets=batch_size)]
+        else:
+            results = [(*send_followup_batch(batch, [report for _, report, _ in reports[start:start + batch_size]],
+                                             recorder), '')] * len(batch)
+        finished = timezone.now()
+        for submission, (status, worker, error, iau_name) in zip(batch, results):
+            submission.status = status
+            submission.worker = worker
+            submission.error = error
+            submission.iau_name = iau_name
+            submission.messages = recorder.messages
+            if status in (TNSSubmission.STATUS_SUCCEEDED, TNSSubmission.STATUS_FAILED):
+                submission.finished = finished
+        TNSSubmission.objects.bulk_update(batch, ['status', 'worker', 'error', 'iau_name', 'messages', 'finished'])
+        recorded.extend(batch)
+    logger.info(f'Reported follow-up photometry of {len(recorded)} objects')
+    return recorded
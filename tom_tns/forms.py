@@ -1,12 +1,16 @@
-import requests
 import os
 
 from django import forms
 from django.conf import settings
 from django.core.exceptions import ValidationError
 
+from tom_tns.reports import ATReport, Classification, NonDetection, PhotometryGroup, Spectrum, tns_bulk_report
+from tom_tns.spectra import (DATUM_CHOICE_PREFIX, FITS_CHOICE_PREFIX, GENERATED_CHOICE_PREFIXES, fits_ascii_file,
+                             spectrum_ascii_file, spectrum_file_errors)
 from tom_tns.tns_api import (get_tns_values, group_names, get_reverse_tns_values,
                              pre_upload_files_to_tns, submit_through_hermes, example_internal_name)
+from tom_tns.tracing import trace_span
+from tom_tns.validation import validate_tns_report
 from tom_dataproducts.models import DataProduct
 
 from crispy_forms.helper import FormHelper
@@ -193,132 +197,77 @@ class TNSReportForm(BaseReportForm):
                 )
         return clean_results
 
+    def option_labels(self):
+        """ The labels of the TNS options offered by this form, for Hermes reports
+        """
+        return {
+            'groups': dict(self.fields['discovery_data_source'].choices) | dict(self.fields['reporting_group'].choices),
+            'at_types': dict(self.fields['at_type'].choices),
+            'instruments': dict(self.fields['instrument'].choices),
+            'filters': dict(self.fields['filter'].choices),
+            'archives': dict(self.fields['archive'].choices),
+        }
+
+    def to_report(self):
+        """ Returns the cleaned form data as an ATReport
+        """
+        data = self.cleaned_data
+        return ATReport(
+            ra=data['ra'],
+            dec=data['dec'],
+            reporting_groupid=data['reporting_group'],
+            data_source_groupid=data['discovery_data_source'],
+            reporter=data['reporter'],
+            discovery_datetime=data['discovery_date'],
+            at_type=data['at_type'],
+            nondetection=NonDetection(
+                archiveid=data['archive'],
+                archival_remarks=data['archival_remarks'],
+                comments=data['nondetection_remarks'],
+                obsdate=data['nondetection_observation_date'],
+                limiting_flux=data['nondetection_flux'],
+                flux_unitid=data['nondetection_flux_units'],
+                filterid=data['nondetection_filter'],
+                instrumentid=data['nondetection_instrument'],
+                exptime=data['nondetection_exposure_time'],
+                observer=data['nondetection_observer'],
+            ),
+            photometry=[PhotometryGroup(
+                obsdate=data['observation_date'],
+                flux=data['flux'],
+                flux_error=data['flux_error'],
+                flux_unitid=data['flux_units'],
+                filterid=data['filter'],
+                instrumentid=data['instrument'],
+                limiting_flux=data['limiting_flux'],
+                exptime=data['exposure_time'],
+                observer=data['observer'],
+                comments=data['photometry_remarks'],
+                telescope=data['telescope'],
+            )],
+            internal_name=data['internal_name'],
+            internal_name_format=internal_name_format,
+            remarks=data['discovery_remarks'],
+            name=data['object_name'],
+            submitter=data['submitter'],
+        )
+
     def generate_hermes_report(self):
         """
         Generate Hermes TNS discovery report according to the hermes schema
 
         Returns the report as a Dict to be sent as JSON
         """
-        hermes_report = {
-            'topic': 'hermes.test',
-            'title': f'{self.cleaned_data["object_name"]} TNS discovery report',
-            'submit_to_tns': True,
-            'submitter': self.cleaned_data['submitter'],
-            'authors': self.cleaned_data['reporter'],  # TODO: Set the initial authors on the field from the settings
-            'data': {
-                'targets': [{
-                    'name': self.cleaned_data['object_name'],
-                    'ra': self.cleaned_data['ra'],
-                    'dec': self.cleaned_data['dec'],
-                    'new_discovery': True,
-                    'discovery_info': {
-                        'date': self.cleaned_data['discovery_date'].isoformat(),
-                        'discovery_source': dict(
-                            self.fields['discovery_data_source'].choices)[self.cleaned_data['discovery_data_source']],
-                        'reporting_group': dict(
-                            self.fields['reporting_group'].choices)[self.cleaned_data['reporting_group']],
-                        'transient_type': dict(self.fields['at_type'].choices)[int(self.cleaned_data['at_type'])],
-                    }
-                }],
-                'photometry': [{
-                    'target_name': self.cleaned_data['object_name'],
-                    'date_obs': self.cleaned_data['observation_date'].isoformat(),
-                    'instrument': dict(self.fields['instrument'].choices)[self.cleaned_data['instrument']],
-                    'bandpass': dict(self.fields['filter'].choices)[self.cleaned_data['filter']],
-                    "brightness": self.cleaned_data['flux'],
-                    "brightness_error": self.cleaned_data['flux_error'],
-                    "brightness_unit": self.cleaned_data['flux_units'],
-                }]
-            },
-        }
-        if self.is_set('discovery_remarks'):
-            hermes_report['data']['targets'][0]['comments'] = self.cleaned_data['discovery_remarks']
-        if self.is_set('photometry_remarks'):
-            hermes_report['data']['photometry'][0]['comments'] = self.cleaned_data['photometry_remarks']
-        if self.is_set('exposure_time'):
-            hermes_report['data']['photometry'][0]['exposure_time'] = self.cleaned_data['exposure_time']
-        if self.is_set('observer'):
-            hermes_report['data']['photometry'][0]['observer'] = self.cleaned_data['observer']
-        if self.is_set('limiting_flux'):
-            hermes_report['data']['photometry'][0]['limiting_brightness'] = self.cleaned_data['limiting_flux']
-        if self.is_set('telescope'):
-            hermes_report['data']['photometry'][0]['telescope'] = self.cleaned_data['telescope']
-
-        if self.is_set('archive') and self.is_set('archival_remarks'):
-            discovery_info = hermes_report['data']['targets'][0]['discovery_info']
-            discovery_info['nondetection_source'] = dict(
-                self.fields['archive'].choices)[self.cleaned_data['archive']]
-            discovery_info['nondetection_comments'] = self.cleaned_data['archival_remarks']
-        elif all([self.is_set(field) for field in [
-            'nondetection_flux', 'nondetection_instrument', 'nondetection_filter', 'nondetection_observation_date'
-        ]]):
-            nondetection = {
-                'limiting_brightness': self.cleaned_data['nondetection_flux'],
-                'limiting_brightness_unit': self.cleaned_data['nondetection_flux_units'],
-                'date_obs': self.cleaned_data['nondetection_observation_date'],
-                'bandpass': self.cleaned_data['nondetection_filter'],
-                'instrument': self.cleaned_data['nondetection_instrument'],
-            }
-            if self.is_set('nondetection_exposure_time'):
-                nondetection['exposure_time'] = self.cleaned_data['nondetection_exposure_time']
-            if self.is_set('nondetection_observer'):
-                nondetection['observer'] = self.cleaned_data['nondetection_observer']
-            if self.is_set('nondetection_remarks'):
-                nondetection['comments'] = self.cleaned_data['nondetection_remarks']
-            hermes_report['data']['photometry'].append(nondetection)
-
-        return hermes_report, []
-
-    def generate_tns_report(self):
+        return self.to_report().to_hermes(self.option_labels()), []
+
+    def generate_tns_report(self, deadline=None):
         """
         Generate TNS bulk transient report according to the schema in this manual:
         https://sandbox.wis-tns.org/sites/default/files/api/TNS_bulk_reports_manual.pdf
 
-        Returns the report as a JSON-formatted string
+        Returns the report as a Dict to be sent as JSON
         """
-        report_data = {
-            "at_report": {
-                "0": {
-                    "ra": {
-                        "value": self.cleaned_data['ra'],
-                    },
-                    "dec": {
-                        "value": self.cleaned_data['dec'],
-                    },
-                    "reporting_groupid": self.cleaned_data['reporting_group'],
-                    "data_source_groupid": self.cleaned_data['discovery_data_source'],
-                    "reporter": self.cleaned_data['reporter'],
-                    "discovery_datetime": self.cleaned_data['discovery_date'].strftime('%Y-%m-%d %H:%M:%S'),
-                    "at_type": self.cleaned_data['at_type'],
-                    "internal_name_format": internal_name_format,
-                    "remarks": self.cleaned_data["discovery_remarks"],
-                    "non_detection": {
-                        "archiveid": self.cleaned_data['archive'],
-                        "archival_remarks": self.cleaned_data['archival_remarks'],
-                        "comments": self.cleaned_data['nondetection_remarks'],
-                    },
-                    "photometry": {
-                        "photometry_group": {
-                            "0": {
-                                "obsdate": self.cleaned_data['observation_date'].strftime('%Y-%m-%d %H:%M:%S'),
-                                "flux": self.cleaned_data['flux'],
-                                "flux_error": self.cleaned_data['flux_error'],
-                                "flux_unitid": self.cleaned_data['flux_units'],
-                                "filterid": self.cleaned_data['filter'],
-                                "instrumentid": self.cleaned_data['instrument'],
-                                "limiting_flux": self.cleaned_data['limiting_flux'],
-                                "exptime": self.cleaned_data['exposure_time'],
-                                "observer": self.cleaned_data['observer'],
-                                "comments": self.cleaned_data['photometry_remarks'],
-                            },
-                        }
-                    },
-                }
-            }
-        }
-        if self.cleaned_data['internal_name']:
-            report_data['at_report']['0']['internal_name'] = self.cleaned_data['internal_name']
-        return report_data
+        return tns_bulk_report([self.to_report()])
 
 
 class TNSClassifyForm(BaseReportForm):
@@ -340,7 +289,7 @@ class TNSClassifyForm(BaseReportForm):
     spectrum_type = forms.ChoiceField(choices=[])
     ascii_file = forms.ChoiceField(label='ASCII file*', choices=[], required=False,
                                    help_text='Select a DataProduct associated with this Target with a .txt or'
-                                   ' .ascii extension.')
+                                   ' .ascii extension, or a file converted from its FITS files or reduced spectra.')
     fits_file = forms.ChoiceField(label='FITS file', choices=[], required=False,
                                   help_text='Select a DataProduct associated with this Target with a .fits or'
                                   ' .fits.fz extension.')
@@ -358,6 +307,8 @@ class TNSClassifyForm(BaseReportForm):
         Also define the form layout using crispy-forms.
         """
         super().__init__(*args, **kwargs)
+        # The ASCII file generated by `check_spectrum_files`, if one was chosen
+        self.generated_ascii_file = None
         self.fields['instrument'].choices = get_tns_values('instruments')
         self.fields['instrument'].initial = (0, "Other")
         self.fields['classification'].choices = get_tns_values('objtypes')
@@ -424,128 +375,145 @@ class TNSClassifyForm(BaseReportForm):
             raise ValidationError(
                 "Must include an ascii/txt file. Either choose an existing data product, or upload a new one."
                 )
+        self.check_spectrum_files()
         return clean_results
 
+    def check_spectrum_files(self):
+        """
+        Check the chosen or uploaded spectrum files before anything is sent, as the TNS only rejects a bad file after
+        it is uploaded and the report is processed (see `tom_tns.spectra.spectrum_file_errors`). ASCII files that
+        tom_tns generates are generated and checked too, and kept for `get_spectrum_files`.
+        """
+        for file_type in ['ascii_file', 'fits_file']:
+            override = f'{file_type}_override'
+            if self.is_set(override):
+                with trace_span('check_spectrum_file', file_type=file_type):
+                    errors = spectrum_file_errors(self.cleaned_data[override], file_type)
+                field = override
+            elif self.is_set(file_type) and self.cleaned_data[file_type].startswith(GENERATED_CHOICE_PREFIXES):
+                try:
+                    self.generated_ascii_file = self.generate_ascii_file(self.cleaned_data[file_type])
+                except (ValueError, OSError) as e:
+                    self.add_error(file_type, f'The ASCII file could not be generated: {e}')
+                    continue
+                with trace_span('check_spectrum_file', file_type=file_type):
+                    errors = spectrum_file_errors(self.generated_ascii_file, file_type)
+                field = file_type
+            elif self.is_set(file_type):
+                data_product = DataProduct.objects.filter(pk=self.cleaned_data[file_type]).first()
+                if data_product is None:
+                    continue
+                with trace_span('check_spectrum_file', file_type=file_type), data_product.data.open('rb') as file:
+                    errors = spectrum_file_errors(file, file_type)
+                field = file_type
+            else:
+                continue
+            if errors:
+                self.add_error(field, errors)
+
+    @staticmethod
+    def generate_ascii_file(choice):
+        """ Returns the ASCII file generated from a reduced spectrum or converted from FITS, for an ascii_file choice
+        """
+        if choice.startswith(DATUM_CHOICE_PREFIX):
+            return spectrum_ascii_file(int(choice[len(DATUM_CHOICE_PREFIX):]))
+        return fits_ascii_file(int(choice[len(FITS_CHOICE_PREFIX):]))
+
+    def get_spectrum_files(self):
+        """
+        Returns the ascii and fits (or None) files to submit, from the uploaded overrides or the chosen DataProducts
+        """
+        with trace_span('fetch_data_products'):
+            if self.is_set('ascii_file_override'):
+                ascii_file = self.cleaned_data['ascii_file_override']
+            elif self.cleaned_data['ascii_file'].startswith(GENERATED_CHOICE_PREFIXES):
+                ascii_file = self.generated_ascii_file or self.generate_ascii_file(self.cleaned_data['ascii_file'])
+            else:
+                ascii_file = DataProduct.objects.get(pk=self.cleaned_data['ascii_file']).data
+            if self.is_set('fits_file_override'):
+                fits_file = self.cleaned_data['fits_file_override']
+            elif self.is_set('fits_file'):
+                fits_file = DataProduct.objects.get(pk=self.cleaned_data['fits_file']).data
+            else:
+                fits_file = None
+        return ascii_file, fits_file
+
+    def option_labels(self):
+        """ The labels of the TNS options offered by this form, for Hermes reports
+        """
+        return {
+            'groups': dict(self.fields['reporting_group'].choices),
+            'instruments': dict(self.fields['instrument'].choices),
+            'spectra_types': dict(self.fields['spectrum_type'].choices),
+            'objtypes': dict(self.fields['classification'].choices),
+        }
+
+    def to_report(self, ascii_file, fits_file=None):
+        """ Returns the cleaned form data as a Classification of a spectrum with the given file names
+        """
+        data = self.cleaned_data
+        return Classification(
+            name=data['object_name'],
+            classifier=data['classifier'],
+            objtypeid=data['classification'],
+            groupid=data['reporting_group'],
+            spectra=[Spectrum(
+                obsdate=data['observation_date'],
+                instrumentid=data['instrument'],
+                spectypeid=data['spectrum_type'],
+                observer=data['observer'],
+                ascii_file=ascii_file,
+                fits_file=fits_file or '',
+                exptime=data['exposure_time'],
+                reducer=data['reducer'],
+                remarks=data['spectrum_remarks'],
+                telescope=data['telescope'],
+                ascii_file_description=data.get('ascii_file_description', ''),
+                fits_file_description=data.get('fits_file_description', ''),
+            )],
+            redshift=data['redshift'],
+            remarks=data['classification_remarks'],
+            ra=data['ra'],
+            dec=data['dec'],
+            submitter=data['submitter'],
+        )
+
+    def build_report(self):
+        """
+        Returns the Classification, named after the local spectrum files, and the ascii and fits (or None) files
+        """
+        ascii_file, fits_file = self.get_spectrum_files()
+        report = self.to_report(os.path.basename(ascii_file.name),
+                                os.path.basename(fits_file.name) if fits_file else '')
+        return report, ascii_file, fits_file
+
     def generate_hermes_report(self):
         """
         Generate Hermes TNS classification report according to the hermes schema
 
-        Returns the report as a Dict to be sent as JSON
+        Returns the report as a Dict to be sent as JSON, and the files to attach
         """
-        if self.is_set('ascii_file_override'):
-            ascii_file = self.cleaned_data['ascii_file_override']
-        else:
-            ascii_file = DataProduct.objects.get(pk=self.cleaned_data['ascii_file']).data
-        if self.is_set('fits_file_override'):
-            fits_file = self.cleaned_data['fits_file_override']
-        elif self.is_set('fits_file'):
-            fits_file = DataProduct.objects.get(pk=self.cleaned_data['fits_file']).data
-        else:
-            fits_file = None
-        hermes_report = {
-            'topic': 'hermes.test',
-            'title': f'{self.cleaned_data["object_name"]} TNS classification report',
-            'submit_to_tns': True,
-            'submitter': self.cleaned_data['submitter'],
-            'authors': self.cleaned_data['classifier'],  # TODO: Set the initial authors on the field from the settings
-            'data': {
-                'targets': [{
-                    'name': self.cleaned_data['object_name'],
-                    'ra': self.cleaned_data['ra'],
-                    'dec': self.cleaned_data['dec'],
-                    'new_discovery': False,
-                    'discovery_info': {
-                        'reporting_group': dict(
-                            self.fields['reporting_group'].choices)[self.cleaned_data['reporting_group']]
-                    }
-                }],
-                'spectroscopy': [{
-                    'target_name': self.cleaned_data['object_name'],
-                    'date_obs': self.cleaned_data['observation_date'].isoformat(),
-                    'instrument': dict(self.fields['instrument'].choices)[self.cleaned_data['instrument']],
-                    'spec_type': dict(self.fields['spectrum_type'].choices)[self.cleaned_data['spectrum_type']],
-                    'classification': dict(self.fields['classification'].choices)[self.cleaned_data['classification']],
-                    'observer': self.cleaned_data['observer'],
-                    'file_info': [
-                        {
-                            'name': os.path.basename(ascii_file.name),
-                            'description': self.cleaned_data.get('ascii_file_description', '')
-                        }
-                    ]
-                }]
-            },
-        }
-        files = [ascii_file]
-        if self.is_set('telescope'):
-            hermes_report['data']['spectroscopy'][0]['telescope'] = self.cleaned_data['telescope']
-        if self.is_set('redshift'):
-            hermes_report['data']['targets'][0]['redshift'] = self.cleaned_data['redshift']
-        if self.is_set('classification_remarks'):
-            hermes_report['data']['targets'][0]['comments'] = self.cleaned_data['classification_remarks']
-        if self.is_set('reducer'):
-            hermes_report['data']['spectroscopy'][0]['reducer'] = self.cleaned_data['reducer']
-        if self.is_set('exposure_time'):
-            hermes_report['data']['spectroscopy'][0]['exposure_time'] = self.cleaned_data['exposure_time']
-        if fits_file:
-            hermes_report['data']['spectroscopy'][0]['file_info'].append({
-                'name': os.path.basename(fits_file.name),
-                'description': self.cleaned_data.get('fits_file_description', '')
-            })
-            files.append(fits_file)
-        if self.is_set('spectrum_remarks'):
-            hermes_report['data']['spectroscopy'][0]['comments'] = self.cleaned_data['spectrum_remarks']
-
-        return hermes_report, files
-
-    def generate_tns_report(self):
+        report, ascii_file, fits_file = self.build_report()
+        files = [ascii_file, fits_file] if fits_file else [ascii_file]
+        return report.to_hermes(self.option_labels()), files
+
+    def generate_tns_report(self, deadline=None):
         """
         Generate TNS bulk classification report according to the schema in this manual:
         https://sandbox.wis-tns.org/sites/default/files/api/TNS_bulk_reports_manual.pdf
+        The spectrum files are uploaded within the `deadline`, if given.
 
-        Returns the report as a JSON-formatted string
+        Returns the report as a Dict to be sent as JSON
         """
-        if self.is_set('ascii_file_override'):
-            ascii_file = self.cleaned_data['ascii_file_override']
-        else:
-            ascii_file = DataProduct.objects.get(pk=self.cleaned_data['ascii_file']).data
-        if self.is_set('fits_file_override'):
-            fits_file = self.cleaned_data['fits_file_override']
-        elif self.is_set('fits_file'):
-            fits_file = DataProduct.objects.get(pk=self.cleaned_data['fits_file']).data
-        else:
-            fits_file = None
+        report, ascii_file, fits_file = self.build_report()
+        # Check the report before uploading any files, then use the uploaded file names
+        validate_tns_report(tns_bulk_report([report]))
         file_list = {'ascii_file': ascii_file,
                      'fits_file': fits_file,
                      'other_files': []}
-        try:
-            tns_filenames = pre_upload_files_to_tns(file_list)
-        except requests.exceptions.HTTPError as e:
-            return {'message': f"ERROR: {e}"}
-        report_data = {
-            "classification_report": {
-                "0": {
-                    "name": self.cleaned_data['object_name'],
-                    "classifier": self.cleaned_data['classifier'],
-                    "objtypeid": self.cleaned_data['classification'],
-                    "redshift": self.cleaned_data['redshift'],
-                    "groupid": self.cleaned_data['reporting_group'],
-                    "remarks": self.cleaned_data['classification_remarks'],
-                    "spectra": {
-                        "spectra-group": {
-                            "0": {
-                                "obsdate": self.cleaned_data['observation_date'].strftime('%Y-%m-%d %H:%M:%S'),
-                                "instrumentid": self.cleaned_data['instrument'],
-                                "exptime": self.cleaned_data['exposure_time'],
-                                "observer": self.cleaned_data['observer'],
-                                "reducer": self.cleaned_data['reducer'],
-                                "spectypeid": self.cleaned_data['spectrum_type'],
-                                "ascii_file": tns_filenames.get('ascii_file', ''),
-                                "fits_file": tns_filenames.get('fits_file', ''),
-                                "remarks": self.cleaned_data['spectrum_remarks'],
-                            },
-                        }
-                    },
-                }
-            }
-        }
-        return report_data
+        # Upload errors are reported by the view, rather than sending a report without its files
+        with trace_span('pre_upload_files_to_tns'):
+            tns_filenames = pre_upload_files_to_tns(file_list, deadline)
+        report.spectra[0].ascii_file = tns_filenames.get('ascii_file', '')
+        report.spectra[0].fits_file = tns_filenames.get('fits_file', '')
+        return tns_bulk_report([report])
@@ -2,6 +2,9 @@ from django.conf import settings
 from django.contrib import messages
 from urllib.parse import urljoin
 
+from tom_tns.deadline import DeadlineExceeded, request_timeout
+from tom_tns.metrics import time_request
+
 import requests
 import json
 import logging
@@ -19,38 +22,157 @@ def get_object_from_response(response_json):
     return None
 
 
-def submit_to_hermes(hermes_message, files, request):
+DEFAULT_HERMES_BATCH_SETTINGS = {
+    'max_targets': 50,  # targets per batched message
+    'max_bytes': 1_000_000,  # size of the JSON of a batched message, not counting files
+}
+
+
+def hermes_batch_settings():
+    tns_settings = getattr(settings, 'DATA_SERVICES', {}).get('TNS', {})
+    return DEFAULT_HERMES_BATCH_SETTINGS | tns_settings.get('hermes_batch', {})
+
+
+def get_objects_from_response(response_json, target_names):
+    """
+    Map the tns_object references of a response to a batched message to its targets, by the target name of each
+    reference. Hermes doesn't promise any order of its references, so references without a target name are only
+    used for a message of a single target. Returns a list of TNS object names (or None) in the order of
+    `target_names`.
+    """
+    references = [reference for reference in response_json.get('data', {}).get('references', [])
+                  if reference.get('source') == 'tns_object']
+    by_name = {reference['target_name']: reference.get('citation') for reference in references
+               if reference.get('target_name')}
+    if not by_name and len(target_names) == 1 and len(references) == 1:
+        return [references[0].get('citation')]
+    return [by_name.get(name) for name in target_names]
+
+
+def post_hermes_message(hermes_message, files, deadline=None):
+    """
+    Post a message, with its files if any, to Hermes. Returns the response JSON, raising on HTTP errors.
+    The request times out at the `deadline`, if given.
+    """
     hermes_submit_url = urljoin(settings.DATA_SHARING.get('hermes', {}).get('BASE_URL', ''), 'api/v0/submit_message/')
     headers = {'Authorization': f"Token {settings.DATA_SHARING.get('hermes', {}).get('HERMES_API_KEY', '')}"}
-    response_json = {}
+    if not files:
+        # Can submit simple json payload to hermes, and this assumed to be a new discovery
+        with time_request('hermes/submit_message') as timing:
+            response = requests.post(url=hermes_submit_url, json=hermes_message, headers=headers,
+                                     timeout=request_timeout(deadline, 'submitting to Hermes'))
+            timing['status'] = response.status_code
+    else:
+        # There are files, so this must be a classification submission
+        data = {'data': json.dumps(hermes_message)}
+        files_to_submit = []
+        for file in files:
+            content_type = 'text/plain'
+            if file.name.endswith('fits') or file.name.endswith('fits.fz'):
+                content_type = 'application/fits'
+            files_to_submit.append(('files', (os.path.basename(file.name), file.open('rb'), content_type)))
+        with time_request('hermes/submit_message') as timing:
+            response = requests.post(url=hermes_submit_url, data=data, files=files_to_submit, headers=headers,
+                                     timeout=request_timeout(deadline, 'submitting to Hermes'))
+            timing['status'] = response.status_code
+    try:
+        response_json = response.json()
+    except ValueError:
+        response_json = {}
+    if not response.ok:
+        raise requests.exceptions.HTTPError(f'{response.status_code} {response_json or response.reason}',
+                                            response=response)
+    return response_json
+
+
+def submit_to_hermes(hermes_message, files, request, deadline=None):
+    """
+    Submit a message to Hermes, returning the TNS object name. Errors are added to the messages of `request`,
+    except DeadlineExceeded, raised if the `deadline` passed before the message could be sent, and
+    requests.exceptions.Timeout, after which the message may or may not have reached Hermes.
+    """
     try:
-        if not files:
-            # Can submit simple json payload to hermes, and this assumed to be a new discovery
-            response = requests.post(url=hermes_submit_url, json=hermes_message, headers=headers)
-            response_json = response.json()
-            response.raise_for_status()
-            logger.info(f"Sent TNS discovery message through Hermes with uuid {response_json.get('uuid')}")
-            return get_object_from_response(response_json)
-        else:
-            # There are files, so this must be a classification submission
-            data = {'data': json.dumps(hermes_message)}
-            files_to_submit = []
-            for file in files:
-                content_type = 'text/plain'
-                if file.name.endswith('fits') or file.name.endswith('fits.fz'):
-                    content_type = 'application/fits'
-                files_to_submit.append(('files', (os.path.basename(file.name), file.open('rb'), content_type)))
-            response = requests.post(url=hermes_submit_url, data=data, files=files_to_submit, headers=headers)
-            response_json = response.json()
-            response.raise_for_status()
-            logger.info(f"Sent TNS classification message through Hermes with uuid {response_json.get('uuid')}")
-            return get_object_from_response(response_json)
+        response_json = post_hermes_message(hermes_message, files, deadline)
+        message_type = 'classification' if files else 'discovery'
+        logger.info(f"Sent TNS {message_type} message through Hermes with uuid {response_json.get('uuid')}")
+        return get_object_from_response(response_json)
+    except (DeadlineExceeded, requests.exceptions.Timeout):
+        raise
     except Exception as e:
-        error_msg = 'Failed to Submit message to Hermes/TNS'
-        if response_json:
-            error_msg += f': {response_json}'
-        else:
-            error_msg += f': {repr(e)}'
+        error_msg = f'Failed to Submit message to Hermes/TNS: {e if isinstance(e, requests.HTTPError) else repr(e)}'
         logger.error(error_msg)
         messages.error(request, error_msg)
     return None
+
+
+def merge_hermes_messages(hermes_messages):
+    """
+    Merge single-target Hermes messages (e.g. from `ATReport.to_hermes` or `Classification.to_hermes`) into one
+    message with the targets, photometry and spectroscopy of all of them. The topic, submitter and authors are
+    taken from the first message.
+    """
+    first = hermes_messages[0]
+    data = {}
+    for hermes_message in hermes_messages:
+        for key, values in hermes_message['data'].items():
+            data.setdefault(key, []).extend(values)
+    names = [target['name'] for target in data.get('targets', [])]
+    title = first['title'] if len(names) == 1 else f'TNS reports of {len(names)} objects: {", ".join(names)}'
+    return first | {'title': title[:256], 'data': data}
+
+
+def batch_hermes_messages(hermes_messages, max_targets=None, max_bytes=None, files=None):
+    """
+    Group single-target Hermes messages into batches that can be merged into one message: consecutive messages with
+    the same topic, submitter and authors, and of the same type (discovery reports without files, or classifications
+    with files, given as a list of the `files` of each message), with at most `max_targets` targets and `max_bytes`
+    bytes of JSON per batch (settings `max_targets` and `max_bytes` of `hermes_batch`).
+    Returns lists of indices into `hermes_messages`.
+    """
+    config = hermes_batch_settings()
+    max_targets = max_targets or config['max_targets']
+    max_bytes = max_bytes or config['max_bytes']
+    batches = []
+    batch, batch_key, batch_bytes = [], None, 0
+    for i, hermes_message in enumerate(hermes_messages):
+        key = (hermes_message.get('topic'), hermes_message.get('submitter'), hermes_message.get('authors'),
+               bool(files and files[i]))
+        size = len(json.dumps(hermes_message['data'], default=str))
+        if batch and (key != batch_key or len(batch) >= max_targets or batch_bytes + size > max_bytes):
+            batches.append(batch)
+            batch, batch_bytes = [], 0
+        batch.append(i)
+        batch_key = key
+        batch_bytes += size
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def submit_batch_to_hermes(hermes_messages, files=None, request=None, max_targets=None, max_bytes=None):
+    """
+    Submit many single-target Hermes messages as batched messages (see `batch_hermes_messages`), each sent in one
+    request with the files of all of its targets. `files` is a list of the files of each message, if any.
+    Returns a list of (TNS object name or None, error message) in the order of `hermes_messages`; errors are also
+    added to `request` (or a stand-in like `SubmissionMessages`) if given.
+    """
+    files = files or [[] for _ in hermes_messages]
+    results = [(None, '')] * len(hermes_messages)
+    for batch in batch_hermes_messages(hermes_messages, max_targets, max_bytes, files):
+        merged = merge_hermes_messages([hermes_messages[i] for i in batch])
+        target_names = [target['name'] for target in merged['data'].get('targets', [])]
+        try:
+            response_json = post_hermes_message(merged, [file for i in batch for file in files[i]])
+            logger.info(f"Sent TNS reports of {len(batch)} objects through Hermes with uuid "
+                        f"{response_json.get('uuid')}")
+            names = get_objects_from_response(response_json, target_names)
+            for i, name in zip(batch, names):
+                results[i] = (name, '' if name else 'Hermes did not return a TNS object name')
+        except Exception as e:
+            error_msg = f'Failed to Submit message to Hermes/TNS: {e if isinstance(e, requests.HTTPError) else repr(e)}'
+            logger.error(error_msg)
+            if request is not None:
+                messages.error(request, error_msg)
+            for i in batch:
+                results[i] = (None, error_msg)
+    return results
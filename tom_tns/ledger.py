@@ -0,0 +1,154 @@
+"""
+Deduplication of the submissions made from the TNS page. Every submission is recorded as a TNSSubmission with the
+hash of the form data it was built from, before anything is uploaded or sent. A submission is not sent again if:
+
+* the same data was already reported for the Target: the earlier result is returned instead, or
+* the same data, or any other report of a Target within `duplicate_radius` arcseconds, is in flight (pending or
+  running for less than `duplicate_window_seconds`): its status is returned instead.
+
+This catches double clicks, browser retries and two users reporting the same transient at once. Submissions are
+checked and recorded one at a time, under the `ledger` TNSLock.
+"""
+import hashlib
+import json
+from contextlib import contextmanager
+from datetime import timedelta
+
+import numpy as np
+from astropy import units
+from astropy.coordinates import SkyCoord
+from django.conf import settings
+from django.core.files import File
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+
+from tom_targets.models import Target
+
+from tom_tns.models import TNSLock, TNSSubmission
+from tom_tns.spectra import file_hash
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+# The `worker` of submissions that are being sent directly (from the TNS page or in follow-up batches), not by a
+# `tns_worker`
+WEB_WORKER = 'web'
+IN_FLIGHT = [TNSSubmission.STATUS_PENDING, TNSSubmission.STATUS_RUNNING]
+LEDGER_LOCK = 'ledger'
+
+
+class DuplicateSubmission(Exception):
+    """ Raised when a submission would duplicate an earlier or in-flight `submission` """
+    def __init__(self, submission):
+        super().__init__(f'Duplicate of {submission}')
+        self.submission = submission
+
+
+def duplicate_settings():
+    tns_settings = getattr(settings, 'DATA_SERVICES', {}).get('TNS', {})
+    return {
+        'duplicate_radius': tns_settings.get('duplicate_radius', tns_settings.get('crossmatch_radius', 2.0)),
+        'duplicate_window_seconds': tns_settings.get('duplicate_window_seconds', 60 * 60),
+    }
+
+
+def _hash_value(value):
+    """ Uploaded files are identified by their contents, any other value by its string """
+    if isinstance(value, File):
+        digest = file_hash(value)
+        value.seek(0)
+        return digest
+    return str(value)
+
+
+def submission_hash(form):
+    """ The SHA-256 hash of the cleaned data of a TNS form, which identifies the report built from it
+    """
+    data = {'form': type(form).__name__, 'data': form.cleaned_data}
+    return hashlib.sha256(json.dumps(data, sort_keys=True, default=_hash_value).encode()).hexdigest()
+
+
+def find_duplicate_submission(target_id, payload_hash):
+    """
+    Returns the TNSSubmission that a new submission of `payload_hash` for a Target would duplicate, or None:
+    a succeeded submission of the same hash, or an in-flight submission of the same hash or of a Target nearby.
+    Follow-up photometry reports are never considered duplicates.
+    """
+    config = duplicate_settings()
+    since = timezone.now() - timedelta(seconds=config['duplicate_window_seconds'])
+    same = (TNSSubmission.objects.filter(target_id=target_id, payload_hash=payload_hash)
+            .exclude(status=TNSSubmission.STATUS_FAILED).order_by('-created'))
+    for submission in same:
+        if submission.status == TNSSubmission.STATUS_SUCCEEDED or submission.created >= since:
+            return submission
+
+    target = Target.objects.filter(pk=target_id, ra__isnull=False, dec__isnull=False).values('ra', 'dec').first()
+    if target is None:
+        return None
+    in_flight = list(TNSSubmission.objects.filter(status__in=IN_FLIGHT, created__gte=since,
+                                                  last_photometry_id__isnull=True,
+                                                  target__ra__isnull=False, target__dec__isnull=False)
+                     .values_list('pk', 'target__ra', 'target__dec').order_by('created'))
+    if not in_flight:
+        return None
+    pks, ras, decs = zip(*in_flight)
+    separation = SkyCoord(target['ra'], target['dec'], unit='deg').separation(
+        SkyCoord(np.array(ras), np.array(decs), unit='deg')).to_value(units.arcsec)
+    nearby = np.flatnonzero(separation <= config['duplicate_radius'])
+    return TNSSubmission.objects.get(pk=pks[nearby[0]]) if len(nearby) else None
+
+
+@contextmanager
+def recording_submission(target_id, payload_hash):
+    """
+    A transaction in which to record a new submission of `payload_hash` for a Target. It holds the ledger lock, so
+    that no other submission is recorded between the duplicate check and the end of the transaction, and raises
+    DuplicateSubmission if the submission would duplicate another one (see `find_duplicate_submission`).
+    Submissions without a hash are not checked.
+    """
+    with transaction.atomic():
+        if payload_hash:
+            TNSLock.acquire([LEDGER_LOCK])
+            duplicate = find_duplicate_submission(target_id, payload_hash)
+            if duplicate is not None:
+                raise DuplicateSubmission(duplicate)
+        yield
+
+
+def start_submission(target_id, payload_hash, user=None, destination=TNSSubmission.DESTINATION_TNS, bot_id=''):
+    """
+    Record a submission that is about to be sent from the TNS page, as running. The payload is filled in once the
+    report is built. Raises DuplicateSubmission if it would duplicate another submission, and returns None if a
+    submission of the same hash for the Target is already in flight.
+    """
+    with recording_submission(target_id, payload_hash):
+        try:
+            with transaction.atomic():
+                return TNSSubmission.objects.create(target_id=target_id, user=user, destination=destination,
+                                                    bot_id=bot_id, payload={}, payload_hash=payload_hash,
+                                                    status=TNSSubmission.STATUS_RUNNING, worker=WEB_WORKER,
+                                                    attempts=1, started=timezone.now())
+        except IntegrityError:
+            return None
+
+
+def finish_submission(submission, iau_name='', error=''):
+    """ Record the result of a submission sent from the TNS page. Failed submissions may be submitted again
+    """
+    submission.status = TNSSubmission.STATUS_FAILED if error else TNSSubmission.STATUS_SUCCEEDED
+    submission.iau_name = iau_name or ''
+    submission.error = str(error)
+    submission.finished = timezone.now()
+    submission.save(update_fields=['status', 'iau_name', 'error', 'finished'])
+
+
+def duplicate_message(submission):
+    """ Tell the user why a submission was not sent again
+    """
+    if submission.status == TNSSubmission.STATUS_SUCCEEDED:
+        return (f'This report was already submitted for {submission.target} on {submission.finished:%Y-%m-%d %H:%M}'
+                f'{f" and named {submission.iau_name}" if submission.iau_name else ""}, so it was not sent again.')
+    report = f' as TNS report {submission.report_id}' if submission.report_id else ''
+    return (f'A report of {submission.target} is already being submitted{report}, so this one was not sent. '
+            'Please check the TNS once it is processed before submitting again.')
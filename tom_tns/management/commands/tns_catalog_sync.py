@@ -0,0 +1,34 @@
+from django.core.management.base import BaseCommand
+
+from tom_tns.catalog import TNS_CATALOG_FILE, apply_tns_catalog_file, download_tns_catalog, sync_tns_catalog
+
+
+class Command(BaseCommand):
+    """
+    Keep the local TNS public objects catalogue up to date by applying the daily and hourly delta files published by
+    the TNS since the last sync. Intended to be run periodically (e.g. hourly from cron).
+
+    Example:
+        ./manage.py tns_catalog_sync
+    """
+
+    help = 'Apply TNS public objects delta files to the local TNS catalogue'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--full',
+            action='store_true',
+            help='Download and ingest the full catalogue instead of applying deltas.'
+        )
+
+    def handle(self, *args, **options):
+        if options['full']:
+            applied = [apply_tns_catalog_file(TNS_CATALOG_FILE, download_tns_catalog())]
+        else:
+            applied = sync_tns_catalog()
+        for catalog_file in applied:
+            self.stdout.write(f'Applied {catalog_file.filename}: {catalog_file.rows} objects')
+        if applied:
+            self.stdout.write(self.style.SUCCESS(f'Local TNS catalogue synced up to {applied[-1].snapshot_time}'))
+        else:
+            self.stdout.write('Local TNS catalogue is already up to date')
@@ -0,0 +1,64 @@
+import os
+import time
+
+from django.core.management.base import BaseCommand
+
+from tom_tns.catalog import (TNS_CATALOG_FILE, add_tns_aliases, apply_tns_catalog_file, crossmatch_radius,
+                             crossmatch_targets, download_tns_catalog)
+
+
+class Command(BaseCommand):
+    """
+    Crossmatch all TOM Targets against the locally ingested TNS public objects catalogue and add the IAU names of
+    matched objects as Target aliases.
+
+    Example:
+        ./manage.py tns_crossmatch --download --radius 3
+    """
+
+    help = 'Crossmatch Targets against the local TNS catalogue and add IAU names as aliases'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--catalog',
+            help='Path to a TNS public objects CSV (or zipped CSV) to ingest before crossmatching.'
+        )
+        parser.add_argument(
+            '--download',
+            action='store_true',
+            help='Download and ingest the full TNS public objects catalogue before crossmatching.'
+        )
+        parser.add_argument(
+            '--radius',
+            type=float,
+            default=None,
+            help=f'Match radius in arcseconds. (Defaults to `crossmatch_radius` in settings or '
+                 f'{crossmatch_radius()}")'
+        )
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help='Report matches without creating any aliases.'
+        )
+
+    def ingest(self, filename, content):
+        catalog_file = apply_tns_catalog_file(filename, content)
+        self.stdout.write(f'Ingested {catalog_file.rows} TNS objects')
+
+    def handle(self, *args, **options):
+        start = time.monotonic()
+        if options['download']:
+            self.ingest(TNS_CATALOG_FILE, download_tns_catalog())
+        elif options['catalog']:
+            with open(options['catalog'], 'rb') as catalog_file:
+                self.ingest(os.path.basename(options['catalog']), catalog_file.read())
+
+        matches = crossmatch_targets(radius=options['radius'])
+        self.stdout.write(f'Matched {len(matches)} targets to TNS objects')
+        if options['dry_run']:
+            for target_id, iau_name, separation in matches:
+                self.stdout.write(f'  target {target_id}: {iau_name} ({separation:.2f}")')
+        else:
+            new_aliases = add_tns_aliases(matches)
+            self.stdout.write(f'Added {len(new_aliases)} new aliases')
+        self.stdout.write(self.style.SUCCESS(f'Done in {time.monotonic() - start:.1f}s'))
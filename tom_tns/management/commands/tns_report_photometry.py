@@ -0,0 +1,44 @@
+from django.core.management.base import BaseCommand
+
+from tom_targets.models import Target
+
+from tom_tns.followup import report_followup_photometry
+from tom_tns.models import TNSSubmission
+
+
+class Command(BaseCommand):
+    """
+    Report the photometry collected since the last report of Targets that already have an AT or SN name to the TNS,
+    as bulk reports of many objects at once.
+
+    Example:
+        ./manage.py tns_report_photometry --batch-size 20
+    """
+
+    help = 'Report new follow-up photometry of Targets known to the TNS'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--target-id',
+            type=int,
+            nargs='+',
+            dest='target_ids',
+            help='Only report these Targets (defaults to all sidereal Targets).'
+        )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            help='Number of objects per bulk report (defaults to `batch_size` of `followup_photometry` in the TNS '
+                 'settings, or 50).'
+        )
+
+    def handle(self, *args, **options):
+        targets = Target.objects.filter(type=Target.SIDEREAL)
+        if options['target_ids']:
+            targets = targets.filter(pk__in=options['target_ids'])
+        submissions = report_followup_photometry(targets, batch_size=options['batch_size'])
+        failed = [submission for submission in submissions if submission.status == TNSSubmission.STATUS_FAILED]
+        for submission in failed:
+            self.stderr.write(f'Failed to report {submission.target}: {submission.error}')
+        self.stdout.write(self.style.SUCCESS(f'Reported follow-up photometry of '
+                                             f'{len(submissions) - len(failed)} objects'))
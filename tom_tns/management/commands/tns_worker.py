@@ -0,0 +1,56 @@
+import signal
+
+from django.core.management.base import BaseCommand
+
+from tom_tns.submissions import SubmissionWorker
+
+
+class Command(BaseCommand):
+    """
+    Send queued TNS and Hermes submissions (see `submission_queue` in the TNS settings) with a pool of threads.
+    Several workers can run at once, on one or more hosts. On SIGINT or SIGTERM the worker stops claiming new
+    submissions and exits once the ones it is working on are finished.
+
+    Example:
+        ./manage.py tns_worker --threads 8
+    """
+
+    help = 'Send queued TNS and Hermes submissions'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--threads',
+            type=int,
+            help='Number of submissions to work on at once (defaults to `worker_threads` in the TNS settings, or 4).'
+        )
+        parser.add_argument(
+            '--bot-concurrency',
+            type=int,
+            help='Maximum number of submissions running at once per TNS bot, across all workers '
+                 '(defaults to `worker_bot_concurrency` in the TNS settings, or 2).'
+        )
+        parser.add_argument(
+            '--poll-interval',
+            type=float,
+            help='Seconds to wait between checks of an empty queue (defaults to `worker_poll_interval` in the TNS '
+                 'settings, or 2).'
+        )
+        parser.add_argument(
+            '--once',
+            action='store_true',
+            help='Exit when the queue is empty instead of waiting for new submissions.'
+        )
+
+    def handle(self, *args, **options):
+        worker = SubmissionWorker(threads=options['threads'], bot_concurrency=options['bot_concurrency'],
+                                  poll_interval=options['poll_interval'])
+
+        def stop(signum, frame):
+            self.stdout.write('Stopping after the submissions in progress are finished')
+            worker.stop()
+
+        signal.signal(signal.SIGINT, stop)
+        signal.signal(signal.SIGTERM, stop)
+        self.stdout.write(f'TNS worker {worker.name} started with {worker.threads} threads')
+        processed = worker.run(once=options['once'])
+        self.stdout.write(self.style.SUCCESS(f'TNS worker {worker.name} processed {processed} submissions'))
@@ -0,0 +1,176 @@
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+from tom_tns.tracing import trace_span
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+ATTEMPT_BUCKETS = (1, 2, 3, 4, 5, 7, 10, 15, 20)
+
+# name: (type, help, histogram buckets)
+METRICS = {
+    'tom_tns_request_seconds': ('histogram', 'Latency of requests to the TNS and Hermes per endpoint',
+                                LATENCY_BUCKETS),
+    'tom_tns_responses_total': ('counter', 'Responses from the TNS and Hermes per endpoint and status code', None),
+    'tom_tns_retries_total': ('counter', 'Requests repeated because the TNS had not finished processing', None),
+    'tom_tns_values_cache_total': ('counter', 'Lookups of the cached TNS option values by result', None),
+    'tom_tns_values_refresh_total': ('counter', 'Downloads of the TNS option values by whether they changed', None),
+    'tom_tns_report_reply_attempts': ('histogram', 'Number of polls needed to get a TNS bulk report reply',
+                                      ATTEMPT_BUCKETS),
+}
+
+
+class MetricsSink:
+    """
+    Base class for the destination of tom_tns metrics. Select a sink with `metrics_sink` in your TNS settings, either
+    one of the names in METRIC_SINKS or the dotted path to a subclass.
+    """
+    def increment(self, name, labels, amount=1):
+        pass
+
+    def observe(self, name, labels, value):
+        pass
+
+
+class PrometheusSink(MetricsSink):
+    """
+    Aggregates metrics in memory and renders them in the Prometheus text exposition format at `tns/metrics`.
+    Metrics are kept per process, so scrape every worker process separately.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+
+    def increment(self, name, labels, amount=1):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def observe(self, name, labels, value):
+        key = (name, tuple(sorted(labels.items())))
+        buckets = METRICS[name][2]
+        with self.lock:
+            bucket_counts, total, count = self.histograms.get(key, ([0] * (len(buckets) + 1), 0, 0))
+            bucket_counts[bisect.bisect_left(buckets, value)] += 1
+            self.histograms[key] = (bucket_counts, total + value, count + 1)
+
+    @staticmethod
+    def _labels(labels, **extra):
+        labels = list(labels) + list(extra.items())
+        if not labels:
+            return ''
+        return '{' + ','.join(f'{key}="{value}"' for key, value in labels) + '}'
+
+    def render(self):
+        with self.lock:
+            counters = dict(self.counters)
+            histograms = {key: (list(bucket_counts), total, count)
+                          for key, (bucket_counts, total, count) in self.histograms.items()}
+        lines = []
+        for name, (metric_type, help_text, buckets) in METRICS.items():
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {metric_type}')
+            for (metric_name, labels), value in sorted(counters.items()):
+                if metric_name == name:
+                    lines.append(f'{name}{self._labels(labels)} {value}')
+            for (metric_name, labels), (bucket_counts, total, count) in sorted(histograms.items()):
+                if metric_name != name:
+                    continue
+                cumulative = 0
+                for bound, bucket_count in zip(list(buckets) + ['+Inf'], bucket_counts):
+                    cumulative += bucket_count
+                    lines.append(f'{name}_bucket{self._labels(labels, le=bound)} {cumulative}')
+                lines.append(f'{name}_sum{self._labels(labels)} {total}')
+                lines.append(f'{name}_count{self._labels(labels)} {count}')
+        return '\n'.join(lines) + '\n'
+
+
+class LoggingSink(MetricsSink):
+    """
+    Writes every metric update to the `tom_tns.metrics` logger.
+    """
+    def increment(self, name, labels, amount=1):
+        logger.info(f'{name} {labels} +{amount}')
+
+    def observe(self, name, labels, value):
+        logger.info(f'{name} {labels} {value:.4g}')
+
+
+METRIC_SINKS = {
+    'prometheus': PrometheusSink,
+    'logging': LoggingSink,
+    None: MetricsSink,
+}
+
+_sinks = {}
+_sinks_lock = threading.Lock()
+_local = threading.local()
+
+
+def get_metrics_sink():
+    """ Returns the metrics sink configured with `metrics_sink` in the TNS settings (Defaults to 'prometheus').
+    """
+    sink_name = getattr(settings, 'DATA_SERVICES', {}).get('TNS', {}).get('metrics_sink', 'prometheus')
+    with _sinks_lock:
+        if sink_name not in _sinks:
+            sink_class = METRIC_SINKS.get(sink_name) or import_string(sink_name)
+            _sinks[sink_name] = sink_class()
+        return _sinks[sink_name]
+
+
+def increment(name, amount=1, **labels):
+    get_metrics_sink().increment(name, labels, amount)
+
+
+def observe(name, value, **labels):
+    get_metrics_sink().observe(name, labels, value)
+
+
+@contextmanager
+def collect_requests():
+    """
+    Collect the requests timed by `time_request` in this thread while the block is active.
+    Yields a list that is filled with a dictionary of `endpoint`, `status` and `duration` for each request.
+    """
+    previous = getattr(_local, 'collected_requests', None)
+    _local.collected_requests = collected = []
+    try:
+        yield collected
+    finally:
+        _local.collected_requests = previous
+
+
+@contextmanager
+def time_request(endpoint):
+    """
+    Time a request to a TNS or Hermes endpoint and count its response status.
+    The request is also recorded as a span of the active submission trace, if any.
+    Set the `status` key of the yielded dictionary to the response status code; it is recorded as `error` if the
+    request raised before a response arrived.
+
+        with time_request('bulk-report') as timing:
+            response = requests.post(...)
+            timing['status'] = response.status_code
+    """
+    timing = {'status': 'error'}
+    start = time.perf_counter()
+    with trace_span(endpoint) as span:
+        try:
+            yield timing
+        finally:
+            duration = time.perf_counter() - start
+            span['status'] = timing['status']
+            observe('tom_tns_request_seconds', duration, endpoint=endpoint)
+            increment('tom_tns_responses_total', endpoint=endpoint, status=str(timing['status']))
+            collected = getattr(_local, 'collected_requests', None)
+            if collected is not None:
+                collected.append({'endpoint': endpoint, 'status': timing['status'], 'duration': duration})
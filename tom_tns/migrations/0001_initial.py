@@ -0,0 +1,35 @@
+# Generated by Django 5.2.18 on 2026-10-19 00:41
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TNSObject',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('objid', models.PositiveIntegerField(unique=True)),
+                ('name_prefix', models.CharField(blank=True, default='', max_length=10)),
+                ('name', models.CharField(db_index=True, max_length=20)),
+                ('ra', models.FloatField()),
+                ('dec', models.FloatField()),
+                ('dec_zone', models.SmallIntegerField(db_index=True)),
+                ('redshift', models.FloatField(blank=True, null=True)),
+                ('object_type', models.CharField(blank=True, default='', max_length=50)),
+                ('reporting_group', models.CharField(blank=True, default='', max_length=100)),
+                ('internal_names', models.TextField(blank=True, default='')),
+                ('discovery_date', models.DateTimeField(blank=True, null=True)),
+                ('last_modified', models.DateTimeField(blank=True, null=True)),
+            ],
+            options={
+                'verbose_name': 'TNS object',
+            },
+        ),
+    ]
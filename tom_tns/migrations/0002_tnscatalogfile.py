@@ -0,0 +1,26 @@
+# Generated by Django 5.2.18 on 2026-10-19 00:42
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tom_tns', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TNSCatalogFile',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('filename', models.CharField(max_length=100)),
+                ('snapshot_time', models.DateTimeField(db_index=True)),
+                ('rows', models.PositiveIntegerField(default=0)),
+                ('applied', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'get_latest_by': 'snapshot_time',
+            },
+        ),
+    ]
@@ -0,0 +1,44 @@
+# Generated by Django 5.2.18 on 2026-10-19 01:02
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tom_targets', '0021_rename_target_basetarget_alter_basetarget_options'),
+        ('tom_tns', '0002_tnscatalogfile'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TNSSubmission',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('destination', models.CharField(choices=[('tns', 'TNS'), ('hermes', 'Hermes')], default='tns', max_length=10)),
+                ('bot_id', models.CharField(blank=True, default='', max_length=50)),
+                ('payload', models.JSONField()),
+                ('files', models.JSONField(blank=True, default=dict)),
+                ('status', models.CharField(choices=[('pending', 'Pending'), ('running', 'Running'), ('succeeded', 'Succeeded'), ('failed', 'Failed')], default='pending', max_length=10)),
+                ('attempts', models.PositiveSmallIntegerField(default=0)),
+                ('report_id', models.PositiveIntegerField(blank=True, null=True)),
+                ('iau_name', models.CharField(blank=True, default='', max_length=50)),
+                ('messages', models.JSONField(blank=True, default=list)),
+                ('error', models.TextField(blank=True, default='')),
+                ('worker', models.CharField(blank=True, default='', max_length=100)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('started', models.DateTimeField(blank=True, null=True)),
+                ('finished', models.DateTimeField(blank=True, null=True)),
+                ('target', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='tns_submissions', to='tom_targets.basetarget')),
+                ('user', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name': 'TNS submission',
+                'ordering': ['created'],
+                'indexes': [models.Index(fields=['status', 'created'], name='tom_tns_tns_status_583d12_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 5.2.18 on 2026-10-19 01:04
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tom_targets', '0021_rename_target_basetarget_alter_basetarget_options'),
+        ('tom_tns', '0003_tnssubmission'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TNSAutoReportCandidate',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('triggered', models.DateTimeField()),
+                ('evaluate_after', models.DateTimeField(db_index=True)),
+                ('target', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='tns_auto_report_candidate', to='tom_targets.basetarget')),
+            ],
+            options={
+                'verbose_name': 'TNS auto report candidate',
+            },
+        ),
+    ]
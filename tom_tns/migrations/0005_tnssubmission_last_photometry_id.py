@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-19 01:14
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tom_tns', '0004_tnsautoreportcandidate'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='tnssubmission',
+            name='last_photometry_id',
+            field=models.PositiveBigIntegerField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 5.2.18 on 2026-10-19 01:39
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tom_targets', '0021_rename_target_basetarget_alter_basetarget_options'),
+        ('tom_tns', '0005_tnssubmission_last_photometry_id'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='tnssubmission',
+            name='payload_hash',
+            field=models.CharField(blank=True, db_index=True, default='', max_length=64),
+        ),
+        migrations.AddConstraint(
+            model_name='tnssubmission',
+            constraint=models.UniqueConstraint(condition=models.Q(('status__in', ['pending', 'running']), models.Q(('payload_hash', ''), _negated=True)), fields=('target', 'payload_hash'), name='unique_tns_submission_in_flight'),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.2.18 on 2026-10-19 02:17
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tom_tns', '0006_tnssubmission_payload_hash'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TNSBotLock',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('bot_id', models.CharField(max_length=50, unique=True)),
+            ],
+            options={
+                'verbose_name': 'TNS bot lock',
+            },
+        ),
+    ]
@@ -0,0 +1,26 @@
+# Generated by Django 5.2.18 on 2026-10-19 02:21
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tom_tns', '0007_tnsbotlock'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TNSLock',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=100, unique=True)),
+            ],
+            options={
+                'verbose_name': 'TNS lock',
+            },
+        ),
+        migrations.DeleteModel(
+            name='TNSBotLock',
+        ),
+    ]
@@ -1,3 +1,170 @@
-# from django.db import models
+import math
 
-# Create your models here.
+from django.conf import settings
+from django.db import models
+
+
+# Height (in degrees) of the declination zones used to bucket the local TNS catalogue for crossmatching
+CATALOG_ZONE_HEIGHT = 1.0
+
+
+def dec_zone(dec):
+    """ Returns the declination zone index a declination (in degrees) falls in.
+    """
+    return int(math.floor((dec + 90.0) / CATALOG_ZONE_HEIGHT))
+
+
+class TNSObject(models.Model):
+    """
+    A locally ingested entry of the TNS public objects catalogue:
+    https://www.wis-tns.org/content/tns-getting-started
+
+    ``dec_zone`` is derived from ``dec`` on ingestion and is used as a coarse spatial index so that a crossmatch
+    only has to load the parts of the catalogue near the targets being matched.
+    """
+    objid = models.PositiveIntegerField(unique=True)
+    name_prefix = models.CharField(max_length=10, blank=True, default='')
+    name = models.CharField(max_length=20, db_index=True)
+    ra = models.FloatField()
+    dec = models.FloatField()
+    dec_zone = models.SmallIntegerField(db_index=True)
+    redshift = models.FloatField(null=True, blank=True)
+    object_type = models.CharField(max_length=50, blank=True, default='')
+    reporting_group = models.CharField(max_length=100, blank=True, default='')
+    internal_names = models.TextField(blank=True, default='')
+    discovery_date = models.DateTimeField(null=True, blank=True)
+    last_modified = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        verbose_name = 'TNS object'
+
+    def __str__(self):
+        return self.iau_name
+
+    @property
+    def iau_name(self):
+        """ The full IAU designation of the object, e.g. AT 2024abc -> AT2024abc
+        """
+        return f'{self.name_prefix}{self.name}'
+
+
+class TNSCatalogFile(models.Model):
+    """
+    Record of a TNS public objects file (the full catalogue or a daily/hourly delta) that has been applied to the
+    local catalogue. ``snapshot_time`` is the time up to which the file contains changes, so the most recent record
+    tells incremental syncs where to resume.
+    """
+    filename = models.CharField(max_length=100)
+    snapshot_time = models.DateTimeField(db_index=True)
+    rows = models.PositiveIntegerField(default=0)
+    applied = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        get_latest_by = 'snapshot_time'
+
+    def __str__(self):
+        return f'{self.filename} ({self.snapshot_time})'
+
+
+class TNSSubmission(models.Model):
+    """
+    A TNS report or classification, to be sent to the TNS directly or through Hermes by the `tns_worker` command.
+
+    ``payload`` is the TNS bulk report or Hermes message, and ``files`` maps the spectrum files to submit with it
+    (``ascii_file``, ``fits_file``) to their copies in the default storage. ``report_id`` is set as soon as a bulk
+    report has been accepted by the TNS, so that an interrupted submission only polls for the reply when retried.
+    Follow-up photometry reports set ``last_photometry_id`` to the newest PhotometryReducedDatum they include, so that
+    the next report starts after it.
+
+    Submissions made from the TNS page also serve as a ledger of what was reported: ``payload_hash`` identifies the
+    form data they were built from, so that a repeated submission returns the earlier result instead of reporting
+    again (see `tom_tns.ledger`). At most one submission per Target and hash can be in flight at a time.
+    """
+    STATUS_PENDING = 'pending'
+    STATUS_RUNNING = 'running'
+    STATUS_SUCCEEDED = 'succeeded'
+    STATUS_FAILED = 'failed'
+    STATUS_CHOICES = [
+        (STATUS_PENDING, 'Pending'),
+        (STATUS_RUNNING, 'Running'),
+        (STATUS_SUCCEEDED, 'Succeeded'),
+        (STATUS_FAILED, 'Failed'),
+    ]
+    DESTINATION_TNS = 'tns'
+    DESTINATION_HERMES = 'hermes'
+    DESTINATION_CHOICES = [
+        (DESTINATION_TNS, 'TNS'),
+        (DESTINATION_HERMES, 'Hermes'),
+    ]
+
+    target = models.ForeignKey('tom_targets.BaseTarget', on_delete=models.CASCADE, related_name='tns_submissions')
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.SET_NULL, null=True, blank=True)
+    destination = models.CharField(max_length=10, choices=DESTINATION_CHOICES, default=DESTINATION_TNS)
+    bot_id = models.CharField(max_length=50, blank=True, default='')
+    payload = models.JSONField()
+    payload_hash = models.CharField(max_length=64, blank=True, default='', db_index=True)
+    files = models.JSONField(default=dict, blank=True)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=STATUS_PENDING)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    report_id = models.PositiveIntegerField(null=True, blank=True)
+    iau_name = models.CharField(max_length=50, blank=True, default='')
+    last_photometry_id = models.PositiveBigIntegerField(null=True, blank=True)
+    messages = models.JSONField(default=list, blank=True)
+    error = models.TextField(blank=True, default='')
+    worker = models.CharField(max_length=100, blank=True, default='')
+    created = models.DateTimeField(auto_now_add=True)
+    started = models.DateTimeField(null=True, blank=True)
+    finished = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        verbose_name = 'TNS submission'
+        ordering = ['created']
+        indexes = [models.Index(fields=['status', 'created'])]
+        constraints = [
+            models.UniqueConstraint(fields=['target', 'payload_hash'], name='unique_tns_submission_in_flight',
+                                    condition=models.Q(status__in=['pending', 'running']) & ~models.Q(payload_hash=''))
+        ]
+
+    def __str__(self):
+        return f'{self.get_destination_display()} submission {self.pk} for {self.target} ({self.status})'
+
+
+class TNSLock(models.Model):
+    """
+    A named row that processes lock to take turns: `tns_worker` processes lock one per bot (``bot:<bot_id>``) while they
+    count and claim that bot's submissions, so that together they cannot exceed the per-bot concurrency cap, and
+    submissions from the TNS page are checked for duplicates and recorded under the ``ledger`` lock.
+    """
+    name = models.CharField(max_length=100, unique=True)
+
+    class Meta:
+        verbose_name = 'TNS lock'
+
+    def __str__(self):
+        return self.name
+
+    @classmethod
+    def acquire(cls, names):
+        """ Lock the rows of `names`, creating them as needed, until the end of the current transaction
+        """
+        names = sorted(set(names))
+        cls.objects.bulk_create([cls(name=name) for name in names], ignore_conflicts=True)
+        list(cls.objects.select_for_update().filter(name__in=names).order_by('name'))
+
+
+class TNSAutoReportCandidate(models.Model):
+    """
+    A Target with new photometry, waiting to be evaluated for automatic TNS reporting once ``evaluate_after`` has
+    passed. Further triggers for the Target before then are ignored, so that a burst of ingested photometry is
+    evaluated once.
+    """
+    target = models.OneToOneField('tom_targets.BaseTarget', on_delete=models.CASCADE,
+                                  related_name='tns_auto_report_candidate')
+    triggered = models.DateTimeField()
+    evaluate_after = models.DateTimeField(db_index=True)
+
+    class Meta:
+        verbose_name = 'TNS auto report candidate'
+
+    def __str__(self):
+        return f'{self.target} (evaluate after {self.evaluate_after})'
@@ -0,0 +1,145 @@
+import cProfile
+import os
+import tempfile
+import threading
+import time
+import uuid
+from contextlib import ExitStack, contextmanager
+
+from django.conf import settings
+from django.contrib import messages
+from django.core.cache import caches
+from django.db import connections
+
+from tom_tns.metrics import collect_requests
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+# Only one profiler can be active at a time from Python 3.12, so only one request is profiled at a time
+_profiler_lock = threading.Lock()
+CACHE_METHODS = ['get', 'set', 'add', 'delete', 'get_many', 'set_many', 'delete_many', 'get_or_set', 'has_key',
+                 'incr', 'decr', 'touch', 'clear']
+
+
+def profile_settings():
+    return getattr(settings, 'DATA_SERVICES', {}).get('TNS', {})
+
+
+def should_profile(request):
+    """
+    Profile a request if `profile_views` is set in the TNS settings, or if a staff user adds `?tns_profile=1`.
+    """
+    if profile_settings().get('profile_views', False):
+        return True
+    return bool(request.GET.get('tns_profile')) and request.user.is_staff
+
+
+@contextmanager
+def count_queries():
+    """ Count the database queries made in this thread, and the time spent on them, on every connection
+    """
+    stats = {'count': 0, 'time': 0.0}
+
+    def wrapper(execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            stats['count'] += 1
+            stats['time'] += time.perf_counter() - start
+
+    with ExitStack() as stack:
+        for connection in connections.all():
+            stack.enter_context(connection.execute_wrapper(wrapper))
+        yield stats
+
+
+@contextmanager
+def count_cache_calls():
+    """ Count the calls made to the default cache in this thread, and the time spent on them
+    """
+    stats = {'count': 0, 'time': 0.0}
+    # Cache handles are per thread, so wrapping this instance's methods only affects the current request
+    cache = caches['default']
+
+    def counted(method):
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                stats['count'] += 1
+                stats['time'] += time.perf_counter() - start
+        return wrapper
+
+    wrapped = [name for name in CACHE_METHODS if hasattr(cache, name) and name not in vars(cache)]
+    for name in wrapped:
+        setattr(cache, name, counted(getattr(cache, name)))
+    try:
+        yield stats
+    finally:
+        for name in wrapped:
+            delattr(cache, name)
+
+
+class ProfiledViewMixin:
+    """
+    Opt-in profiling of a view. When `should_profile` is true, the request (including template rendering) is run
+    under cProfile while counting database queries, cache calls and requests to the TNS/Hermes. The profile is saved
+    to `profile_dir` from the TNS settings (Defaults to a `tom_tns_profiles` directory in the system temp directory)
+    and a short summary is logged, and added to the messages and the `X-TNS-Profile` response header of staff users.
+    Only one request is profiled at a time; requests made meanwhile, or while another profiler is active, are served
+    without profiling.
+    """
+    def dispatch(self, request, *args, **kwargs):
+        if not should_profile(request) or not _profiler_lock.acquire(blocking=False):
+            return super().dispatch(request, *args, **kwargs)
+        try:
+            return self.profiled_dispatch(request, *args, **kwargs)
+        finally:
+            _profiler_lock.release()
+
+    def profiled_dispatch(self, request, *args, **kwargs):
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError as e:
+            # Another profiling tool is active
+            logger.warning(f'Not profiling {self.__class__.__name__}: {e}')
+            return super().dispatch(request, *args, **kwargs)
+        start = time.perf_counter()
+        try:
+            with count_queries() as queries, count_cache_calls() as cache_calls, collect_requests() as http_requests:
+                response = super().dispatch(request, *args, **kwargs)
+                if hasattr(response, 'render') and not response.is_rendered:
+                    response.render()
+        finally:
+            profiler.disable()
+        duration = time.perf_counter() - start
+
+        profile_path = self.save_profile(profiler)
+        http_time = sum(http_request['duration'] for http_request in http_requests)
+        summary = (f'{self.__class__.__name__} took {duration:.2f}s: '
+                   f'{queries["count"]} DB queries ({queries["time"]:.2f}s), '
+                   f'{cache_calls["count"]} cache calls ({cache_calls["time"]:.2f}s), '
+                   f'{len(http_requests)} TNS/Hermes requests ({http_time:.2f}s).')
+        logger.info(f'{summary} Profile: {profile_path}')
+        if request.user.is_staff:
+            response['X-TNS-Profile'] = summary
+            messages.info(request, f'{summary} Profile saved to {profile_path}')
+        return response
+
+    def save_profile(self, profiler):
+        profile_dir = profile_settings().get('profile_dir',
+                                             os.path.join(tempfile.gettempdir(), 'tom_tns_profiles'))
+        try:
+            os.makedirs(profile_dir, exist_ok=True)
+            profile_path = os.path.join(
+                profile_dir, f'{self.__class__.__name__}_{time.strftime("%Y%m%dT%H%M%S")}_{uuid.uuid4().hex[:8]}.prof')
+            profiler.dump_stats(profile_path)
+        except OSError as e:
+            logger.warning(f'Failed to save TNS view profile: {repr(e)}')
+            return None
+        return profile_path
@@ -0,0 +1,69 @@
+from collections import Counter
+
+from django.db import transaction
+from django.utils import timezone
+
+from tom_common.hooks import run_hook
+from tom_targets.models import Target, TargetName
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+def rename_targets(iau_names, run_hooks=True):
+    """
+    Rename Targets to their IAU names in a single transaction, keeping each old name as an alias.
+
+    The Targets are locked for the duration of the transaction and all renames and new aliases are written with one
+    `bulk_update` and one `bulk_create`. Targets that already carry their IAU name are left alone, so the rename can
+    safely be repeated. An existing alias equal to the new name is removed since it would duplicate the name.
+    Targets whose IAU name is already the name of a different Target, or is given to several Targets of the batch, are
+    skipped with a warning, so one collision never aborts the whole batch.
+
+    :param iau_names: Dictionary of Target (or Target id) to the IAU name to give it
+    :param run_hooks: Whether to run the `target_post_save` hook for each renamed Target. `Target.save()` itself is
+        never called.
+    :returns: List of the renamed Targets
+    """
+    iau_names = {getattr(target, 'pk', target): iau_name for target, iau_name in iau_names.items()}
+    with transaction.atomic():
+        targets = list(Target.objects.select_for_update().filter(pk__in=iau_names.keys()))
+        to_rename = [target for target in targets if target.name != iau_names[target.pk]]
+        if not to_rename:
+            return []
+        taken_names = dict(Target.objects.filter(name__in=[iau_names[target.pk] for target in to_rename])
+                           .values_list('name', 'pk'))
+        batch_names = Counter(iau_names[target.pk] for target in to_rename)
+        existing_aliases = set(TargetName.objects.filter(target__in=to_rename).values_list('target_id', 'name'))
+
+        now = timezone.now()
+        renamed = []
+        new_aliases = []
+        duplicate_aliases = []
+        for target in to_rename:
+            iau_name = iau_names[target.pk]
+            if taken_names.get(iau_name, target.pk) != target.pk:
+                logger.warning(f'Cannot rename {target.name} to {iau_name}: the name is used by another Target')
+                continue
+            if batch_names[iau_name] > 1:
+                logger.warning(f'Cannot rename {target.name} to {iau_name}: the name is given to '
+                               f'{batch_names[iau_name]} Targets')
+                continue
+            if (target.pk, iau_name) in existing_aliases:
+                duplicate_aliases.append((target.pk, iau_name))
+            if (target.pk, target.name) not in existing_aliases:
+                new_aliases.append(TargetName(target=target, name=target.name))
+            logger.info(f'Renaming {target.name} to {iau_name}')
+            target.name = iau_name
+            target.modified = now
+            renamed.append(target)
+
+        for target_id, name in duplicate_aliases:
+            TargetName.objects.filter(target_id=target_id, name=name).delete()
+        Target.objects.bulk_update(renamed, ['name', 'modified'])
+        TargetName.objects.bulk_create(new_aliases)
+
+    if run_hooks:
+        for target in renamed:
+            run_hook('target_post_save', target=target, created=False)
+    return renamed
@@ -0,0 +1,153 @@
+"""
+A shared cache of TNS bulk report replies, so that any number of pages watching a report (see
+`views.TNSReplyStatusView`) cause at most one request to the TNS per `reply_poll_interval` seconds between them.
+The first watcher to find the report processed renames its Target and finishes its TNSSubmission.
+"""
+import time
+
+import requests.exceptions
+from django.conf import settings
+from django.core.cache import cache
+from django.utils import timezone
+
+from tom_tns.deadline import Deadline
+from tom_tns.models import TNSSubmission
+from tom_tns.renaming import rename_targets
+from tom_tns.submissions import SubmissionMessages
+from tom_tns.tns_api import (BadTnsRequest, get_tns_credentials, lookup_timeout, request_tns_report_reply,
+                             use_tns_bot)
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+REPLY_PROCESSING = 'processing'
+REPLY_SUCCEEDED = 'succeeded'
+REPLY_FAILED = 'failed'
+REPLY_CACHE_TIMEOUT = 60 * 60 * 24
+# Submissions whose reply is watched from the TNS page, rather than waited for by a worker
+REPLY_WATCHER = 'tns/status'
+
+
+def reply_settings():
+    tns_settings = getattr(settings, 'DATA_SERVICES', {}).get('TNS', {})
+    return {
+        'live_replies': tns_settings.get('live_replies', False),
+        'reply_poll_interval': tns_settings.get('reply_poll_interval', 2),
+        'reply_max_wait': tns_settings.get('reply_max_wait', 25),
+        'reply_stream_max_wait': tns_settings.get('reply_stream_max_wait', 5),
+    }
+
+
+def reply_cache_key(report_id):
+    return f'tns_report_reply_{report_id}'
+
+
+def reply_is_final(reply):
+    return reply['status'] != REPLY_PROCESSING
+
+
+def watch_report_reply(submission):
+    """
+    Hand the wait for the reply to a sent TNSSubmission to the pages watching its report. The submission is marked as
+    running, so that a `tns_worker` only picks it up (after `worker_stale_seconds`) if nobody watches it.
+    """
+    submission.status = TNSSubmission.STATUS_RUNNING
+    submission.worker = REPLY_WATCHER
+    submission.started = timezone.now()
+    submission.attempts += 1
+    submission.save(update_fields=['status', 'worker', 'started', 'attempts'])
+    cache.set(reply_cache_key(submission.report_id), processing_reply(submission.report_id), REPLY_CACHE_TIMEOUT)
+
+
+def processing_reply(report_id):
+    return {'report_id': report_id, 'status': REPLY_PROCESSING, 'iau_name': '', 'error': '', 'messages': []}
+
+
+def submission_reply(submission):
+    """ The reply of a TNSSubmission that was finished by a worker, or None if it isn't finished
+    """
+    if submission.status == TNSSubmission.STATUS_SUCCEEDED:
+        status = REPLY_SUCCEEDED
+    elif submission.status == TNSSubmission.STATUS_FAILED:
+        status = REPLY_FAILED
+    else:
+        return None
+    return {'report_id': submission.report_id, 'status': status, 'iau_name': submission.iau_name,
+            'error': submission.error, 'messages': submission.messages}
+
+
+def get_report_reply(report_id):
+    """
+    Returns the reply to a TNS bulk report as a dictionary of its `status` (processing, succeeded or failed),
+    `iau_name`, `error` and `messages`. Replies come from the shared cache; the TNS is only asked again if the report
+    is still processing, nobody else asked in the last `reply_poll_interval` seconds, and no `tns_worker` is
+    waiting for it. Reports that weren't submitted from this TOM (i.e. have no TNSSubmission) are never polled.
+    """
+    key = reply_cache_key(report_id)
+    reply = cache.get(key)
+    if reply is not None and reply_is_final(reply):
+        return reply
+    # The lock expires by itself after the poll interval, which throttles the requests to the TNS
+    if not cache.add(f'{key}_lock', True, timeout=reply_settings()['reply_poll_interval']):
+        return reply or processing_reply(report_id)
+
+    submission = TNSSubmission.objects.filter(report_id=report_id).order_by('-created').first()
+    if submission is None:
+        return processing_reply(report_id) | {'status': REPLY_FAILED, 'error': 'Unknown TNS report'}
+    reply = submission_reply(submission)
+    if reply is None:
+        if submission.worker != REPLY_WATCHER:
+            # A `tns_worker` is waiting for this reply already
+            reply = processing_reply(report_id)
+        else:
+            reply = poll_report_reply(report_id, submission)
+    cache.set(key, reply, REPLY_CACHE_TIMEOUT)
+    return reply
+
+
+def poll_report_reply(report_id, submission):
+    """
+    Ask the TNS for the reply to a report once, waiting at most `lookup_timeout` seconds. Once it is processed, the
+    Target of its `submission` is renamed and the submission finished. Returns the reply dictionary.
+    """
+    reply = processing_reply(report_id)
+    if not get_tns_credentials():
+        return reply | {'status': REPLY_FAILED, 'error': 'The TNS is not configured'}
+    recorder = SubmissionMessages()
+    try:
+        with use_tns_bot(submission.bot_id):
+            iau_name = request_tns_report_reply(report_id, recorder, Deadline(lookup_timeout()))
+        if not iau_name:
+            return reply
+        reply.update(status=REPLY_SUCCEEDED, iau_name=iau_name)
+    except requests.exceptions.RequestException as e:
+        # Including timeouts: try again with the next poll
+        logger.warning(f'Failed to get the reply to TNS report {report_id}: {repr(e)}')
+        return reply
+    except BadTnsRequest as e:
+        reply.update(status=REPLY_FAILED, error=str(e))
+    reply['messages'] = recorder.messages
+    if iau_name := reply['iau_name']:
+        rename_targets({submission.target_id: iau_name})
+    submission.status = (TNSSubmission.STATUS_SUCCEEDED if reply['status'] == REPLY_SUCCEEDED
+                         else TNSSubmission.STATUS_FAILED)
+    submission.iau_name = reply['iau_name']
+    submission.error = reply['error']
+    submission.messages = submission.messages + recorder.messages
+    submission.finished = timezone.now()
+    submission.save(update_fields=['status', 'iau_name', 'error', 'messages', 'finished'])
+    return reply
+
+
+def wait_for_report_reply(report_id, wait, interval=0.5):
+    """
+    Long-poll the reply to a report: returns as soon as it is final, or after `wait` seconds (at most
+    `reply_max_wait`) with the last reply seen.
+    """
+    give_up = time.monotonic() + min(wait, reply_settings()['reply_max_wait'])
+    reply = get_report_reply(report_id)
+    while not reply_is_final(reply) and time.monotonic() + interval < give_up:
+        time.sleep(interval)
+        reply = get_report_reply(report_id)
+    return reply
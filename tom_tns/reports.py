@@ -0,0 +1,363 @@
+"""
+Lightweight report classes for building TNS bulk reports and Hermes messages without Django forms, e.g. for
+scripted reporting from a pipeline:
+
+    report = ATReport(ra=123.4, dec=-45.6, reporting_groupid='1', data_source_groupid='1', reporter='A. Person',
+                      discovery_datetime=datetime(2024, 1, 2), at_type='1',
+                      nondetection=NonDetection(archiveid='0', archival_remarks='Not in archive images'),
+                      photometry=[PhotometryGroup(obsdate=datetime(2024, 1, 2), flux=18.5, flux_error=0.05,
+                                                  flux_unitid='1', filterid='22', instrumentid='0')])
+    send_tns_report(dumps_tns_report([report]))
+
+This module does not depend on Django, so that reports can be built cheaply in bulk.
+"""
+import json
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import Optional
+
+
+TNS_DATETIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+_encoder = json.JSONEncoder()
+
+
+def option_labels(tns_values):
+    """
+    Map each list of TNS option values to a dictionary of {ID: label}, as needed by the `to_hermes` methods.
+    IDs of options given as a list (e.g. `at_types`) are integers, others are strings.
+    """
+    labels = {}
+    for option_list, values in tns_values.items():
+        if isinstance(values, list):
+            labels[option_list] = dict(enumerate(values))
+        elif isinstance(values, dict):
+            labels[option_list] = values
+    return labels
+
+
+@dataclass(slots=True)
+class PhotometryGroup:
+    """ One photometry measurement of an AT report. Units, filters and instruments are TNS option IDs
+    """
+    obsdate: datetime
+    flux: Optional[float]
+    flux_error: Optional[float]
+    flux_unitid: str
+    filterid: str
+    instrumentid: str
+    limiting_flux: Optional[float] = None
+    exptime: Optional[float] = None
+    observer: str = ''
+    comments: str = ''
+    telescope: str = ''  # Only sent to Hermes
+
+    def to_tns(self):
+        return {
+            "obsdate": self.obsdate.strftime(TNS_DATETIME_FORMAT),
+            "flux": self.flux,
+            "flux_error": self.flux_error,
+            "flux_unitid": self.flux_unitid,
+            "filterid": self.filterid,
+            "instrumentid": self.instrumentid,
+            "limiting_flux": self.limiting_flux,
+            "exptime": self.exptime,
+            "observer": self.observer,
+            "comments": self.comments,
+        }
+
+    def to_hermes(self, target_name, labels):
+        photometry = {
+            'target_name': target_name,
+            'date_obs': self.obsdate.isoformat(),
+            'instrument': labels['instruments'][self.instrumentid],
+            'bandpass': labels['filters'][self.filterid],
+            "brightness": self.flux,
+            "brightness_error": self.flux_error,
+            "brightness_unit": self.flux_unitid,
+        }
+        if self.comments:
+            photometry['comments'] = self.comments
+        if self.exptime:
+            photometry['exposure_time'] = self.exptime
+        if self.observer:
+            photometry['observer'] = self.observer
+        if self.limiting_flux:
+            photometry['limiting_brightness'] = self.limiting_flux
+        if self.telescope:
+            photometry['telescope'] = self.telescope
+        return photometry
+
+
+@dataclass(slots=True)
+class NonDetection:
+    """
+    The last non-detection of an AT report: either an archive search (`archiveid` and `archival_remarks`), or a
+    non-detection limit (`obsdate`, `limiting_flux`, `flux_unitid`, `filterid` and `instrumentid`)
+    """
+    archiveid: str = ''
+    archival_remarks: str = ''
+    comments: str = ''
+    obsdate: Optional[datetime] = None
+    limiting_flux: Optional[float] = None
+    flux_unitid: str = ''
+    filterid: str = ''
+    instrumentid: str = ''
+    exptime: Optional[float] = None
+    observer: str = ''
+
+    def to_tns(self):
+        nondetection = {
+            "archiveid": self.archiveid,
+            "archival_remarks": self.archival_remarks,
+            "comments": self.comments,
+        }
+        if self.obsdate:
+            nondetection.update({
+                "obsdate": self.obsdate.strftime(TNS_DATETIME_FORMAT),
+                "limiting_flux": self.limiting_flux,
+                "flux_unitid": self.flux_unitid,
+                "filterid": self.filterid,
+                "instrumentid": self.instrumentid,
+                "exptime": self.exptime,
+                "observer": self.observer,
+            })
+        return nondetection
+
+    def has_limit(self):
+        return all([self.limiting_flux, self.instrumentid, self.filterid, self.obsdate])
+
+
+@dataclass(slots=True)
+class ATReport:
+    """ A TNS discovery (AT) report. Groups and the AT type are TNS option IDs
+    """
+    ra: float
+    dec: float
+    reporting_groupid: str
+    data_source_groupid: str
+    reporter: str
+    discovery_datetime: datetime
+    at_type: str
+    nondetection: NonDetection
+    photometry: list = field(default_factory=list)
+    internal_name: str = ''
+    internal_name_format: Optional[str] = None
+    remarks: str = ''
+    name: str = ''  # The Target name, only sent to Hermes
+    submitter: str = ''  # Only sent to Hermes
+    new_discovery: bool = True  # False for follow-up photometry of a known transient, only sent to Hermes
+
+    def to_tns(self):
+        """ Returns the report as an entry of the `at_report` section of a TNS bulk report
+        """
+        report = {
+            "ra": {
+                "value": self.ra,
+            },
+            "dec": {
+                "value": self.dec,
+            },
+            "reporting_groupid": self.reporting_groupid,
+            "data_source_groupid": self.data_source_groupid,
+            "reporter": self.reporter,
+            "discovery_datetime": self.discovery_datetime.strftime(TNS_DATETIME_FORMAT),
+            "at_type": self.at_type,
+            "internal_name_format": self.internal_name_format,
+            "remarks": self.remarks,
+            "non_detection": self.nondetection.to_tns(),
+            "photometry": {
+                "photometry_group": {str(i): group.to_tns() for i, group in enumerate(self.photometry)}
+            },
+        }
+        if self.internal_name:
+            report['internal_name'] = self.internal_name
+        return report
+
+    def to_hermes(self, labels):
+        """
+        Returns the report as a Hermes message. `labels` maps TNS option lists to dictionaries of {ID: label},
+        see `option_labels`.
+        """
+        discovery_info = {
+            'date': self.discovery_datetime.isoformat(),
+            'discovery_source': labels['groups'][self.data_source_groupid],
+            'reporting_group': labels['groups'][self.reporting_groupid],
+            'transient_type': labels['at_types'][int(self.at_type)],
+        }
+        target = {
+            'name': self.name,
+            'ra': self.ra,
+            'dec': self.dec,
+            'new_discovery': self.new_discovery,
+            'discovery_info': discovery_info,
+        }
+        if self.remarks:
+            target['comments'] = self.remarks
+        photometry = [group.to_hermes(self.name, labels) for group in self.photometry]
+
+        nondetection = self.nondetection
+        if nondetection.archiveid and nondetection.archival_remarks:
+            discovery_info['nondetection_source'] = labels['archives'][nondetection.archiveid]
+            discovery_info['nondetection_comments'] = nondetection.archival_remarks
+        elif nondetection.has_limit():
+            limit = {
+                'limiting_brightness': nondetection.limiting_flux,
+                'limiting_brightness_unit': nondetection.flux_unitid,
+                'date_obs': nondetection.obsdate,
+                'bandpass': nondetection.filterid,
+                'instrument': nondetection.instrumentid,
+            }
+            if nondetection.exptime:
+                limit['exposure_time'] = nondetection.exptime
+            if nondetection.observer:
+                limit['observer'] = nondetection.observer
+            if nondetection.comments:
+                limit['comments'] = nondetection.comments
+            photometry.append(limit)
+
+        return {
+            'topic': 'hermes.test',
+            'title': f'{self.name} TNS {"discovery" if self.new_discovery else "follow-up photometry"} report',
+            'submit_to_tns': True,
+            'submitter': self.submitter,
+            'authors': self.reporter,
+            'data': {
+                'targets': [target],
+                'photometry': photometry,
+            },
+        }
+
+
+@dataclass(slots=True)
+class Spectrum:
+    """
+    A classification spectrum. `ascii_file` and `fits_file` are the names of the files: as pre-uploaded to the TNS
+    for TNS reports, or as attached to the message for Hermes.
+    """
+    obsdate: datetime
+    instrumentid: str
+    spectypeid: str
+    observer: str
+    ascii_file: str = ''
+    fits_file: str = ''
+    exptime: Optional[float] = None
+    reducer: str = ''
+    remarks: str = ''
+    telescope: str = ''  # Only sent to Hermes
+    ascii_file_description: str = ''  # Only sent to Hermes
+    fits_file_description: str = ''  # Only sent to Hermes
+
+    def to_tns(self):
+        return {
+            "obsdate": self.obsdate.strftime(TNS_DATETIME_FORMAT),
+            "instrumentid": self.instrumentid,
+            "exptime": self.exptime,
+            "observer": self.observer,
+            "reducer": self.reducer,
+            "spectypeid": self.spectypeid,
+            "ascii_file": self.ascii_file,
+            "fits_file": self.fits_file,
+            "remarks": self.remarks,
+        }
+
+
+@dataclass(slots=True)
+class Classification:
+    """ A TNS classification report. The object type and group are TNS option IDs
+    """
+    name: str
+    classifier: str
+    objtypeid: str
+    groupid: str
+    spectra: list = field(default_factory=list)
+    redshift: Optional[float] = None
+    remarks: str = ''
+    ra: Optional[float] = None  # Only sent to Hermes
+    dec: Optional[float] = None  # Only sent to Hermes
+    submitter: str = ''  # Only sent to Hermes
+
+    def to_tns(self):
+        """ Returns the report as an entry of the `classification_report` section of a TNS bulk report
+        """
+        return {
+            "name": self.name,
+            "classifier": self.classifier,
+            "objtypeid": self.objtypeid,
+            "redshift": self.redshift,
+            "groupid": self.groupid,
+            "remarks": self.remarks,
+            "spectra": {
+                "spectra-group": {str(i): spectrum.to_tns() for i, spectrum in enumerate(self.spectra)}
+            },
+        }
+
+    def to_hermes(self, labels):
+        """
+        Returns the report as a Hermes message. `labels` maps TNS option lists to dictionaries of {ID: label},
+        see `option_labels`.
+        """
+        target = {
+            'name': self.name,
+            'ra': self.ra,
+            'dec': self.dec,
+            'new_discovery': False,
+            'discovery_info': {
+                'reporting_group': labels['groups'][self.groupid]
+            }
+        }
+        if self.redshift:
+            target['redshift'] = self.redshift
+        if self.remarks:
+            target['comments'] = self.remarks
+        spectroscopy = []
+        for spectrum in self.spectra:
+            hermes_spectrum = {
+                'target_name': self.name,
+                'date_obs': spectrum.obsdate.isoformat(),
+                'instrument': labels['instruments'][spectrum.instrumentid],
+                'spec_type': labels['spectra_types'][spectrum.spectypeid],
+                'classification': labels['objtypes'][self.objtypeid],
+                'observer': spectrum.observer,
+                'file_info': [{'name': spectrum.ascii_file, 'description': spectrum.ascii_file_description}],
+            }
+            if spectrum.telescope:
+                hermes_spectrum['telescope'] = spectrum.telescope
+            if spectrum.reducer:
+                hermes_spectrum['reducer'] = spectrum.reducer
+            if spectrum.exptime:
+                hermes_spectrum['exposure_time'] = spectrum.exptime
+            if spectrum.fits_file:
+                hermes_spectrum['file_info'].append({'name': spectrum.fits_file,
+                                                     'description': spectrum.fits_file_description})
+            if spectrum.remarks:
+                hermes_spectrum['comments'] = spectrum.remarks
+            spectroscopy.append(hermes_spectrum)
+        return {
+            'topic': 'hermes.test',
+            'title': f'{self.name} TNS classification report',
+            'submit_to_tns': True,
+            'submitter': self.submitter,
+            'authors': self.classifier,
+            'data': {
+                'targets': [target],
+                'spectroscopy': spectroscopy,
+            },
+        }
+
+
+def tns_bulk_report(reports):
+    """ Combine AT reports and classifications into one TNS bulk report
+    """
+    bulk_report = {}
+    for report in reports:
+        section = 'at_report' if isinstance(report, ATReport) else 'classification_report'
+        entries = bulk_report.setdefault(section, {})
+        entries[str(len(entries))] = report.to_tns()
+    return bulk_report
+
+
+def dumps_tns_report(reports):
+    """ Serialize AT reports and classifications as one JSON TNS bulk report, ready for `send_tns_report`
+    """
+    return _encoder.encode(tns_bulk_report(reports))
@@ -0,0 +1,504 @@
+import functools
+import hashlib
+import json
+import os
+import re
+import tempfile
+import warnings
+
+import numpy as np
+from astropy import units
+from astropy.io import fits
+from astropy.wcs import WCS, FITSFixedWarning
+from django.core.cache import cache
+from django.core.files.base import ContentFile, File
+
+from tom_dataproducts.models import DataProduct, SpectroscopyReducedDatum
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+# Choices of the classify form's `ascii_file` field that generate the file from a SpectroscopyReducedDatum, or convert
+# it from a FITS DataProduct
+DATUM_CHOICE_PREFIX = 'datum-'
+FITS_CHOICE_PREFIX = 'fits-'
+GENERATED_CHOICE_PREFIXES = (DATUM_CHOICE_PREFIX, FITS_CHOICE_PREFIX)
+ASCII_EXTENSIONS = ['.ascii', '.txt']
+FITS_EXTENSIONS = ['.fits', '.fits.fz']
+SPECTRUM_CACHE_TIMEOUT = 60 * 60 * 24
+# Larger converted files are not cached (e.g. memcached stores values of up to 1 MB)
+SPECTRUM_CACHE_MAX_SIZE = 1024 * 1024
+WAVELENGTH_FORMAT = '%.4f'
+FLUX_FORMAT = '%.6e'
+# Number of spectrum points converted from FITS at a time
+FITS_CHUNK_SIZE = 65536
+# Table columns of FITS spectra, by preference. `loglam` is log10 of the wavelength and `ivar` the inverse variance
+WAVELENGTH_COLUMNS = ['wavelength', 'wave', 'lambda', 'loglam']
+FLUX_COLUMNS = ['flux', 'fluxes', 'spec', 'spectrum']
+ERROR_COLUMNS = ['error', 'err', 'flux_error', 'sigma', 'ivar']
+# Image extensions that hold something other than the spectrum itself
+SKIPPED_EXTENSIONS = re.compile(r'err|sig|var|ivar|mask|dq|qual|sky|bkg|back|wave|arc', re.IGNORECASE)
+# Spectrum files are checked this many bytes at a time, and checks stop after this many errors
+VALIDATION_CHUNK_SIZE = 1024 * 1024
+MAX_SPECTRUM_ERRORS = 10
+MAX_LINE_LENGTH = 1024
+# The first axis of images with a celestial WCS is not a spectral axis, and spectrum images have few rows
+CELESTIAL_CTYPES = re.compile(r'^(RA|DEC|GLON|GLAT|ELON|ELAT)-', re.IGNORECASE)
+MAX_SPECTRUM_IMAGE_ROWS = 16
+
+
+def spectrum_ascii(wavelength, flux, error=None):
+    """
+    Format a spectrum as TNS ASCII file content: one row of `wavelength flux [error]` per point, sorted by wavelength.
+    Of points with the same wavelength, only the first is kept. Returns bytes.
+    """
+    columns = [np.asarray(wavelength, dtype=float), np.asarray(flux, dtype=float)]
+    if error is not None and len(error) == len(columns[0]):
+        columns.append(np.asarray(error, dtype=float))
+    if len(columns[0]) != len(columns[1]):
+        raise ValueError(f'The spectrum has {len(columns[0])} wavelengths but {len(columns[1])} fluxes')
+    data = np.column_stack(columns)
+    return format_spectrum_rows(increasing_rows(data[np.argsort(data[:, 0], kind='stable')], -np.inf))
+
+
+def format_spectrum_rows(data):
+    """
+    Format an array of (wavelength, flux[, error]) rows as lines of a TNS ASCII file. Rows with non-finite values
+    (e.g. masked pixels) are dropped. Returns bytes.
+    """
+    data = data[np.isfinite(data).all(axis=1)]
+    # Formatting every row with one format string is much faster than np.savetxt's row by row writes
+    row_format = ' '.join([WAVELENGTH_FORMAT] + [FLUX_FORMAT] * (data.shape[1] - 1)) + '\n'
+    return ((row_format * len(data)) % tuple(data.ravel().tolist())).encode()
+
+
+def spectrum_file_name(target_name, timestamp, datum_id):
+    name = re.sub(r'[^A-Za-z0-9_.-]+', '_', f'{target_name}_{timestamp:%Y%m%dT%H%M%S}_{datum_id}')
+    return f'{name}.txt'
+
+
+def spectrum_datum_choices(target):
+    """ Returns a choice of generated ASCII file for each spectrum of a Target, for the classify form
+    """
+    datums = (SpectroscopyReducedDatum.objects.filter(target=target).order_by('-timestamp')
+              .values_list('pk', 'timestamp', 'telescope', 'instrument'))
+    return [(f'{DATUM_CHOICE_PREFIX}{pk}',
+             f'{spectrum_file_name(target.name, timestamp, pk)} (generated from the '
+             f'{" ".join(filter(None, [telescope, instrument])) or "reduced"} spectrum)')
+            for pk, timestamp, telescope, instrument in datums]
+
+
+def spectrum_file_choices(target):
+    """
+    Returns the choices of ASCII and FITS files of a Target for the classify form. Besides the ASCII DataProducts,
+    ASCII files can be converted from each FITS DataProduct or generated from each reduced spectrum.
+    """
+    ascii_files = []
+    fits_files = []
+    converted_files = []
+    for data_product in target.dataproduct_set.all():
+        if data_product.get_file_extension().lower() in ASCII_EXTENSIONS:
+            ascii_files.append((data_product.pk, data_product.get_file_name()))
+        elif data_product.get_file_extension().lower() in FITS_EXTENSIONS:
+            fits_files.append((data_product.pk, data_product.get_file_name()))
+            converted_files.append((f'{FITS_CHOICE_PREFIX}{data_product.pk}',
+                                    f'{converted_file_name(data_product.get_file_name())} (converted from FITS)'))
+    return ascii_files + converted_files + spectrum_datum_choices(target), fits_files
+
+
+def spectrum_ascii_file(datum_id):
+    """
+    Returns an in-memory ASCII file of a SpectroscopyReducedDatum, ready to be sent to the TNS or Hermes.
+    The file content is cached by datum ID, timestamp and a hash of the spectrum data, so re-reduced data is never
+    served stale.
+    """
+    datum = (SpectroscopyReducedDatum.objects.values('pk', 'timestamp', 'target__name', 'value', 'wavelength', 'flux',
+                                                     'error').get(pk=datum_id))
+    name = spectrum_file_name(datum['target__name'], datum['timestamp'], datum['pk'])
+    # Older spectra only have their data in the value JSON
+    value = datum['value'] if isinstance(datum['value'], dict) else {}
+    wavelength = datum['wavelength'] or value.get('wavelength', [])
+    flux = datum['flux'] or value.get('flux', [])
+    error = datum['error'] or value.get('error') or None
+    data_hash = hashlib.sha256(json.dumps([datum['value'], datum['wavelength'], datum['flux'], datum['error']],
+                                          sort_keys=True, default=str).encode()).hexdigest()
+    cache_key = f'tns_spectrum_ascii_{datum["pk"]}_{datum["timestamp"]:%Y%m%dT%H%M%S%f}_{data_hash}'
+    content = cache.get(cache_key)
+    if content is None:
+        content = spectrum_ascii(wavelength, flux, error)
+        cache.set(cache_key, content, SPECTRUM_CACHE_TIMEOUT)
+        logger.info(f'Generated {name} from {len(wavelength)} spectrum points')
+    return ContentFile(content, name=name)
+
+
+def converted_file_name(fits_name):
+    name = os.path.basename(fits_name)
+    for extension in FITS_EXTENSIONS[::-1]:
+        if name.lower().endswith(extension):
+            name = name[:-len(extension)]
+            break
+    return f'{name}.txt'
+
+
+def multispec_dispersion(header, aperture=1):
+    """
+    Returns a function of pixel indices to wavelengths for a spectrum (aperture) of an IRAF multispec image, which
+    gives its dispersion in the WAT2 keywords. Only linear and log-linear dispersions are supported.
+    """
+    wat = ''.join(str(header[key]).ljust(68) for key in sorted(header['WAT2_*'], key=lambda key: int(key[5:])))
+    match = re.search(rf'spec{aperture}\s*=\s*"([^"]*)"', wat)
+    if not match:
+        raise ValueError(f'The multispec FITS file has no dispersion for spectrum {aperture}')
+    _, _, dtype, w1, dw, _, z = match.group(1).split()[:7]
+    dtype, w1, dw, z = int(dtype), float(w1), float(dw), float(z)
+    if dtype not in [0, 1]:
+        raise ValueError('Non-linear multispec dispersions are not supported')
+
+    def dispersion(pixels):
+        wavelength = (w1 + dw * pixels) / (1 + z)
+        return 10 ** wavelength if dtype == 1 else wavelength
+    return dispersion
+
+
+def spectrum_dispersion(header):
+    """
+    Returns a function of pixel indices (along the first axis of a spectrum image) to wavelengths in Angstrom, from
+    the WCS of the image.
+    """
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', FITSFixedWarning)
+        wcs = WCS(header, naxis=[1])
+    # Spectral WCS types give wavelengths in SI units
+    unit = wcs.wcs.cunit[0]
+    scale = unit.to(units.AA) if unit.physical_type == 'length' else 1
+    log_linear = header.get('DC-FLAG') == 1  # IRAF log-linear dispersion
+
+    def dispersion(pixels):
+        wavelength = wcs.pixel_to_world_values(pixels)
+        return (10 ** wavelength if log_linear else wavelength) * scale
+    return dispersion
+
+
+def find_column(names, candidates):
+    lower_names = {name.lower(): name for name in names}
+    return next((lower_names[candidate] for candidate in candidates if candidate in lower_names), None)
+
+
+def fits_table_chunks(hdu, reverse=False):
+    """
+    Yields arrays of (wavelength, flux[, error]) rows from a table HDU with wavelength and flux columns, in the order
+    of its rows, or in `reverse` order
+    """
+    names = hdu.columns.names
+    wavelength_column = find_column(names, WAVELENGTH_COLUMNS)
+    flux_column = find_column(names, FLUX_COLUMNS)
+    if not wavelength_column or not flux_column:
+        return
+    error_column = find_column(names, ERROR_COLUMNS)
+    data = hdu.data
+    starts = range(0, len(data), FITS_CHUNK_SIZE)
+    # Spectra are stored either as one point per row, or as arrays in a single row
+    for row_start in reversed(starts) if reverse else starts:
+        rows = data[row_start:row_start + FITS_CHUNK_SIZE]
+        wavelength = np.ravel(rows[wavelength_column]).astype(float)
+        columns = [10 ** wavelength if wavelength_column.lower() == 'loglam' else wavelength,
+                   np.ravel(rows[flux_column]).astype(float)]
+        if error_column:
+            error = np.ravel(rows[error_column]).astype(float)
+            if error_column.lower() == 'ivar':
+                with np.errstate(divide='ignore'):
+                    error = 1 / np.sqrt(error)
+            columns.append(error)
+        chunk = np.column_stack(columns)
+        yield chunk[::-1] if reverse else chunk
+
+
+def fits_image_spectra(hdu):
+    """
+    Returns a function of `reverse` yielding arrays of (wavelength, flux) rows for each spectrum of an image HDU, with
+    wavelengths from its WCS. IRAF multispec images have a spectrum per aperture (e.g. echelle orders) in their second
+    axis, and other bands (e.g. sky or errors) in their third axis, which are skipped. Other multi-dimensional images
+    use their first row, as in FLOYDS spectra.
+    """
+    length = hdu.data.shape[-1]
+    if str(hdu.header.get('CTYPE1', '')).upper().startswith('MULTISPE'):
+        apertures = hdu.data.shape[-2] if hdu.data.ndim > 1 else 1
+        fluxes = hdu.data.reshape(-1, apertures, length)[0]
+        dispersions = [multispec_dispersion(hdu.header, aperture + 1) for aperture in range(apertures)]
+    else:
+        fluxes = hdu.data.reshape(-1, length)[:1]
+        dispersions = [spectrum_dispersion(hdu.header)]
+    return [functools.partial(image_chunks, flux, dispersion) for flux, dispersion in zip(fluxes, dispersions)]
+
+
+def image_chunks(flux, dispersion, reverse=False):
+    starts = range(0, len(flux), FITS_CHUNK_SIZE)
+    for start in reversed(starts) if reverse else starts:
+        stop = min(start + FITS_CHUNK_SIZE, len(flux))
+        wavelength = np.asarray(dispersion(np.arange(start, stop, dtype=float)), dtype=float)
+        chunk = np.column_stack([wavelength, flux[start:stop].astype(float)])
+        yield chunk[::-1] if reverse else chunk
+
+
+def spectrum_order(chunks):
+    """
+    Returns the lowest and highest wavelength of a spectrum given in chunks of rows, its number of columns, and
+    whether its wavelengths increase (1), decrease (-1) or neither (0).
+    """
+    low, high, last, columns = np.inf, -np.inf, np.nan, 0
+    increasing = decreasing = True
+    for chunk in chunks:
+        columns = chunk.shape[1]
+        wavelength = chunk[np.isfinite(chunk).all(axis=1), 0]
+        if not len(wavelength):
+            continue
+        steps = np.diff(np.concatenate([[last], wavelength]) if np.isfinite(last) else wavelength)
+        increasing = increasing and bool((steps > 0).all())
+        decreasing = decreasing and bool((steps < 0).all())
+        low, high, last = min(low, wavelength.min()), max(high, wavelength.max()), wavelength[-1]
+    return low, high, columns, 1 if increasing else -1 if decreasing else 0
+
+
+def increasing_rows(chunk, last_wavelength):
+    """ The finite rows of a chunk whose wavelength is above `last_wavelength` and every wavelength before them
+    """
+    chunk = chunk[np.isfinite(chunk).all(axis=1)]
+    previous = np.maximum.accumulate(np.concatenate([[last_wavelength], chunk[:-1, 0]]))
+    return chunk[chunk[:, 0] > previous]
+
+
+def fits_spectrum_ascii(file, output):
+    """
+    Convert a FITS spectrum to TNS ASCII file content, written to the binary file `output`. The file is memory
+    mapped and converted in chunks, so large files are never fully loaded. Spectra are read from every table HDU with
+    wavelength and flux columns, and every spectrum image HDU other than errors, masks or sky. Several spectra (e.g.
+    echelle orders, in separate HDUs or multispec apertures) are written in order of wavelength, each in increasing
+    order of wavelength: where spectra overlap, the one starting at the lower wavelength is kept. Spectra whose rows
+    are not sorted by wavelength are sorted in memory.
+    """
+    with fits.open(file, memmap=True, lazy_load_hdus=False) as hdul:
+        spectra = []
+        for hdu in hdul:
+            if hdu.data is None:
+                continue
+            if isinstance(hdu, (fits.BinTableHDU, fits.TableHDU)):
+                spectra.append(functools.partial(fits_table_chunks, hdu))
+            elif hdu.is_image and not SKIPPED_EXTENSIONS.search(hdu.name if hdu.name != 'PRIMARY' else ''):
+                spectra.extend(fits_image_spectra(hdu))
+        ordered = []
+        for spectrum in spectra:
+            low, high, columns, order = spectrum_order(spectrum())
+            if low <= high:
+                ordered.append((low, columns, order, spectrum))
+        if not ordered:
+            raise ValueError('No spectrum found in the FITS file')
+        # Every row of the file needs the same columns, so errors are only written if every spectrum has them
+        columns = min(spectrum[1] for spectrum in ordered)
+        last_wavelength = -np.inf
+        for _, _, order, spectrum in sorted(ordered, key=lambda spectrum: spectrum[0]):
+            if order:
+                chunks = spectrum(reverse=order < 0)
+            else:
+                data = np.concatenate(list(spectrum()))
+                chunks = [data[np.argsort(data[:, 0], kind='stable')]]
+            for chunk in chunks:
+                chunk = increasing_rows(chunk[:, :columns], last_wavelength)
+                if len(chunk):
+                    output.write(format_spectrum_rows(chunk))
+                    last_wavelength = chunk[-1, 0]
+
+
+def file_hash(file):
+    digest = hashlib.sha256()
+    for chunk in file.chunks():
+        digest.update(chunk)
+    return digest.hexdigest()
+
+
+def fits_ascii_file(data_product_id):
+    """
+    Returns an ASCII file converted from a FITS spectrum DataProduct, ready to be sent to the TNS or Hermes. The file
+    is converted to a temporary file, and converted files of up to SPECTRUM_CACHE_MAX_SIZE are cached by the hash of
+    the FITS file.
+    """
+    data_product = DataProduct.objects.get(pk=data_product_id)
+    name = converted_file_name(data_product.data.name)
+    with data_product.data.open('rb') as file:
+        cache_key = f'tns_fits_ascii_{file_hash(file)}'
+        content = cache.get(cache_key)
+        if content is not None:
+            return ContentFile(content, name=name)
+        file.seek(0)
+        # Memory mapping needs a path; storages without local files are read through the file object
+        try:
+            source = data_product.data.path
+        except NotImplementedError:
+            source = file
+        output = tempfile.TemporaryFile()
+        fits_spectrum_ascii(source, output)
+    logger.info(f'Converted {data_product.data.name} to {name}')
+    if output.tell() <= SPECTRUM_CACHE_MAX_SIZE:
+        output.seek(0)
+        cache.set(cache_key, output.read(), SPECTRUM_CACHE_TIMEOUT)
+    output.seek(0)
+    return File(output, name=name)
+
+
+def file_lines(file, chunk_size=VALIDATION_CHUNK_SIZE):
+    """
+    Yields lists of the lines (as bytes) of a file, read `chunk_size` bytes at a time. A line longer than
+    MAX_LINE_LENGTH is yielded on its own, cut short, so that files without line breaks are never fully read.
+    """
+    remainder = b''
+    for chunk in file.chunks(chunk_size):
+        lines = (remainder + chunk).split(b'\n')
+        remainder = lines.pop()
+        if len(remainder) > MAX_LINE_LENGTH:
+            lines.append(remainder[:MAX_LINE_LENGTH + 1])
+            yield lines
+            return
+        yield lines
+    if remainder:
+        yield [remainder]
+
+
+def ascii_spectrum_errors(file, max_errors=MAX_SPECTRUM_ERRORS):
+    """
+    Check a TNS ASCII spectrum file a chunk at a time, so that large files are never loaded at once. Every row other
+    than blank lines and `#` comments must hold a wavelength, a flux and optionally an error, as finite numbers, with
+    the same number of columns throughout and wavelengths in increasing order. Returns a list of errors with their
+    line numbers; checking stops at the first chunk of the file with errors.
+    """
+    columns = None
+    rows = 0
+    line_number = 0
+    last_wavelength = -np.inf
+    for lines in file_lines(file):
+        # Chunks are parsed at once, and only parsed line by line to find the errors of a chunk that fails
+        try:
+            data = None if len(lines[-1]) > MAX_LINE_LENGTH else np.loadtxt(
+                [line.decode() for line in lines], comments='#', ndmin=2)
+        except ValueError:
+            data = None
+        if data is not None and len(data) and not spectrum_rows_are_valid(data, columns, last_wavelength):
+            data = None
+        if data is None:
+            errors, columns, data = spectrum_line_errors(lines, line_number, columns, last_wavelength, max_errors)
+            if errors:
+                return errors
+        if len(data):
+            columns = data.shape[1]
+            rows += len(data)
+            last_wavelength = data[-1, 0]
+        line_number += len(lines)
+    if not rows:
+        return ['The ASCII file holds no spectrum rows']
+    return []
+
+
+def spectrum_rows_are_valid(data, columns, last_wavelength):
+    return (data.shape[1] == (columns or data.shape[1]) and data.shape[1] in (2, 3) and np.isfinite(data).all()
+            and data[0, 0] > last_wavelength and (np.diff(data[:, 0]) > 0).all())
+
+
+def spectrum_line_errors(lines, line_number, columns, last_wavelength, max_errors=MAX_SPECTRUM_ERRORS):
+    """
+    Check lines of an ASCII spectrum following `line_number` one by one, given the number of `columns` and the
+    `last_wavelength` of the rows before them (None and -inf at the start of the file).
+    Returns the errors, the number of columns and an array of the valid rows.
+    """
+    errors = []
+    rows = []
+    for line in lines:
+        line_number += 1
+        if len(line) > MAX_LINE_LENGTH:
+            errors.append(f'line {line_number}: longer than {MAX_LINE_LENGTH} characters, not an ASCII spectrum')
+            break
+        try:
+            fields = line.decode().split('#')[0].split()
+        except UnicodeDecodeError:
+            errors.append(f'line {line_number}: not text, not an ASCII spectrum')
+            break
+        if not fields:
+            continue
+        if columns is None:
+            columns = len(fields)
+            if columns not in (2, 3):
+                errors.append(f'line {line_number}: expected 2 or 3 columns (wavelength, flux and optionally '
+                              f'error), found {columns}')
+                break
+        if len(fields) != columns:
+            errors.append(f'line {line_number}: expected {columns} columns, found {len(fields)}')
+            continue
+        try:
+            row = np.array(fields, dtype=float)
+        except ValueError:
+            errors.append(f'line {line_number}: not a number in {" ".join(fields)!r}')
+            continue
+        if not np.isfinite(row).all():
+            errors.append(f'line {line_number}: values must be finite numbers')
+        elif row[0] <= last_wavelength:
+            errors.append(f'line {line_number}: wavelength {row[0]:g} is not above the previous wavelength '
+                          f'{last_wavelength:g}, wavelengths must increase')
+        else:
+            last_wavelength = row[0]
+            rows.append(row)
+        if len(errors) >= max_errors:
+            break
+    return errors, columns, np.array(rows).reshape(-1, columns or 2)
+
+
+def is_spectrum_hdu(hdu):
+    """ Whether an HDU holds a spectrum, from its header only: a table with wavelength and flux columns, or a spectrum
+    image rather than a direct image of the sky
+    """
+    if isinstance(hdu, (fits.BinTableHDU, fits.TableHDU)):
+        names = hdu.columns.names
+        return bool(find_column(names, WAVELENGTH_COLUMNS) and find_column(names, FLUX_COLUMNS))
+    if not hdu.is_image or not hdu.shape or SKIPPED_EXTENSIONS.search(hdu.name if hdu.name != 'PRIMARY' else ''):
+        return False
+    if str(hdu.header.get('CTYPE1', '')).upper().startswith('MULTISPE'):
+        return True
+    if CELESTIAL_CTYPES.match(str(hdu.header.get('CTYPE1', ''))):
+        return False
+    return int(np.prod(hdu.shape[:-1])) <= MAX_SPECTRUM_IMAGE_ROWS
+
+
+def fits_spectrum_errors(file):
+    """
+    Check that a FITS file holds a spectrum that `fits_spectrum_ascii` can read, from its headers only. Returns a
+    list of errors.
+    """
+    shapes = []
+    try:
+        hdul = fits.open(file, memmap=False)
+    except (OSError, ValueError) as e:
+        return [f'The FITS file cannot be read: {e}']
+    try:
+        for index, hdu in enumerate(hdul):
+            if is_spectrum_hdu(hdu):
+                return []
+            if hdu.is_image and hdu.shape:
+                shapes.append(f'HDU {index} is a {" x ".join(str(n) for n in hdu.shape[::-1])} image')
+    except (OSError, ValueError) as e:
+        return [f'The FITS file cannot be read: {e}']
+    finally:
+        # The file is still to be submitted
+        hdul.close(closed=False)
+    return [f'The FITS file holds no spectrum{": " if shapes else ""}{", ".join(shapes)}']
+
+
+def spectrum_file_errors(file, file_type):
+    """
+    Check an `ascii_file` or `fits_file` before it is submitted. Verdicts are cached by the hash of the file, so a
+    file is only checked once. Returns a list of errors, empty if the file is valid.
+    """
+    cache_key = f'tns_spectrum_verdict_{file_type}_{file_hash(file)}'
+    errors = cache.get(cache_key)
+    if errors is None:
+        file.seek(0)
+        errors = ascii_spectrum_errors(file) if file_type == 'ascii_file' else fits_spectrum_errors(file)
+        cache.set(cache_key, errors, SPECTRUM_CACHE_TIMEOUT)
+    file.seek(0)
+    return errors
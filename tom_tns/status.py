@@ -0,0 +1,63 @@
+from django.db.models import Exists, OuterRef, Q
+
+from tom_targets.models import Target, TargetName
+
+from tom_tns.ledger import IN_FLIGHT
+from tom_tns.models import TNSSubmission
+
+
+TNS_STATUS_UNREPORTED = 'unreported'
+TNS_STATUS_SUBMITTED = 'submitted'
+TNS_STATUS_REPORTED = 'reported'
+TNS_STATUS_CLASSIFIED = 'classified'
+
+TNS_STATUS_LABELS = {
+    TNS_STATUS_UNREPORTED: 'Unreported',
+    TNS_STATUS_SUBMITTED: 'Report submitted',
+    TNS_STATUS_REPORTED: 'AT reported',
+    TNS_STATUS_CLASSIFIED: 'Classified SN',
+}
+
+
+def _iau_name_exists(prefix):
+    """
+    Returns an expression that is True if a Target's name or any of its aliases is an IAU designation with `prefix`,
+    such as AT2024abc or AT 2024abc for 'AT' (but not ATLAS24abc)
+    """
+    designation = rf'^{prefix}\s?\d{{4}}[a-z]+$'
+    alias_exists = Exists(TargetName.objects.filter(target=OuterRef('pk'), name__iregex=designation))
+    return Q(name__iregex=designation) | Q(alias_exists)
+
+
+def get_tns_statuses(targets):
+    """
+    Determine the TNS status of many Targets with a single query.
+    A Target with an SN designation as its name or alias has been classified, one with an AT designation or with a
+    succeeded TNSSubmission has been reported, and one with a pending or running TNSSubmission has been submitted.
+    Otherwise it is considered unreported.
+
+    :param targets: An iterable of Targets or Target ids (e.g. a page of a target list)
+    :returns: Dictionary of Target id to one of the TNS_STATUS_* values
+    """
+    target_ids = [getattr(target, 'pk', target) for target in targets]
+    submissions = TNSSubmission.objects.filter(target=OuterRef('pk'))
+    annotated = Target.objects.filter(pk__in=target_ids).annotate(
+        tns_submitted=Exists(submissions.filter(status__in=IN_FLIGHT)),
+        tns_reported=_iau_name_exists('AT') | Q(Exists(submissions.filter(status=TNSSubmission.STATUS_SUCCEEDED))),
+        tns_classified=_iau_name_exists('SN'),
+    ).values_list('pk', 'tns_submitted', 'tns_reported', 'tns_classified')
+    statuses = {target_id: TNS_STATUS_UNREPORTED for target_id in target_ids}
+    for target_id, submitted, reported, classified in annotated:
+        if classified:
+            statuses[target_id] = TNS_STATUS_CLASSIFIED
+        elif reported:
+            statuses[target_id] = TNS_STATUS_REPORTED
+        elif submitted:
+            statuses[target_id] = TNS_STATUS_SUBMITTED
+    return statuses
+
+
+def get_tns_status(target):
+    """ Returns the TNS status of a single Target. See `get_tns_statuses`.
+    """
+    return get_tns_statuses([target])[target.pk]
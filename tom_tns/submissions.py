@@ -0,0 +1,319 @@
+import json
+import os
+import socket
+import threading
+import time
+import uuid
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+import requests.exceptions
+from django.conf import settings
+from django.core.cache import cache
+from django.core.files.storage import default_storage
+from django.db import IntegrityError, close_old_connections, transaction
+from django.db.models import Count
+from django.utils import timezone
+
+from tom_tns.autoreport import auto_report_settings, evaluate_auto_report_candidates
+from tom_tns.hermes_api import submit_to_hermes
+from tom_tns.ledger import WEB_WORKER, DuplicateSubmission, recording_submission
+from tom_tns.models import TNSLock, TNSSubmission
+from tom_tns.renaming import rename_targets
+from tom_tns.reports import tns_bulk_report
+from tom_tns.tns_api import (BadTnsRequest, choose_tns_bot, get_tns_credentials, get_tns_report_reply,
+                             pre_upload_files_to_tns, report_bot_key, send_tns_report, submit_through_hermes,
+                             use_tns_bot)
+from tom_tns.validation import validate_tns_report
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+SUBMISSION_FILES_DIR = 'tns_submissions'
+# Errors after which a submission is worth retrying, as the TNS or Hermes may just have been unreachable
+TRANSIENT_ERRORS = (requests.exceptions.ConnectionError, requests.exceptions.Timeout)
+# The `worker` of submissions whose send failed in a way that leaves open whether the report was received
+SENT_UNCONFIRMED = 'unconfirmed'
+
+
+def worker_settings():
+    return getattr(settings, 'DATA_SERVICES', {}).get('TNS', {})
+
+
+def queue_submissions_enabled():
+    """ Whether the TNS views queue submissions for the `tns_worker` command rather than sending them directly
+    """
+    return worker_settings().get('submission_queue', False)
+
+
+def store_submission_file(file):
+    """ Copy a spectrum file to the default storage so that a worker can submit it later. Returns its storage name
+    """
+    name = os.path.join(SUBMISSION_FILES_DIR, uuid.uuid4().hex, os.path.basename(file.name))
+    file.open('rb')
+    return default_storage.save(name, file)
+
+
+def open_submission_file(name):
+    file = default_storage.open(name, 'rb')
+    # Submit the file under its original name, without the storage directories
+    file.name = os.path.basename(name)
+    return file
+
+
+def queue_submission(form, target_id, user=None, payload_hash=''):
+    """
+    Build the report from a valid TNS form and queue it for the `tns_worker` command, without contacting the TNS or
+    Hermes. TNS reports are validated first, raising InvalidTnsReport if they are malformed. A `payload_hash` (see
+    `tom_tns.ledger`) that duplicates another submission raises DuplicateSubmission, or IntegrityError if it is
+    already in flight for the Target. Returns the queued TNSSubmission.
+    """
+    files = {}
+    if hasattr(form, 'build_report'):
+        report, ascii_file, fits_file = form.build_report()
+        spectrum_files = {'ascii_file': ascii_file, 'fits_file': fits_file}
+    else:
+        report, spectrum_files = form.to_report(), {}
+
+    if submit_through_hermes():
+        destination = TNSSubmission.DESTINATION_HERMES
+        bot_id = 'hermes'
+        payload = report.to_hermes(form.option_labels())
+    else:
+        destination = TNSSubmission.DESTINATION_TNS
+        bot_id = str(choose_tns_bot().get('bot_id', ''))
+        payload = tns_bulk_report([report])
+        validate_tns_report(payload)
+    for file_type, file in spectrum_files.items():
+        if file:
+            files[file_type] = store_submission_file(file)
+
+    try:
+        with recording_submission(target_id, payload_hash):
+            submission = TNSSubmission.objects.create(target_id=target_id, user=user, destination=destination,
+                                                      bot_id=bot_id, payload=payload, payload_hash=payload_hash,
+                                                      files=files)
+    except (IntegrityError, DuplicateSubmission):
+        for name in files.values():
+            default_storage.delete(name)
+        raise
+    logger.info(f'Queued {submission}')
+    return submission
+
+
+def queue_report_reply(target_id, payload, report_id, user=None):
+    """
+    Queue a TNS report that was already sent (as `report_id`) for the `tns_worker` command, which only waits for its
+    reply and renames the Target. Returns the queued TNSSubmission.
+    """
+    bot_id = str(get_tns_credentials(cache.get(report_bot_key(report_id))).get('bot_id', ''))
+    submission = TNSSubmission.objects.create(target_id=target_id, user=user, destination=TNSSubmission.DESTINATION_TNS,
+                                              bot_id=bot_id, payload=payload, report_id=report_id)
+    logger.info(f'Queued the reply to TNS report {report_id} as {submission}')
+    return submission
+
+
+class SubmissionMessages:
+    """
+    Stands in for the request in the TNS and Hermes functions that report their progress through Django messages,
+    recording the messages so they can be stored with the submission instead.
+    """
+    def __init__(self):
+        self._messages = self
+        self.messages = []
+
+    def add(self, level, message, extra_tags=''):
+        self.messages.append({'level': level, 'message': str(message)})
+
+
+def process_submission(submission):
+    """
+    Send a claimed TNSSubmission to the TNS or Hermes, wait for the TNS reply and rename the Target to its IAU name.
+    Transient network errors before the report is sent, or while waiting for its reply, put the submission back in
+    the queue until `worker_max_attempts` (default 3) is reached; other errors fail it. A report that timed out or
+    lost its connection while being sent may or may not have reached the TNS or Hermes, so it is not sent again: it
+    stays running as SENT_UNCONFIRMED, with its error, until `requeue_stale` fails it.
+    Returns the updated submission.
+    """
+    recorder = SubmissionMessages()
+    sending = False
+    files = {file_type: open_submission_file(name) for file_type, name in submission.files.items()}
+    try:
+        if submission.destination == TNSSubmission.DESTINATION_HERMES:
+            spectrum_files = [files[file_type] for file_type in ['ascii_file', 'fits_file'] if file_type in files]
+            sending = True
+            iau_name = submit_to_hermes(submission.payload, spectrum_files, recorder)
+            sending = False
+            if not iau_name:
+                raise BadTnsRequest('; '.join(message['message'] for message in recorder.messages) or
+                                    'Hermes did not return a TNS object name')
+        else:
+            # Send from, and poll with, the bot the submission was queued for
+            with use_tns_bot(submission.bot_id):
+                # A report that was already accepted by the TNS only needs its reply
+                if submission.report_id is None:
+                    payload = submission.payload
+                    if files:
+                        tns_filenames = pre_upload_files_to_tns({'ascii_file': files.get('ascii_file'),
+                                                                 'fits_file': files.get('fits_file'),
+                                                                 'other_files': []}) or {}
+                        for classification in payload.get('classification_report', {}).values():
+                            for spectrum in classification['spectra']['spectra-group'].values():
+                                spectrum['ascii_file'] = tns_filenames.get('ascii_file', '')
+                                spectrum['fits_file'] = tns_filenames.get('fits_file', '')
+                    sending = True
+                    submission.report_id = send_tns_report(json.dumps(payload))
+                    sending = False
+                    submission.save(update_fields=['report_id'])
+                iau_name = get_tns_report_reply(submission.report_id, recorder)
+        # Follow-up photometry reports are of named objects, and a batch of them shares one report and its reply
+        if submission.last_photometry_id is None:
+            rename_targets({submission.target_id: iau_name})
+            submission.iau_name = iau_name
+        submission.status = TNSSubmission.STATUS_SUCCEEDED
+        submission.error = ''
+    except TRANSIENT_ERRORS as e:
+        submission.error = repr(e)
+        if sending and not isinstance(e, requests.exceptions.ConnectTimeout):
+            submission.worker = SENT_UNCONFIRMED
+            logger.error(f'{submission} may or may not have been sent, it is not sent again: {repr(e)}')
+        else:
+            max_attempts = worker_settings().get('worker_max_attempts', 3)
+            submission.status = (TNSSubmission.STATUS_PENDING if submission.attempts < max_attempts
+                                 else TNSSubmission.STATUS_FAILED)
+            logger.warning(f'{submission} failed on attempt {submission.attempts}: {repr(e)}')
+    except (requests.exceptions.RequestException, BadTnsRequest) as e:
+        submission.status = TNSSubmission.STATUS_FAILED
+        submission.error = str(e)
+        logger.error(f'{submission} failed: {e}')
+    finally:
+        for file in files.values():
+            file.close()
+    submission.messages = submission.messages + recorder.messages
+    if submission.status != TNSSubmission.STATUS_PENDING:
+        if submission.status != TNSSubmission.STATUS_RUNNING:
+            submission.finished = timezone.now()
+        for name in submission.files.values():
+            default_storage.delete(name)
+    submission.save(update_fields=['status', 'iau_name', 'error', 'messages', 'worker', 'finished'])
+    return submission
+
+
+class SubmissionWorker:
+    """
+    Drains the TNSSubmission queue with a pool of threads. Submissions are claimed with `SELECT ... FOR UPDATE SKIP
+    LOCKED` (where the database supports it) so that several workers, on any number of hosts, can run at once.
+    No more than `bot_concurrency` submissions per TNS bot (or through Hermes) are running at a time across workers.
+    If automatic reporting is enabled, the worker also queues reports for the Targets due to be evaluated, at most
+    once per `debounce_seconds`.
+    """
+    def __init__(self, threads=None, bot_concurrency=None, poll_interval=None, stale_seconds=None, name=None):
+        tns_settings = worker_settings()
+        self.threads = threads or tns_settings.get('worker_threads', 4)
+        self.bot_concurrency = bot_concurrency or tns_settings.get('worker_bot_concurrency', 2)
+        self.poll_interval = poll_interval or tns_settings.get('worker_poll_interval', 2)
+        self.stale_seconds = stale_seconds or tns_settings.get('worker_stale_seconds', 600)
+        self.name = name or f'{socket.gethostname()}:{os.getpid()}'
+        self.stopping = threading.Event()
+        self.in_flight = threading.Semaphore(self.threads)
+        self.next_evaluation = 0
+
+    def stop(self):
+        """ Stop claiming submissions. Submissions already claimed are finished before `run` returns
+        """
+        self.stopping.set()
+
+    def requeue_stale(self):
+        """
+        Put submissions left running by a worker that died back in the queue. Submissions left running while being
+        sent directly (WEB_WORKER) before the TNS accepted them, or whose send timed out (SENT_UNCONFIRMED), may or may
+        not have been sent, so they fail instead of being sent again.
+        Returns how many were requeued.
+        """
+        cutoff = timezone.now() - timedelta(seconds=self.stale_seconds)
+        stale = TNSSubmission.objects.filter(status=TNSSubmission.STATUS_RUNNING, started__lt=cutoff)
+        unconfirmed = stale.filter(worker__in=[WEB_WORKER, SENT_UNCONFIRMED], report_id__isnull=True)
+        unconfirmed.filter(error='').update(error='Interrupted while being submitted')
+        interrupted = unconfirmed.update(status=TNSSubmission.STATUS_FAILED, finished=timezone.now())
+        if interrupted:
+            logger.warning(f'Failed {interrupted} TNS submissions that may or may not have been sent')
+        requeued = stale.update(status=TNSSubmission.STATUS_PENDING)
+        if requeued:
+            logger.warning(f'Requeued {requeued} stale TNS submissions')
+        return requeued
+
+    def claim(self, limit):
+        """ Claim up to `limit` pending submissions, respecting the per-bot concurrency caps
+        """
+        with transaction.atomic():
+            pending = list(TNSSubmission.objects.select_for_update(skip_locked=True)
+                           .filter(status=TNSSubmission.STATUS_PENDING).order_by('created')[:limit * 4])
+            # Hold the bots' lock rows across the count and the update, so other workers wait for this claim
+            bot_ids = sorted({submission.bot_id for submission in pending})
+            TNSLock.acquire(f'bot:{bot_id}' for bot_id in bot_ids)
+            running = Counter(dict(TNSSubmission.objects.filter(status=TNSSubmission.STATUS_RUNNING,
+                                                                bot_id__in=bot_ids)
+                                   .values_list('bot_id').annotate(count=Count('id'))))
+            claimed = []
+            now = timezone.now()
+            for submission in pending:
+                if len(claimed) == limit:
+                    break
+                if running[submission.bot_id] >= self.bot_concurrency:
+                    continue
+                running[submission.bot_id] += 1
+                submission.status = TNSSubmission.STATUS_RUNNING
+                submission.worker = self.name
+                submission.started = now
+                submission.attempts += 1
+                claimed.append(submission)
+            TNSSubmission.objects.bulk_update(claimed, ['status', 'worker', 'started', 'attempts'])
+        return claimed
+
+    def process(self, submission):
+        try:
+            process_submission(submission)
+        except Exception as e:
+            logger.exception(f'Unexpected error processing {submission}: {repr(e)}')
+            TNSSubmission.objects.filter(pk=submission.pk).update(status=TNSSubmission.STATUS_FAILED,
+                                                                  error=repr(e), finished=timezone.now())
+        finally:
+            self.in_flight.release()
+            close_old_connections()
+
+    def evaluate_auto_reports(self):
+        """ Queue the automatic reports that are due, if automatic reporting is enabled and it's time to look again
+        """
+        config = auto_report_settings()
+        if not config['enabled'] or time.monotonic() < self.next_evaluation:
+            return
+        self.next_evaluation = time.monotonic() + config['debounce_seconds']
+        evaluate_auto_report_candidates()
+
+    def run(self, once=False):
+        """
+        Process submissions until `stop` is called, or until the queue is empty if `once` is set.
+        Returns the number of submissions processed.
+        """
+        processed = 0
+        with ThreadPoolExecutor(max_workers=self.threads, thread_name_prefix='tns_worker') as executor:
+            while not self.stopping.is_set():
+                self.requeue_stale()
+                self.evaluate_auto_reports()
+                # Only claim as many submissions as there are idle threads
+                free = 0
+                while self.in_flight.acquire(blocking=False):
+                    free += 1
+                claimed = self.claim(free) if free else []
+                for _ in range(free - len(claimed)):
+                    self.in_flight.release()
+                for submission in claimed:
+                    executor.submit(self.process, submission)
+                processed += len(claimed)
+                if once and not claimed and free == self.threads:
+                    break
+                if not claimed:
+                    self.stopping.wait(self.poll_interval)
+        return processed
@@ -1,3 +1,4 @@
+import numpy as np
 from django import template
 from django.conf import settings
 
@@ -6,6 +7,11 @@ from tom_dataproducts.models import PhotometryReducedDatum, SpectroscopyReducedD
 from tom_tns.tns_api import (get_tns_values, map_filter_to_tns, map_instrument_to_tns,
                              default_authors)
 from tom_tns.forms import TNSReportForm, TNSClassifyForm
+from tom_tns.spectra import (ASCII_EXTENSIONS, DATUM_CHOICE_PREFIX, FITS_CHOICE_PREFIX, FITS_EXTENSIONS,
+                             spectrum_file_choices)
+from tom_tns.status import (get_tns_statuses, TNS_STATUS_LABELS, TNS_STATUS_UNREPORTED, TNS_STATUS_SUBMITTED,
+                            TNS_STATUS_REPORTED, TNS_STATUS_CLASSIFIED)
+from tom_tns.units import AB_MAG, convert_flux
 
 register = template.Library()
 
@@ -61,12 +67,17 @@ def report_to_tns(context):
         mapped_filter = map_filter_to_tns(phot_data.bandpass)
         if mapped_filter and mapped_filter in TNS_FILTER_IDS:
             initial['filter'] = (TNS_FILTER_IDS[mapped_filter], mapped_filter)
+        # The form defaults to AB magnitudes; photometry in units that can't be converted is given as it is
+        (brightness, limit), (error, _) = convert_flux(
+            [phot_data.brightness, phot_data.limit], [phot_data.brightness_error, None],
+            from_units=phot_data.unit or '', to_unit=AB_MAG, filters=phot_data.bandpass or '')
+        converted = not (np.isnan(brightness) and np.isnan(limit))
         if phot_data.brightness:
-            initial['flux'] = phot_data.brightness
+            initial['flux'] = float(brightness) if converted else phot_data.brightness
         if phot_data.brightness_error:
-            initial['flux_error'] = phot_data.brightness_error
+            initial['flux_error'] = float(error) if converted else phot_data.brightness_error
         if phot_data.limit:
-            initial['limiting_flux'] = phot_data.limit
+            initial['limiting_flux'] = float(limit) if converted else phot_data.limit
 
     tns_report_form = TNSReportForm(initial=initial)
     return {'target': target,
@@ -94,13 +105,9 @@ def classify_with_tns(context):
         initial['classifier'] = classifier
 
     # Get the list of chocies for ascii and fits files for those fields
-    ascii_files = [(None, '')]
-    fits_files = [(None, '')]
-    for data_product in target.dataproduct_set.all():
-        if data_product.get_file_extension().lower() in ['.ascii', '.txt']:
-            ascii_files.append((data_product.pk, data_product.get_file_name()))
-        elif data_product.get_file_extension().lower() in ['.fits', '.fits.fz']:
-            fits_files.append((data_product.pk, data_product.get_file_name()))
+    ascii_files, fits_files = spectrum_file_choices(target)
+    ascii_files = [(None, '')] + ascii_files
+    fits_files = [(None, '')] + fits_files
     initial['ascii_file_choices'] = ascii_files
     initial['fits_file_choices'] = fits_files
 
@@ -125,9 +132,47 @@ def classify_with_tns(context):
                 initial['instrument'] = (TNS_INSTRUMENT_IDS[instrument_name], instrument_name)
         initial['telescope'] = spectra_data.telescope
 
-        if spectra_data.data_product and spectra_data.data_product.get_file_extension().lower() in ['.ascii', '.txt']:
-            initial['ascii_file'] = (spectra_data.data_product.pk, spectra_data.data_product.get_file_name())
+        data_product = spectra_data.data_product
+        extension = data_product.get_file_extension().lower() if data_product else ''
+        if extension in ASCII_EXTENSIONS:
+            initial['ascii_file'] = (data_product.pk, data_product.get_file_name())
+        # Without an ASCII file, default to one converted from the FITS file or generated from the reduced spectrum
+        elif extension in FITS_EXTENSIONS:
+            initial['ascii_file'] = f'{FITS_CHOICE_PREFIX}{data_product.pk}'
+        else:
+            initial['ascii_file'] = f'{DATUM_CHOICE_PREFIX}{spectra_data.pk}'
 
     tns_classify_form = TNSClassifyForm(initial=initial)
     return {'target': target,
             'form': tns_classify_form}
+
+
+@register.simple_tag
+def tns_statuses(targets):
+    """
+    Determine the TNS status of a whole list of targets (e.g. a page of the target list) in one query.
+    Use together with `tns_status_badge`:
+
+    {% tns_statuses target_list as statuses %}
+    {% for target in target_list %} {% tns_status_badge target statuses %} {% endfor %}
+    """
+    return get_tns_statuses(targets)
+
+
+@register.inclusion_tag('tom_tns/partials/tns_status_badge.html')
+def tns_status_badge(target, statuses=None):
+    """
+    Render a TNS status badge for a target, using the statuses from `tns_statuses` if given.
+    """
+    if statuses is None:
+        statuses = get_tns_statuses([target])
+    status = statuses.get(target.pk, TNS_STATUS_UNREPORTED)
+    badge_classes = {
+        TNS_STATUS_UNREPORTED: 'bg-secondary',
+        TNS_STATUS_SUBMITTED: 'bg-warning',
+        TNS_STATUS_REPORTED: 'bg-info',
+        TNS_STATUS_CLASSIFIED: 'bg-success',
+    }
+    return {'status': status,
+            'label': TNS_STATUS_LABELS[status],
+            'badge_class': badge_classes[status]}
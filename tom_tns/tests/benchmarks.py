@@ -0,0 +1,184 @@
+# benchmarks.py
+#
+# Microbenchmarks for building and rendering the TNS forms and reports.
+# Run with run_benchmarks.py, which sets up Django and a test database first.
+
+import platform
+import statistics
+import timeit
+from datetime import datetime, timedelta, timezone
+from unittest.mock import patch
+
+import django
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.template import Context, Template
+from django.test import Client, RequestFactory, override_settings
+
+from tom_dataproducts.models import PhotometryReducedDatum, SpectroscopyReducedDatum
+from tom_targets.models import Target
+
+from tom_tns import __version__
+
+
+BENCHMARK_DATA_SERVICES = {
+    'TNS': {
+        'api_key': 'benchmark', 'bot_id': 1, 'bot_name': 'benchmark', 'base_url': 'https://sandbox.wis-tns.org/',
+        'group_names': ['Group 1', 'Group 2'],
+    }
+}
+
+
+def build_tns_values(n_instruments=500, n_groups=800):
+    """
+    A realistic sized set of TNS option values, as returned by `api/get/values/`.
+    """
+    return {
+        'groups': {str(i): f'Group {i}' for i in range(n_groups)} | {str(n_groups): 'None'},
+        'instruments': {str(i): f'Telescope {i // 3} - Instrument {i}' for i in range(n_instruments)},
+        'filters': {str(i): f'Filter {i}' for i in range(150)} | {'22': 'r-Sloan'},
+        'units': {'1': 'ABMag', '2': 'VegaMag', '3': 'erg cm(-2) sec(-1) A(-1)', '4': 'mJy'},
+        'at_types': ['Other', 'PSN - Possible SN', 'PNV - Possible Nova', 'AGN - Known AGN', 'NUC - Nuclear',
+                     'FRB - Fast Radio Burst'],
+        'objtypes': {str(i): f'Object type {i}' for i in range(1, 150)},
+        'spectra_types': {str(i): f'Spectrum type {i}' for i in range(1, 6)},
+        'archives': {str(i): f'Archive {i}' for i in range(20)},
+    }
+
+
+def prime_tns_values(tns_values):
+    """ Put the TNS values in the cache, as populate_tns_values would after a successful request
+    """
+    from tom_tns.tns_api import reverse_tns_values
+    cache.set('all_tns_values', tns_values, None)
+    cache.set('reverse_tns_values', reverse_tns_values(tns_values), None)
+
+
+def create_target(n_photometry=5000, n_spectra=20, spectrum_length=4000):
+    """ Create a Target with a large light curve and a set of spectra
+    """
+    target = Target.objects.create(name='benchmark_target', type=Target.SIDEREAL, ra=123.4, dec=-45.6)
+    start = datetime(2024, 1, 1, tzinfo=timezone.utc)
+    PhotometryReducedDatum.objects.bulk_create([
+        PhotometryReducedDatum(target=target, timestamp=start + timedelta(hours=i), brightness=18 + (i % 100) / 50,
+                               brightness_error=0.05, bandpass='r', instrument=f'Instrument {i % 7}',
+                               telescope='Telescope 1', exposure_time=60)
+        for i in range(n_photometry)
+    ])
+    wavelength = [3500 + i for i in range(spectrum_length)]
+    SpectroscopyReducedDatum.objects.bulk_create([
+        SpectroscopyReducedDatum(target=target, timestamp=start + timedelta(days=i), wavelength=wavelength,
+                                 flux=[1e-16] * spectrum_length, instrument='Instrument 1', telescope='Telescope 1')
+        for i in range(n_spectra)
+    ])
+    return target
+
+
+def report_form_data():
+    return {
+        'object_name': 'benchmark_target', 'internal_name': 'benchmark_target', 'ra': 123.4, 'dec': -45.6,
+        'reporting_group': '1', 'discovery_data_source': '1', 'reporter': 'A. Person',
+        'discovery_date': '2024-01-02 00:00:00', 'at_type': '1', 'archive': '0', 'archival_remarks': 'None',
+        'observation_date': '2024-01-02 00:00:00', 'flux': 18.5, 'flux_error': 0.05, 'flux_units': '1',
+        'filter': '22', 'instrument': '0', 'limiting_flux': 21.0, 'exposure_time': 60, 'observer': 'Robot',
+    }
+
+
+def classify_form_data():
+    return {
+        'object_name': '2024abc', 'ra': 123.4, 'dec': -45.6, 'classifier': 'A. Person', 'classification': '1',
+        'redshift': 0.05, 'reporting_group': '1', 'observation_date': '2024-01-02 00:00:00', 'instrument': '0',
+        'exposure_time': 600, 'observer': 'Robot', 'reducer': 'Robot', 'spectrum_type': '1',
+    }
+
+
+def time_call(function, number, repeat):
+    """ Time `function` and return statistics for a single call in milliseconds
+    """
+    timings = [total / number * 1000 for total in timeit.Timer(function).repeat(repeat=repeat, number=number)]
+    return {'min_ms': min(timings), 'median_ms': statistics.median(timings), 'number': number, 'repeat': repeat}
+
+
+@override_settings(DATA_SERVICES=BENCHMARK_DATA_SERVICES)
+def run_benchmarks(number=10, repeat=5, n_instruments=500, n_groups=800, n_photometry=5000):
+    """
+    Run all benchmarks against a freshly created test database.
+    Returns a JSON-serializable dictionary of results keyed by benchmark name.
+    """
+    tns_values = build_tns_values(n_instruments, n_groups)
+    prime_tns_values(tns_values)
+    # Import after the values are cached: tns_extras reads them when it is imported
+    from tom_tns.forms import TNSReportForm, TNSClassifyForm
+    from tom_tns.tns_api import reverse_tns_values
+    from tom_tns.reports import dumps_tns_report
+    from tom_tns.spectra import spectrum_ascii
+    from tom_tns.validation import validate_tns_report
+
+    target = create_target(n_photometry=n_photometry)
+    user = User.objects.create(username='benchmark', email='benchmark@example.com', is_superuser=True)
+    request = RequestFactory().get('/')
+    request.user = user
+    spectrum = SpectroscopyReducedDatum.objects.filter(target=target).first()
+    choices = {'ascii_file_choices': [(None, '')], 'fits_file_choices': [(None, '')]}
+
+    report_form = TNSReportForm(data=report_form_data())
+    assert report_form.is_valid(), report_form.errors
+    tns_report = report_form.generate_tns_report()
+    classify_form = TNSClassifyForm(
+        data=classify_form_data(), initial=choices,
+        files={'ascii_file_override': SimpleUploadedFile('spectrum.txt', b'3500 1e-16\n')})
+    assert classify_form.is_valid(), classify_form.errors
+
+    report_template = Template('{% load tns_extras %}{% report_to_tns %}')
+    classify_template = Template('{% load tns_extras %}{% classify_with_tns %}')
+    template_context = {'target': target, 'request': request, 'csrf_token': 'benchmark'}
+    client = Client()
+    client.force_login(user)
+    assert client.get(f'/tns/{target.pk}/').status_code == 200
+
+    benchmarks = {
+        'report_form_construction': lambda: TNSReportForm(initial={}),
+        'classify_form_construction': lambda: TNSClassifyForm(initial=choices),
+        'reverse_tns_values': lambda: reverse_tns_values(tns_values),
+        'generate_tns_report': report_form.generate_tns_report,
+        'generate_hermes_report': report_form.generate_hermes_report,
+        'validate_tns_report': lambda: validate_tns_report(tns_report),
+        'dumps_tns_report': lambda: dumps_tns_report([report_form.to_report()]),
+        'spectrum_ascii': lambda: spectrum_ascii(spectrum.wavelength, spectrum.flux),
+        'generate_tns_classification_report': classify_form.generate_tns_report,
+        'generate_hermes_classification_report': classify_form.generate_hermes_report,
+        'render_report_to_tns': lambda: report_template.render(Context(template_context)),
+        'render_classify_with_tns': lambda: classify_template.render(Context(template_context)),
+        'render_tns_report_page': lambda: client.get(f'/tns/{target.pk}/'),
+    }
+    results = {}
+    # Don't send anything to the TNS when generating the classification report
+    with patch('tom_tns.forms.pre_upload_files_to_tns', return_value={'ascii_file': 'spectrum.txt'}):
+        for name, function in benchmarks.items():
+            results[name] = time_call(function, number, repeat)
+    return {
+        'meta': {
+            'tom_tns': __version__,
+            'python': platform.python_version(),
+            'django': django.get_version(),
+            'date': datetime.now(timezone.utc).isoformat(),
+            'parameters': {'number': number, 'repeat': repeat, 'n_instruments': n_instruments,
+                           'n_groups': n_groups, 'n_photometry': n_photometry},
+        },
+        'results': results,
+    }
+
+
+def compare_results(results, baseline, tolerance=0.5):
+    """
+    Compare benchmark results with a baseline from a previous run.
+    Returns a list of (name, baseline median ms, new median ms) for each benchmark whose median is more than
+    `tolerance` (as a fraction) slower than the baseline.
+    """
+    regressions = []
+    for name, result in results['results'].items():
+        previous = baseline.get('results', {}).get(name)
+        if previous and result['median_ms'] > previous['median_ms'] * (1 + tolerance):
+            regressions.append((name, previous['median_ms'], result['median_ms']))
+    return regressions
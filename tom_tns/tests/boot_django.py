@@ -4,6 +4,7 @@
 # execute as if running in a Django server.
 
 import os
+import tempfile
 import django
 from django.conf import settings
 from tom_common.default_settings import TOMTOOKIT_INSTALLED_APPS, TOMTOOKIT_MIDDLEWARE
@@ -21,6 +22,10 @@ def boot_django():
             'default': {
                 'ENGINE': 'django.db.backends.sqlite3',
                 'NAME': os.path.join(BASE_DIR, 'db.sqlite3'),
+                # Concurrent transactions wait for each other (see TestConcurrentClaims), which they can't do in the
+                # default shared in-memory test database
+                'OPTIONS': {'transaction_mode': 'IMMEDIATE', 'timeout': 20},
+                'TEST': {'NAME': os.path.join(tempfile.gettempdir(), 'tom_tns_test.sqlite3')},
             }
         },
         TOM_NAME='Test TOM',
@@ -56,6 +61,8 @@ def boot_django():
             'guardian.backends.ObjectPermissionBackend',
         ),
         AUTH_STRATEGY='READ_ONLY',
+        CRISPY_TEMPLATE_PACK='bootstrap5',
+        CRISPY_ALLOWED_TEMPLATE_PACKS='bootstrap5',
         ROOT_URLCONF='tom_common.urls',
         STATIC_URL='/static/',
         STATIC_ROOT=os.path.join(BASE_DIR, '_static'),
@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+# load_test.py
+#
+# Drive concurrent TNS report submissions through TNSSubmitView against the local TNS stand-in server and report
+# throughput and latency percentiles, e.g.
+#   python tom_tns/tests/load_test.py --submissions 200 --concurrency 16 --latency 0.2 --processing-seconds 2
+import argparse
+import json
+import os
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from boot_django import boot_django
+
+boot_django()
+
+from django.contrib.auth.models import User  # noqa: E402
+from django.core.cache import cache  # noqa: E402
+from django.db import connection, connections  # noqa: E402
+from django.test import Client, override_settings  # noqa: E402
+from django.test.utils import setup_test_environment, teardown_test_environment  # noqa: E402
+
+from tom_targets.models import Target  # noqa: E402
+
+from standin_server import StandInConfig, start_server  # noqa: E402
+
+
+def report_data(target):
+    return {
+        'object_name': target.name, 'internal_name': target.name, 'ra': target.ra, 'dec': target.dec,
+        'reporting_group': '1', 'discovery_data_source': '1', 'reporter': 'Load Test',
+        'discovery_date': '2024-01-02 00:00:00', 'at_type': '1', 'archive': '0', 'archival_remarks': 'None',
+        'observation_date': '2024-01-02 00:00:00', 'flux': 18.5, 'flux_error': 0.05, 'flux_units': '1',
+        'filter': '22', 'instrument': '0',
+    }
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(fraction * (len(values) - 1))))]
+
+
+def run_load_test(base_url, submissions, concurrency, poll_delay):
+    """
+    Submit `submissions` AT reports with `concurrency` concurrent clients, each for its own Target.
+    Returns a JSON-serializable summary of throughput and latencies in seconds.
+    """
+    tns_settings = {'TNS': {'api_key': 'load-test', 'bot_id': 1, 'bot_name': 'load_test', 'base_url': base_url,
+                            'group_names': ['Test TOM'], 'report_delay_seconds': poll_delay,
+                            'report_max_attempts': 1000}}
+    with override_settings(DATA_SERVICES=tns_settings):
+        cache.clear()
+        user = User.objects.create(username='load_test', email='load@example.com', is_superuser=True)
+        targets = [Target.objects.create(name=f'load_test_{i}', type=Target.SIDEREAL, ra=i % 360, dec=0)
+                   for i in range(submissions)]
+        local = threading.local()
+        latencies = []
+        failures = []
+        lock = threading.Lock()
+
+        def submit(target):
+            if not hasattr(local, 'client'):
+                local.client = Client()
+                local.client.force_login(user)
+            start = time.perf_counter()
+            response = local.client.post(f'/tns/{target.pk}/report', report_data(target))
+            elapsed = time.perf_counter() - start
+            renamed = Target.objects.filter(pk=target.pk, name__startswith='AT').exists()
+            with lock:
+                latencies.append(elapsed)
+                if response.status_code != 302 or not renamed:
+                    failures.append(target.pk)
+            connections.close_all()
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            list(executor.map(submit, targets))
+        duration = time.perf_counter() - start
+
+    return {
+        'submissions': submissions,
+        'concurrency': concurrency,
+        'failures': len(failures),
+        'duration': duration,
+        'throughput_per_second': submissions / duration,
+        'latency': {
+            'mean': statistics.mean(latencies),
+            'p50': percentile(latencies, 0.5),
+            'p99': percentile(latencies, 0.99),
+            'max': max(latencies),
+        },
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load test TNS submissions against the local TNS stand-in')
+    parser.add_argument('--submissions', type=int, default=50)
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--poll-delay', type=float, default=0.5, help='Seconds between report reply polls')
+    parser.add_argument('--base-url', help='Use an already running stand-in server instead of starting one')
+    parser.add_argument('--latency', type=float, default=StandInConfig.latency)
+    parser.add_argument('--latency-jitter', type=float, default=StandInConfig.latency_jitter)
+    parser.add_argument('--processing-seconds', type=float, default=StandInConfig.processing_seconds)
+    parser.add_argument('--error-rate', type=float, default=StandInConfig.error_rate)
+    parser.add_argument('--rate-limit', type=int, default=StandInConfig.rate_limit)
+    parser.add_argument('--rate-limit-window', type=float, default=StandInConfig.rate_limit_window)
+    parser.add_argument('--output', help='File to write the JSON results to (Defaults to stdout)')
+    args = parser.parse_args()
+
+    server = None
+    base_url = args.base_url
+    if not base_url:
+        config = StandInConfig(latency=args.latency, latency_jitter=args.latency_jitter,
+                               processing_seconds=args.processing_seconds, error_rate=args.error_rate,
+                               rate_limit=args.rate_limit, rate_limit_window=args.rate_limit_window)
+        server = start_server(config)
+        base_url = f'http://127.0.0.1:{server.server_port}/'
+
+    # Concurrent clients need a database on disk rather than the default in-memory test database, and SQLite
+    # transactions must take their write lock up front to wait for each other rather than fail
+    db_dir = tempfile.mkdtemp()
+    connection.settings_dict['TEST']['NAME'] = os.path.join(db_dir, 'load_test.sqlite3')
+    connection.settings_dict['OPTIONS'].update({'timeout': 60, 'transaction_mode': 'IMMEDIATE'})
+    setup_test_environment()
+    old_name = connection.creation.create_test_db(verbosity=0)
+    try:
+        results = run_load_test(base_url, args.submissions, args.concurrency, args.poll_delay)
+    finally:
+        connections.close_all()
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+        teardown_test_environment()
+        if server:
+            server.shutdown()
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+    if results['failures']:
+        print(f'{results["failures"]} submissions failed', file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
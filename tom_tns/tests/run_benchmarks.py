@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+# run_benchmarks.py
+#
+# Run the tom_tns microbenchmarks and write the results as JSON, e.g.
+#   python tom_tns/tests/run_benchmarks.py --output benchmarks.json --compare baseline.json
+import argparse
+import json
+import sys
+
+from boot_django import boot_django
+
+boot_django()
+
+from django.db import connection  # noqa: E402
+from django.test.utils import setup_test_environment, teardown_test_environment  # noqa: E402
+
+from benchmarks import run_benchmarks, compare_results  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run the tom_tns microbenchmarks')
+    parser.add_argument('--output', help='File to write the JSON results to (Defaults to stdout)')
+    parser.add_argument('--compare', help='JSON results of a previous run to check for regressions against')
+    parser.add_argument('--tolerance', type=float, default=0.5,
+                        help='Fraction a median may be slower than the baseline before failing (Defaults to 0.5)')
+    parser.add_argument('--number', type=int, default=10, help='Calls per timing run')
+    parser.add_argument('--repeat', type=int, default=5, help='Number of timing runs')
+    args = parser.parse_args()
+
+    setup_test_environment()
+    old_name = connection.creation.create_test_db(verbosity=0)
+    try:
+        results = run_benchmarks(number=args.number, repeat=args.repeat)
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+        teardown_test_environment()
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+    for name, result in results['results'].items():
+        print(f'{name:40s} {result["median_ms"]:10.3f} ms', file=sys.stderr)
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare_results(results, json.load(f), args.tolerance)
+        for name, before, after in regressions:
+            print(f'REGRESSION {name}: {before:.3f} ms -> {after:.3f} ms', file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,217 @@
+#!/usr/bin/env python
+# standin_server.py
+#
+# A local stand-in for the TNS and Hermes APIs used by tom_tns, for load testing submissions without touching the
+# real TNS sandbox. Latency, the window during which reports are still "processing" (404 replies), error rates and
+# rate limits are configurable. Run standalone with e.g.
+#   python tom_tns/tests/standin_server.py --port 8123 --latency 0.2 --processing-seconds 2 --error-rate 0.01
+# and point `base_url` in your TNS settings (or `BASE_URL` in your Hermes settings) at http://localhost:8123/
+
+import argparse
+import hashlib
+import itertools
+import json
+import random
+import re
+import threading
+import time
+import uuid
+from dataclasses import dataclass
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+
+@dataclass
+class StandInConfig:
+    latency: float = 0.05  # seconds added to every response
+    latency_jitter: float = 0.0  # up to this many seconds are randomly added to the latency
+    processing_seconds: float = 1.0  # bulk report replies return 404 for this long after submission
+    error_rate: float = 0.0  # fraction of requests answered with a 500 error
+    rate_limit: int = 0  # requests allowed per rate limit window (0 for no limit)
+    rate_limit_window: float = 60.0  # seconds
+    etags: bool = True  # whether the option values are served with an ETag, and answer If-None-Match with 304
+
+
+def standin_tns_values():
+    """ A small but complete set of TNS option values
+    """
+    return {
+        'groups': {'0': 'None', '1': 'Test TOM', '2': 'Other Group'},
+        'instruments': {'0': 'Other', '1': 'LCO1m - Sinistro', '2': 'LCO2m - FLOYDS'},
+        'filters': {'0': 'Other', '21': 'g-Sloan', '22': 'r-Sloan'},
+        'units': {'1': 'ABMag', '2': 'VegaMag', '4': 'mJy'},
+        'at_types': ['Other', 'PSN - Possible SN', 'PNV - Possible Nova'],
+        'objtypes': {'0': 'Other', '1': 'SN', '3': 'SN Ia'},
+        'spectra_types': {'1': 'Object', '2': 'Host', '3': 'Sky'},
+        'archives': {'0': 'Other', '1': 'SDSS', '2': 'DSS'},
+    }
+
+
+class StandInState:
+    """ State shared by all request handler threads of a stand-in server
+    """
+    def __init__(self, config):
+        self.config = config
+        self.lock = threading.Lock()
+        self.report_ids = itertools.count(1)
+        self.object_names = itertools.count(1)
+        self.reports = {}
+        self.window_start = time.monotonic()
+        self.window_requests = 0
+        self.request_count = 0
+
+    def take_rate_limit(self):
+        """ Count a request against the rate limit. Returns (allowed, remaining, seconds until reset)
+        """
+        with self.lock:
+            self.request_count += 1
+            now = time.monotonic()
+            if now - self.window_start >= self.config.rate_limit_window:
+                self.window_start = now
+                self.window_requests = 0
+            self.window_requests += 1
+            reset = self.config.rate_limit_window - (now - self.window_start)
+            if not self.config.rate_limit:
+                return True, None, reset
+            remaining = self.config.rate_limit - self.window_requests
+            return remaining >= 0, max(remaining, 0), reset
+
+    def new_report(self):
+        with self.lock:
+            report_id = next(self.report_ids)
+            self.reports[report_id] = (time.monotonic(), f'2024{next(self.object_names):05d}')
+        return report_id
+
+    def new_object_name(self):
+        with self.lock:
+            return f'2024{next(self.object_names):05d}'
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    state = None  # set on the subclass created by `make_server`
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status, payload, headers=None):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_empty(self, status, headers=None):
+        self.send_response(status)
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+
+    def read_body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        return self.rfile.read(length) if length else b''
+
+    def form_data(self, body):
+        if self.headers.get('Content-Type', '').startswith('application/x-www-form-urlencoded'):
+            return {key: values[0] for key, values in parse_qs(body.decode()).items()}
+        return {}
+
+    def handle_request(self):
+        body = self.read_body()
+        config = self.state.config
+        time.sleep(config.latency + random.uniform(0, config.latency_jitter))
+        allowed, remaining, reset = self.state.take_rate_limit()
+        headers = {}
+        if remaining is not None:
+            headers = {'x-rate-limit-limit': str(config.rate_limit), 'x-rate-limit-remaining': str(remaining),
+                       'x-rate-limit-reset': str(int(reset))}
+        if not allowed:
+            return self.send_json(429, {'id_code': 429, 'id_message': 'Too Many Requests'}, headers)
+        if random.random() < config.error_rate:
+            return self.send_json(500, {'id_code': 500, 'id_message': 'Internal Server Error'}, headers)
+
+        path = urlparse(self.path).path
+        if path in ('/api/get/values/', '/api/v0/tns_options/'):
+            values = standin_tns_values()
+            payload = {'data': values} if path.startswith('/api/get') else values
+            if config.etags:
+                headers['ETag'] = f'"{hashlib.sha256(json.dumps(payload).encode()).hexdigest()[:16]}"'
+                if self.headers.get('If-None-Match') == headers['ETag']:
+                    return self.send_empty(304, headers)
+            return self.send_json(200, payload, headers)
+        if path == '/api/set/file-upload':
+            filenames = re.findall(rb'filename="([^"]+)"', body)
+            return self.send_json(200, {'data': [f'{int(time.time())}_{name.decode()}' for name in filenames]},
+                                  headers)
+        if path == '/api/set/bulk-report':
+            return self.send_json(200, {'data': {'report_id': self.state.new_report()}}, headers)
+        if path == '/api/get/bulk-report-reply':
+            report_id = int(self.form_data(body).get('report_id', 0))
+            submitted, objname = self.state.reports.get(report_id, (None, None))
+            if submitted is None:
+                return self.send_json(400, {'data': {'feedback': {'report_id': 'Unknown report'}}}, headers)
+            if time.monotonic() - submitted < config.processing_seconds:
+                return self.send_json(404, {'id_code': 404, 'id_message': 'Report not yet processed'}, headers)
+            feedback = {'at_report': [{'100': {'objname': objname, 'message': 'Transient object was inserted.'}}]}
+            return self.send_json(200, {'data': {'feedback': feedback}}, headers)
+        if path == '/api/v0/submit_message/':
+            # One TNS object per target of the message, which is JSON or the `data` field of a multipart form
+            match = re.search(rb'name="data"\r\n\r\n(.*?)\r\n--', body, re.DOTALL)
+            try:
+                targets = json.loads(match.group(1) if match else body).get('data', {}).get('targets', [])
+            except ValueError:
+                targets = []
+            references = [{'source': 'tns_object', 'citation': f'AT{self.state.new_object_name()}',
+                           **({'target_name': target['name']} if target else {})}
+                          for target in targets or [None]]
+            return self.send_json(200, {'uuid': str(uuid.uuid4()), 'data': {'references': references}}, headers)
+        return self.send_json(404, {'id_code': 404, 'id_message': f'Unknown endpoint {path}'}, headers)
+
+    do_GET = handle_request
+    do_POST = handle_request
+
+
+def make_server(config=None, host='127.0.0.1', port=0):
+    """
+    Create (but do not start) a stand-in server. Use port 0 to pick a free port; the chosen base URL is
+    `f'http://{host}:{server.server_port}/'`.
+    """
+    handler = type('ConfiguredStandInHandler', (StandInHandler,), {'state': StandInState(config or StandInConfig())})
+    return ThreadingHTTPServer((host, port), handler)
+
+
+def start_server(config=None, host='127.0.0.1', port=0):
+    """ Start a stand-in server on a background thread. Returns the server; call `server.shutdown()` to stop it.
+    """
+    server = make_server(config, host, port)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run a local stand-in for the TNS and Hermes APIs')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8123)
+    parser.add_argument('--latency', type=float, default=StandInConfig.latency)
+    parser.add_argument('--latency-jitter', type=float, default=StandInConfig.latency_jitter)
+    parser.add_argument('--processing-seconds', type=float, default=StandInConfig.processing_seconds)
+    parser.add_argument('--error-rate', type=float, default=StandInConfig.error_rate)
+    parser.add_argument('--rate-limit', type=int, default=StandInConfig.rate_limit)
+    parser.add_argument('--rate-limit-window', type=float, default=StandInConfig.rate_limit_window)
+    args = parser.parse_args()
+    config = StandInConfig(latency=args.latency, latency_jitter=args.latency_jitter,
+                           processing_seconds=args.processing_seconds, error_rate=args.error_rate,
+                           rate_limit=args.rate_limit, rate_limit_window=args.rate_limit_window)
+    server = make_server(config, args.host, args.port)
+    print(f'TNS/Hermes stand-in listening on http://{args.host}:{server.server_port}/')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,74 @@
-from django.test import TestCase
+import io
+import json
+import os
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from unittest.mock import Mock, patch
 
-# Create your tests here.
+import numpy as np
+import requests
+from astropy.io import fits
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.contrib.messages.storage.cookie import CookieStorage
+from django.core.files.base import ContentFile
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.http import HttpResponse
+from django.core.cache import cache
+from django.db import connection
+from django.test import RequestFactory, TestCase, TransactionTestCase, override_settings
+from django.urls import reverse
+from django.views.generic import View
+from guardian.shortcuts import assign_perm
+
+from tom_dataproducts.models import DataProduct, PhotometryReducedDatum, SpectroscopyReducedDatum
+from tom_targets.models import Target, TargetName
+
+from tom_tns import autoreport
+from tom_tns.autoreport import evaluate_auto_report_candidates, trigger_auto_report
+from tom_tns.catalog import (add_tns_aliases, apply_tns_catalog_file, crossmatch_targets, ingest_tns_catalog,
+                             pending_tns_deltas, read_tns_catalog, sync_tns_catalog)
+from tom_tns.followup import report_followup_photometry
+from tom_tns.forms import TNSClassifyForm
+from tom_tns.hermes_api import batch_hermes_messages, get_objects_from_response, submit_batch_to_hermes
+from tom_tns.ledger import DuplicateSubmission, start_submission, submission_hash
+from tom_tns.metrics import PrometheusSink
+from tom_tns.models import TNSAutoReportCandidate, TNSCatalogFile, TNSObject, TNSSubmission
+from tom_tns.profiling import ProfiledViewMixin
+from tom_tns.renaming import rename_targets
+from tom_tns.reports import (ATReport, Classification, NonDetection, PhotometryGroup, Spectrum, dumps_tns_report,
+                             option_labels, tns_bulk_report)
+from tom_tns.spectra import (ascii_spectrum_errors, fits_ascii_file, fits_spectrum_ascii, spectrum_ascii,
+                             spectrum_ascii_file, spectrum_datum_choices, spectrum_file_choices)
+from tom_tns.status import get_tns_statuses
+from tom_tns.replies import poll_report_reply, watch_report_reply
+from tom_tns.submissions import SENT_UNCONFIRMED, SubmissionWorker, process_submission, queue_report_reply
+from tom_tns.tracing import start_trace, trace_span
+from tom_tns.units import AB_MAG_MJY, convert_flux, normalize_unit, tns_unit_option
+from tom_tns.validation import ReportValidator
+from tom_tns.views import TNSSubmitView
+from tom_tns.tns_api import (get_tns_object, get_tns_objects, tns_objname, send_tns_report, get_tns_report_reply,
+                             get_tns_values, populate_tns_values, choose_tns_bot, get_tns_bots, get_tns_credentials,
+                             record_bot_quota, reverse_option_list, reverse_tns_values, search_tns, use_tns_bot)
+from tom_tns.tests.standin_server import StandInConfig, standin_tns_values, start_server
+
+
+TNS_CATALOG_HEADER = ('"objid","name_prefix","name","ra","declination","redshift","typeid","type",'
+                      '"reporting_groupid","reporting_group","source_groupid","source_group","discoverydate",'
+                      '"discoverymag","discmagfilter","filter","reporters","time_received","internal_names",'
+                      '"creationdate","lastmodified"')
+TNS_CATALOG_ROWS = [
+    '"1001","AT","2024abc","10.0","-20.0","","","","1","ZTF","1","ZTF","2024-04-01 01:02:03.456","19.1","1","g",'
+    '"A. Person","2024-04-01 02:00:00","ZTF24aaa","2024-04-01 02:00:00","2024-04-02 00:00:00"',
+    '"1002","SN","2024abd","150.0","45.0","0.05","1","SN Ia","2","ATLAS","2","ATLAS","2024-04-03 00:00:00","18.0",'
+    '"2","o","B. Person","2024-04-03 02:00:00","ATLAS24bbb","2024-04-03 02:00:00","2024-04-05 00:00:00"',
+]
+TNS_CATALOG_CSV = '\n'.join(['"2024-05-01 00:00:00"', TNS_CATALOG_HEADER] + TNS_CATALOG_ROWS).encode()
+
+TNS_SETTINGS = {'TNS': {'api_key': 'key', 'bot_id': 1, 'bot_name': 'bot', 'base_url': 'https://sandbox.wis-tns.org/'}}
 
 
 class TestDummy(TestCase):
@@ -10,3 +78,975 @@ class TestDummy(TestCase):
 
     def test_dummy(self):
         pass
+
+
+class TestCatalogCrossmatch(TestCase):
+    def setUp(self):
+        snapshot_time, tns_objects = read_tns_catalog(TNS_CATALOG_CSV)
+        self.snapshot_time = snapshot_time
+        ingest_tns_catalog(tns_objects)
+        self.near = Target.objects.create(name='near', type=Target.SIDEREAL, ra=10.0002, dec=-20.0001)
+        self.far = Target.objects.create(name='far', type=Target.SIDEREAL, ra=11.0, dec=-20.0)
+        self.sn = Target.objects.create(name='sn', type=Target.SIDEREAL, ra=150.0, dec=45.0)
+
+    def test_read_catalog(self):
+        self.assertEqual(self.snapshot_time.year, 2024)
+        self.assertEqual(TNSObject.objects.count(), 2)
+        self.assertEqual(TNSObject.objects.get(objid=1002).iau_name, 'SN2024abd')
+
+    def test_reingest_updates_rows(self):
+        _, tns_objects = read_tns_catalog(TNS_CATALOG_CSV.replace(b'"SN","2024abd"', b'"SN","2024abz"'))
+        ingest_tns_catalog(tns_objects)
+        self.assertEqual(TNSObject.objects.count(), 2)
+        self.assertEqual(TNSObject.objects.get(objid=1002).name, '2024abz')
+
+    def test_crossmatch(self):
+        matches = {target_id: name for target_id, name, _ in crossmatch_targets(radius=2.0)}
+        self.assertEqual(matches, {self.near.id: 'AT2024abc', self.sn.id: 'SN2024abd'})
+
+    def test_add_aliases_skips_existing_names(self):
+        TargetName.objects.create(target=self.sn, name='SN2024abd')
+        new_aliases = add_tns_aliases(crossmatch_targets(radius=2.0))
+        self.assertEqual([alias.name for alias in new_aliases], ['AT2024abc'])
+        self.assertIn('AT2024abc', self.near.names)
+
+
+class TestCatalogSync(TestCase):
+    def setUp(self):
+        apply_tns_catalog_file('tns_public_objects.csv.zip', TNS_CATALOG_CSV)
+
+    def test_pending_deltas(self):
+        last_sync = datetime(2024, 5, 1, tzinfo=timezone.utc)
+        now = datetime(2024, 5, 3, 2, 30, tzinfo=timezone.utc)
+        self.assertEqual([filename for filename, _ in pending_tns_deltas(last_sync, now)],
+                         ['tns_public_objects_20240501.csv.zip', 'tns_public_objects_20240502.csv.zip',
+                          'tns_public_objects_20240503_00.csv.zip', 'tns_public_objects_20240503_01.csv.zip'])
+        hourly_sync = datetime(2024, 5, 3, 1, tzinfo=timezone.utc)
+        self.assertEqual([filename for filename, _ in pending_tns_deltas(hourly_sync, now)],
+                         ['tns_public_objects_20240503_01.csv.zip'])
+
+    def test_sync_applies_deltas(self):
+        delta = '\n'.join([TNS_CATALOG_HEADER, TNS_CATALOG_ROWS[1].replace('"150.0","45.0"', '"151.0","-45.0"')])
+        now = datetime(2024, 5, 1, 1, 30, tzinfo=timezone.utc)
+        with patch('tom_tns.catalog.download_tns_catalog', return_value=delta.encode()) as download:
+            applied = sync_tns_catalog(now)
+        download.assert_called_once_with('tns_public_objects_20240501_00.csv.zip')
+        self.assertEqual(len(applied), 1)
+        self.assertEqual(TNSCatalogFile.objects.latest().snapshot_time, datetime(2024, 5, 1, 1, tzinfo=timezone.utc))
+        tns_object = TNSObject.objects.get(objid=1002)
+        self.assertEqual((tns_object.dec, tns_object.dec_zone), (-45.0, 45))
+        self.assertEqual(TNSObject.objects.count(), 2)
+
+
+@override_settings(DATA_SERVICES=TNS_SETTINGS)
+class TestTNSObjectLookup(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.calls = []
+
+    def fake_tns_get(self, endpoint, data):
+        self.calls.append(data['objname'])
+        time.sleep(0.05)
+        if data['objname'] == '2024abc':
+            return {'objname': '2024abc', 'name_prefix': 'AT', 'object_type': {'name': None}}
+        return {}
+
+    def test_objname(self):
+        self.assertEqual(tns_objname('AT 2024abc'), '2024abc')
+        self.assertEqual(tns_objname('SN2024abc'), '2024abc')
+        self.assertEqual(tns_objname('2024abc'), '2024abc')
+
+    def test_lookup_is_cached(self):
+        with patch('tom_tns.tns_api._tns_get', side_effect=self.fake_tns_get):
+            self.assertEqual(get_tns_object('AT2024abc')['objname'], '2024abc')
+            self.assertEqual(get_tns_object('2024abc')['objname'], '2024abc')
+            self.assertIsNone(get_tns_object('AT2024zzz'))
+            self.assertIsNone(get_tns_object('AT2024zzz'))
+        self.assertEqual(self.calls, ['2024abc', '2024zzz'])
+
+    def test_lookups_time_out(self):
+        response = Mock(status_code=200, headers={}, json=Mock(return_value={'data': {'reply': {}}}))
+        with patch('tom_tns.tns_api.requests.post', return_value=response) as post:
+            get_tns_object('AT2024abc')
+            with override_settings(DATA_SERVICES={'TNS': {**TNS_SETTINGS['TNS'], 'lookup_timeout': 2}}):
+                get_tns_object('AT2024abd')
+        self.assertEqual([call.kwargs['timeout'] for call in post.call_args_list], [10, 2])
+
+    def test_concurrent_lookups_are_coalesced(self):
+        with patch('tom_tns.tns_api._tns_get', side_effect=self.fake_tns_get):
+            threads = [threading.Thread(target=get_tns_object, args=('AT2024abc',)) for _ in range(5)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        self.assertEqual(self.calls, ['2024abc'])
+
+    def test_searches_are_cached_for_the_unclassified_ttl(self):
+        matches = [{'objname': '2024abc', 'prefix': 'AT', 'objid': 1001}]
+        with patch('tom_tns.tns_api._tns_get', return_value=matches), \
+                patch('tom_tns.tns_api.cache.set') as cache_set:
+            self.assertEqual(search_tns(internal_name='ZTF24aaa'), matches)
+            with override_settings(DATA_SERVICES={'TNS': {**TNS_SETTINGS['TNS'],
+                                                          'object_cache_ttl': {'unclassified': 600}}}):
+                search_tns(internal_name='ZTF24aab')
+        self.assertEqual([call.args[2] for call in cache_set.call_args_list], [3600, 600])
+
+    def test_batch_lookup(self):
+        with patch('tom_tns.tns_api._tns_get', side_effect=self.fake_tns_get):
+            get_tns_object('AT2024abc')
+            results = get_tns_objects(['AT2024abc', 'AT2024zzz', 'AT2024yyy'], max_workers=2)
+        self.assertEqual(results['AT2024abc']['objname'], '2024abc')
+        self.assertIsNone(results['AT2024zzz'])
+        self.assertEqual(sorted(self.calls), ['2024abc', '2024yyy', '2024zzz'])
+
+
+class TestTNSStatuses(TestCase):
+    def test_statuses_in_one_query(self):
+        unreported = Target.objects.create(name='ZTF24aaa', type=Target.SIDEREAL, ra=1, dec=1)
+        reported = Target.objects.create(name='ZTF24aab', type=Target.SIDEREAL, ra=2, dec=2)
+        TargetName.objects.create(target=reported, name='AT2024abc')
+        classified = Target.objects.create(name='SN2024abd', type=Target.SIDEREAL, ra=3, dec=3)
+        TargetName.objects.create(target=classified, name='AT2024abd')
+        queued = Target.objects.create(name='ZTF24aac', type=Target.SIDEREAL, ra=4, dec=4)
+        TNSSubmission.objects.create(target=queued, payload={})
+        TNSSubmission.objects.create(target=unreported, payload={}, status=TNSSubmission.STATUS_FAILED)
+        # Survey names starting with AT or SN are not IAU designations
+        atlas = Target.objects.create(name='ATLAS24abc', type=Target.SIDEREAL, ra=5, dec=5)
+        TargetName.objects.create(target=atlas, name='SNAD123')
+        with self.assertNumQueries(1):
+            statuses = get_tns_statuses([unreported, reported, classified, queued, atlas])
+        self.assertEqual(statuses, {unreported.pk: 'unreported', reported.pk: 'reported', classified.pk: 'classified',
+                                    queued.pk: 'submitted', atlas.pk: 'unreported'})
+        TargetName.objects.create(target=atlas, name='AT 2024xyz')
+        self.assertEqual(get_tns_statuses([atlas]), {atlas.pk: 'reported'})
+        TNSSubmission.objects.filter(target=queued).update(status=TNSSubmission.STATUS_SUCCEEDED)
+        self.assertEqual(get_tns_statuses([queued]), {queued.pk: 'reported'})
+
+
+class TestRenameTargets(TestCase):
+    def setUp(self):
+        self.first = Target.objects.create(name='ZTF24aaa', type=Target.SIDEREAL, ra=1, dec=1)
+        self.second = Target.objects.create(name='ZTF24aab', type=Target.SIDEREAL, ra=2, dec=2)
+        TargetName.objects.create(target=self.second, name='AT2024abd')
+
+    def test_rename_with_aliases(self):
+        with patch('tom_tns.renaming.run_hook') as run_hook:
+            renamed = rename_targets({self.first: 'AT2024abc', self.second.pk: 'AT2024abd'})
+        self.assertEqual(len(renamed), 2)
+        self.assertEqual(run_hook.call_count, 2)
+        self.first.refresh_from_db()
+        self.second.refresh_from_db()
+        self.assertEqual(self.first.names, ['AT2024abc', 'ZTF24aaa'])
+        self.assertEqual(self.second.names, ['AT2024abd', 'ZTF24aab'])
+
+    def test_rename_is_idempotent(self):
+        rename_targets({self.first: 'AT2024abc'}, run_hooks=False)
+        self.assertEqual(rename_targets({self.first: 'AT2024abc'}, run_hooks=False), [])
+        self.assertEqual(TargetName.objects.filter(target=self.first).count(), 1)
+
+    def test_rename_skips_taken_names(self):
+        self.assertEqual(rename_targets({self.first: 'ZTF24aab'}, run_hooks=False), [])
+        self.first.refresh_from_db()
+        self.assertEqual(self.first.name, 'ZTF24aaa')
+
+        # Targets given the same name in one batch are skipped, and the rest of the batch is renamed
+        third = Target.objects.create(name='ZTF24aac', type=Target.SIDEREAL, ra=3, dec=3)
+        renamed = rename_targets({self.first: 'AT2024abc', self.second: 'AT2024abc', third: 'AT2024abe'},
+                                 run_hooks=False)
+        self.assertEqual([target.name for target in renamed], ['AT2024abe'])
+        self.assertEqual(Target.objects.filter(name='AT2024abc').count(), 0)
+
+
+class TestMetrics(TestCase):
+    def test_prometheus_render(self):
+        sink = PrometheusSink()
+        sink.increment('tom_tns_responses_total', {'endpoint': 'bulk-report', 'status': 200})
+        sink.increment('tom_tns_responses_total', {'endpoint': 'bulk-report', 'status': 200})
+        sink.observe('tom_tns_request_seconds', {'endpoint': 'bulk-report'}, 0.3)
+        sink.observe('tom_tns_request_seconds', {'endpoint': 'bulk-report'}, 100)
+        text = sink.render()
+        self.assertIn('tom_tns_responses_total{endpoint="bulk-report",status="200"} 2', text)
+        self.assertIn('tom_tns_request_seconds_bucket{endpoint="bulk-report",le="0.25"} 0', text)
+        self.assertIn('tom_tns_request_seconds_bucket{endpoint="bulk-report",le="0.5"} 1', text)
+        self.assertIn('tom_tns_request_seconds_bucket{endpoint="bulk-report",le="+Inf"} 2', text)
+        self.assertIn('tom_tns_request_seconds_count{endpoint="bulk-report"} 2', text)
+
+    def test_metrics_view_requires_staff(self):
+        self.client.force_login(User.objects.create(username='user'))
+        # The TOM turns 403 responses into a redirect to the login page
+        self.assertTrue(self.client.get(reverse('tns:metrics')).url.startswith(reverse('login')))
+        self.client.force_login(User.objects.create(username='staff', is_staff=True))
+        response = self.client.get(reverse('tns:metrics'))
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'# TYPE tom_tns_request_seconds histogram', response.content)
+
+
+class TestTracing(TestCase):
+    def test_trace_is_exported_with_spans(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            trace_file = os.path.join(tmp_dir, 'traces.jsonl')
+            with override_settings(DATA_SERVICES={'TNS': {'trace_file': trace_file}}):
+                with start_trace('tns_submission', target_id=1):
+                    with trace_span('send_tns_report'):
+                        with trace_span('bulk-report') as span:
+                            span['status'] = 200
+                        time.sleep(0.01)
+            with open(trace_file) as f:
+                trace = json.loads(f.readline())
+        self.assertEqual(trace['attributes'], {'target_id': 1})
+        self.assertEqual([(span['name'], span['parent']) for span in trace['spans']],
+                         [('send_tns_report', None), ('bulk-report', 'send_tns_report')])
+        self.assertEqual(trace['spans'][1]['attributes'], {'status': 200})
+        self.assertGreaterEqual(trace['spans'][0]['duration'], 0.01)
+
+    def test_spans_without_trace_are_noops(self):
+        with trace_span('send_tns_report') as span:
+            span['status'] = 200
+
+
+class ProfiledView(ProfiledViewMixin, View):
+    def get(self, request):
+        cache.get('profiled')
+        return HttpResponse(str(Target.objects.count()))
+
+
+class TestProfiling(TestCase):
+    def profile(self, query, is_staff=True):
+        request = RequestFactory().get('/', query)
+        request.user = User.objects.get_or_create(username='staff' if is_staff else 'user', is_staff=is_staff)[0]
+        request._messages = CookieStorage(request)
+        return request, ProfiledView.as_view()(request)
+
+    def test_profile_flag(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            with override_settings(DATA_SERVICES={'TNS': {'profile_dir': tmp_dir}}):
+                request, response = self.profile({})
+                self.assertNotIn('X-TNS-Profile', response)
+                request, response = self.profile({'tns_profile': 1})
+            self.assertEqual(len(os.listdir(tmp_dir)), 1)
+        self.assertRegex(response['X-TNS-Profile'],
+                         r'^ProfiledView took .*s: [1-9]\d* DB queries .*, 1 cache calls .*, 0 TNS/Hermes requests')
+        self.assertIn(response['X-TNS-Profile'], str(list(request._messages)[0]))
+
+    def test_profiling_is_not_concurrent(self):
+        with tempfile.TemporaryDirectory() as tmp_dir, \
+                override_settings(DATA_SERVICES={'TNS': {'profile_dir': tmp_dir, 'profile_views': True}}):
+            # Other users get no summary
+            self.assertNotIn('X-TNS-Profile', self.profile({}, is_staff=False)[1])
+            # A request made while another one is profiled, or while another profiler is active, is served as is
+            with patch('tom_tns.profiling._profiler_lock', Mock(acquire=Mock(return_value=False))):
+                response = self.profile({})[1]
+            self.assertEqual((response.status_code, response.has_header('X-TNS-Profile')), (200, False))
+            with patch('tom_tns.profiling.cProfile.Profile', return_value=Mock(
+                    enable=Mock(side_effect=ValueError('Another profiling tool is already active')))):
+                response = self.profile({})[1]
+            self.assertEqual((response.status_code, response.has_header('X-TNS-Profile')), (200, False))
+            self.assertEqual(len(os.listdir(tmp_dir)), 1)
+
+
+def at_report(**fields):
+    entry = {
+        'ra': {'value': 10.5}, 'dec': {'value': -20.1}, 'reporting_groupid': '1', 'data_source_groupid': '1',
+        'reporter': 'A. Person', 'discovery_datetime': '2024-01-02 00:00:00', 'at_type': 1,
+        'non_detection': {'archiveid': '0', 'archival_remarks': 'None'},
+        'photometry': {'photometry_group': {'0': {
+            'obsdate': '2024-01-02 00:00:00', 'flux': 18.5, 'flux_error': 0.05, 'flux_unitid': '1', 'filterid': '22',
+            'instrumentid': '0', 'limiting_flux': None, 'exptime': 60}}},
+    }
+    entry.update(fields)
+    return {'at_report': {'0': entry}}
+
+
+class TestReportValidation(TestCase):
+    def setUp(self):
+        self.validator = ReportValidator(standin_tns_values())
+
+    def test_valid_report(self):
+        self.assertEqual(self.validator.validate(at_report()), [])
+
+    def test_all_errors_are_reported(self):
+        report = at_report(ra={'value': 400}, at_type=99, discovery_datetime='2024-01-01 00:00:00', non_detection={
+            'obsdate': '2024-01-03 00:00:00', 'limiting_flux': 21, 'flux_unitid': '1', 'filterid': '5',
+            'instrumentid': '0'})
+        self.assertEqual(self.validator.validate(report), [
+            'at_report.0.ra.value: 400 is outside the range [0, 360]',
+            "at_report.0.at_type: 99 is not a valid TNS at_types ID",
+            "at_report.0.non_detection.filterid: '5' is not a valid TNS filters ID",
+            'at_report.0.non_detection.obsdate: must be before the discovery date',
+            'at_report.0.photometry.photometry_group.0.obsdate: must be after the last non-detection',
+        ])
+
+    def test_nondetection_required(self):
+        errors = self.validator.validate(at_report(non_detection={'archiveid': '0'}))
+        self.assertEqual(len(errors), 1)
+        self.assertTrue(errors[0].startswith('at_report.0.non_detection: must give either archiveid'))
+
+    def test_invalid_report_is_not_sent(self):
+        cache.set('all_tns_values', standin_tns_values(), None)
+        target = Target.objects.create(name='invalid', type=Target.SIDEREAL, ra=10.5, dec=-20.1)
+        with patch('tom_tns.views.send_tns_report') as send:
+            view = TNSSubmitView(request=RequestFactory().post('/'), kwargs={'pk': target.pk})
+            view.request.user = User.objects.create(username='reporter')
+            view.request._messages = CookieStorage(view.request)
+            form = Mock(generate_tns_report=Mock(return_value=at_report(dec={'value': -91})))
+            view.form_valid(form)
+        send.assert_not_called()
+        self.assertIn('at_report.0.dec.value', str(list(view.request._messages)[0]))
+
+
+class TestReports(TestCase):
+    def at_report(self, **fields):
+        return ATReport(ra=10.5, dec=-20.1, reporting_groupid='1', data_source_groupid='1', reporter='A. Person',
+                        discovery_datetime=datetime(2024, 1, 2), at_type='1', name='target', **fields,
+                        nondetection=NonDetection(archiveid='1', archival_remarks='Not in SDSS'),
+                        photometry=[PhotometryGroup(obsdate=datetime(2024, 1, 2, 1), flux=18.5, flux_error=0.05,
+                                                    flux_unitid='1', filterid='22', instrumentid='1')])
+
+    def test_bulk_report(self):
+        classification = Classification(name='2024abc', classifier='A. Person', objtypeid='3', groupid='1',
+                                        spectra=[Spectrum(obsdate=datetime(2024, 1, 3), instrumentid='2',
+                                                          spectypeid='1', observer='Robot', ascii_file='spec.txt')])
+        reports = [self.at_report(), self.at_report(internal_name='ZTF24aaa'), classification]
+        bulk_report = tns_bulk_report(reports)
+        self.assertEqual(list(bulk_report['at_report']), ['0', '1'])
+        self.assertEqual(bulk_report['at_report']['1']['internal_name'], 'ZTF24aaa')
+        self.assertEqual(bulk_report['at_report']['0']['photometry']['photometry_group']['0']['obsdate'],
+                         '2024-01-02 01:00:00')
+        self.assertEqual(ReportValidator(standin_tns_values()).validate(bulk_report), [])
+        self.assertEqual(json.loads(dumps_tns_report(reports)), bulk_report)
+        self.assertFalse(hasattr(classification, '__dict__'))
+
+    def test_hermes_report(self):
+        hermes_report = self.at_report().to_hermes(option_labels(standin_tns_values()))
+        self.assertEqual(hermes_report['data']['targets'][0]['discovery_info'], {
+            'date': '2024-01-02T00:00:00', 'discovery_source': 'Test TOM', 'reporting_group': 'Test TOM',
+            'transient_type': 'PSN - Possible SN', 'nondetection_source': 'SDSS',
+            'nondetection_comments': 'Not in SDSS'})
+        self.assertEqual(hermes_report['data']['photometry'][0]['instrument'], 'LCO1m - Sinistro')
+
+
+@override_settings(DATA_SERVICES={'TNS': {**TNS_SETTINGS['TNS'], 'bots': [
+    {'bot_id': 2, 'bot_name': 'second bot', 'api_key': 'key2'}]}})
+class TestTNSBots(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_credentials_are_built_once(self):
+        first, second = get_tns_bots()
+        self.assertIs(get_tns_credentials(), first)
+        self.assertEqual(first['marker'], 'tns_marker{"tns_id": 1, "type": "bot", "name": "bot"}')
+        self.assertEqual((second['api_key'], second['base_url']), ('key2', 'https://sandbox.wis-tns.org/'))
+        self.assertNotIn('marker', settings.DATA_SERVICES['TNS'])
+        self.assertIs(get_tns_credentials('2'), second)
+        with use_tns_bot('2'):
+            self.assertIs(get_tns_credentials(), second)
+            self.assertIs(choose_tns_bot(), second)
+        self.assertIs(get_tns_credentials(), first)
+
+    def test_bots_are_chosen_by_quota(self):
+        first, second = get_tns_bots()
+        # Bots take turns until their quotas are known
+        self.assertEqual({choose_tns_bot()['bot_id'] for _ in range(2)}, {1, 2})
+        record_bot_quota(first, Mock(headers={'x-rate-limit-remaining': '1', 'x-rate-limit-reset': '60'}))
+        record_bot_quota(second, Mock(headers={'x-rate-limit-remaining': '4', 'x-rate-limit-reset': '60'}))
+        self.assertEqual([choose_tns_bot()['bot_id'] for _ in range(3)], [2, 2, 2])
+        # Only the responses to requests actually sent are charged against the quota
+        self.assertEqual(cache.get('tns_bot_quota_2'), 4)
+        record_bot_quota(second, Mock(headers={'x-rate-limit-remaining': '0', 'x-rate-limit-reset': '60'}))
+        self.assertEqual(choose_tns_bot()['bot_id'], 1)
+
+
+class TestStandInServer(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.server = start_server(StandInConfig(latency=0, processing_seconds=0.2))
+        base_url = f'http://127.0.0.1:{self.server.server_port}/'
+        self.settings = override_settings(DATA_SERVICES={'TNS': {**TNS_SETTINGS['TNS'], 'base_url': base_url,
+                                                                 'report_delay_seconds': 0.1}})
+        self.settings.enable()
+
+    def tearDown(self):
+        self.settings.disable()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_report_round_trip(self):
+        self.assertIn((22, 'r-Sloan'), [(int(k), v) for k, v in get_tns_values('filters')])
+        report_id = send_tns_report(json.dumps({'at_report': {}}))
+        request = RequestFactory().get('/')
+        with patch('tom_tns.tns_api.messages'):
+            self.assertTrue(get_tns_report_reply(report_id, request).startswith('AT2024'))
+
+    def test_values_are_revalidated(self):
+        values, reversed_values = populate_tns_values()
+        version = cache.get('tns_values_version')
+        cache.delete('all_tns_values')
+        with patch('tom_tns.tns_api.reverse_option_list') as reverse:
+            # Not modified, by ETag
+            self.assertEqual(populate_tns_values(), (values, reversed_values))
+            self.server.RequestHandlerClass.state.config.etags = False
+            # Unchanged, by content hash
+            self.assertEqual(populate_tns_values(), (values, reversed_values))
+        reverse.assert_not_called()
+        self.assertEqual(cache.get('all_tns_values'), values)
+        self.assertEqual(cache.get('tns_values_version'), version)
+
+        changed = {**values, 'filters': {**values['filters'], '23': 'i-Sloan'}}
+        with patch('tom_tns.tests.standin_server.standin_tns_values', return_value=changed), \
+                patch('tom_tns.tns_api.reverse_option_list', wraps=reverse_option_list) as reverse:
+            self.assertEqual(populate_tns_values()[1]['filters']['i-Sloan'], '23')
+        reverse.assert_called_once_with(changed['filters'])
+        self.assertNotEqual(cache.get('tns_values_version'), version)
+
+    def test_queued_submission_is_processed(self):
+        target = Target.objects.create(name='queued', type=Target.SIDEREAL, ra=10.5, dec=-20.1)
+        submission = TNSSubmission.objects.create(target=target, bot_id='1', payload=at_report(),
+                                                  status=TNSSubmission.STATUS_RUNNING, attempts=1)
+        submission = process_submission(submission)
+        self.assertEqual(submission.status, TNSSubmission.STATUS_SUCCEEDED)
+        self.assertTrue(submission.report_id)
+        target.refresh_from_db()
+        self.assertEqual(target.name, submission.iau_name)
+        self.assertIn('was created', submission.messages[0]['message'])
+
+    def test_unconfirmed_send_is_not_retried(self):
+        target = Target.objects.create(name='queued', type=Target.SIDEREAL, ra=10.5, dec=-20.1)
+        submission = TNSSubmission.objects.create(target=target, bot_id='1', payload=at_report(),
+                                                  status=TNSSubmission.STATUS_RUNNING, attempts=1)
+        with patch('tom_tns.submissions.send_tns_report',
+                   side_effect=requests.exceptions.ConnectTimeout('unreachable')):
+            submission = process_submission(submission)
+        self.assertEqual(submission.status, TNSSubmission.STATUS_PENDING)
+
+        # The report may have reached the TNS, so it stays in flight until it is failed as stale
+        submission.status = TNSSubmission.STATUS_RUNNING
+        with patch('tom_tns.submissions.send_tns_report', side_effect=requests.exceptions.ReadTimeout('slow')):
+            submission = process_submission(submission)
+        self.assertEqual((submission.status, submission.worker), (TNSSubmission.STATUS_RUNNING, SENT_UNCONFIRMED))
+        self.assertIsNone(submission.finished)
+        TNSSubmission.objects.filter(pk=submission.pk).update(started=datetime.now(timezone.utc) - timedelta(hours=1))
+        self.assertEqual(SubmissionWorker(name='test').requeue_stale(), 0)
+        submission.refresh_from_db()
+        self.assertEqual(submission.status, TNSSubmission.STATUS_FAILED)
+        self.assertIn('slow', submission.error)
+
+    def test_deadline_hands_off_the_reply(self):
+        target = Target.objects.create(name='slow', type=Target.SIDEREAL, ra=10.5, dec=-20.1)
+        request = RequestFactory().post('/')
+        request.user = User.objects.create(username='reporter')
+        request._messages = CookieStorage(request)
+        view = TNSSubmitView(request=request, kwargs={'pk': target.pk})
+        tns_settings = {**settings.DATA_SERVICES['TNS'], 'submission_deadline_seconds': 0.15}
+        with override_settings(DATA_SERVICES={'TNS': tns_settings}):
+            start = time.monotonic()
+            view.form_valid(Mock(generate_tns_report=Mock(return_value=at_report())))
+            self.assertLess(time.monotonic() - start, 0.15)
+        submission = TNSSubmission.objects.get(target=target)
+        self.assertEqual(submission.status, TNSSubmission.STATUS_PENDING)
+        self.assertIn(f'still processing report {submission.report_id}', str(list(request._messages)[0]))
+
+        # The worker only waits for the reply
+        time.sleep(0.2)
+        with patch('tom_tns.submissions.send_tns_report') as send:
+            submission = process_submission(submission)
+        send.assert_not_called()
+        self.assertEqual(submission.status, TNSSubmission.STATUS_SUCCEEDED)
+
+    def test_repeated_submission_is_not_sent_again(self):
+        target = Target.objects.create(name='reported', type=Target.SIDEREAL, ra=10.5, dec=-20.1)
+        user = User.objects.create(username='reporter')
+
+        def submit(target_id, data):
+            request = RequestFactory().post('/')
+            request.user = user
+            request._messages = CookieStorage(request)
+            form = Mock(cleaned_data=data, generate_tns_report=Mock(return_value=at_report()))
+            TNSSubmitView(request=request, kwargs={'pk': target_id}).form_valid(form)
+            return str(list(request._messages)[0]) if list(request._messages) else ''
+
+        submit(target.pk, {'reporter': 'A. Person'})
+        submission = TNSSubmission.objects.get(target=target)
+        self.assertEqual(submission.status, TNSSubmission.STATUS_SUCCEEDED)
+        target.refresh_from_db()
+        self.assertEqual(target.name, submission.iau_name)
+
+        with patch('tom_tns.views.send_tns_report') as send:
+            # A double click returns the earlier result
+            self.assertIn(f'named {submission.iau_name}', submit(target.pk, {'reporter': 'A. Person'}))
+            # Another report of a target 1" away is held back while the first report is in flight
+            TNSSubmission.objects.filter(pk=submission.pk).update(status=TNSSubmission.STATUS_RUNNING)
+            nearby = Target.objects.create(name='nearby', type=Target.SIDEREAL, ra=10.5, dec=-20.1 + 1 / 3600)
+            self.assertIn('already being submitted', submit(nearby.pk, {'reporter': 'B. Person'}))
+        send.assert_not_called()
+        self.assertEqual(TNSSubmission.objects.count(), 1)
+
+    def test_spectrum_files_are_hashed_by_content(self):
+        def form_hash(content):
+            ascii_file = SimpleUploadedFile('spectrum.txt', content)
+            form = Mock(cleaned_data={'reporter': 'A. Person', 'ascii_file': ascii_file})
+            payload_hash = submission_hash(form)
+            # The file can still be read in full
+            self.assertEqual(ascii_file.read(), content)
+            return payload_hash
+
+        self.assertEqual(form_hash(b'4000 1.0\n'), form_hash(b'4000 1.0\n'))
+        self.assertNotEqual(form_hash(b'4000 1.0\n'), form_hash(b'4000 2.0\n'))
+
+    def test_hermes_timeout_is_handed_off(self):
+        target = Target.objects.create(name='hermes', type=Target.SIDEREAL, ra=10.5, dec=-20.1)
+        request = RequestFactory().post('/')
+        request.user = User.objects.create(username='reporter')
+        request._messages = CookieStorage(request)
+        form = Mock(cleaned_data={}, generate_hermes_report=Mock(return_value=({'data': {}}, [])))
+        with patch('tom_tns.views.submit_through_hermes', return_value=True), \
+                patch('tom_tns.hermes_api.requests.post', side_effect=requests.exceptions.ReadTimeout('slow')), \
+                override_settings(DATA_SHARING={'hermes': {'BASE_URL': 'http://hermes/'}}):
+            TNSSubmitView(request=request, kwargs={'pk': target.pk}).form_valid(form)
+        # The message may have reached Hermes, so it is neither failed nor sent again
+        self.assertIn('timed out', str(list(request._messages)[0]))
+        self.assertEqual(TNSSubmission.objects.get(target=target).status, TNSSubmission.STATUS_RUNNING)
+
+    def test_reply_poll_times_out(self):
+        target = Target.objects.create(name='polled', type=Target.SIDEREAL, ra=10.5, dec=-20.1)
+        submission = TNSSubmission.objects.create(target=target, payload=at_report(), report_id=12345,
+                                                  status=TNSSubmission.STATUS_RUNNING)
+        with override_settings(DATA_SERVICES={'TNS': {**settings.DATA_SERVICES['TNS'], 'lookup_timeout': 2}}), \
+                patch('tom_tns.tns_api.requests.post', side_effect=requests.exceptions.ReadTimeout('slow')) as post:
+            reply = poll_report_reply(12345, submission)
+        self.assertLessEqual(post.call_args.kwargs['timeout'], 2)
+        # A timed out poll is tried again with the next one
+        self.assertEqual(reply['status'], 'processing')
+        self.assertEqual(TNSSubmission.objects.get(pk=submission.pk).status, TNSSubmission.STATUS_RUNNING)
+
+    def test_status_endpoint_shares_one_poll(self):
+        target = Target.objects.create(name='watched', type=Target.SIDEREAL, ra=10.5, dec=-20.1)
+        report_id = send_tns_report(json.dumps(at_report()))
+        watch_report_reply(queue_report_reply(target.pk, at_report(), report_id))
+        watcher = User.objects.create(username='watcher')
+        assign_perm('tom_targets.view_target', watcher, target)
+        self.client.force_login(watcher)
+        url = reverse('tom_tns:report-status', kwargs={'report_id': report_id})
+        state = self.server.RequestHandlerClass.state
+        with override_settings(DATA_SERVICES={'TNS': {**settings.DATA_SERVICES['TNS'], 'reply_poll_interval': 0.5}}):
+            requests_before = state.request_count
+            for _ in range(3):
+                self.assertEqual(self.client.get(url).json()['status'], 'processing')
+            self.assertEqual(state.request_count, requests_before + 1)
+            reply = self.client.get(url, {'wait': 5}).json()
+        self.assertEqual(reply['status'], 'succeeded')
+        target.refresh_from_db()
+        self.assertEqual(target.name, reply['iau_name'])
+        self.assertEqual(TNSSubmission.objects.get(report_id=report_id).status, TNSSubmission.STATUS_SUCCEEDED)
+
+        # Finished replies are served from the cache, also as server-sent events
+        requests_before = state.request_count
+        response = self.client.get(url, HTTP_ACCEPT='text/event-stream')
+        events = b''.join(response.streaming_content).decode()
+        self.assertIn(f'event: reply\ndata: {json.dumps(reply)}', events)
+        self.assertEqual(state.request_count, requests_before)
+
+        # Reports that weren't submitted from the TOM, or of Targets the user may not view, are not found
+        private = Target.objects.create(name='private', type=Target.SIDEREAL, ra=10.5, dec=-20.1)
+        TNSSubmission.objects.create(target=private, payload=at_report(), report_id=report_id + 1)
+        for unknown in [report_id + 1, report_id + 2]:
+            url = reverse('tom_tns:report-status', kwargs={'report_id': unknown})
+            self.assertEqual(self.client.get(url).status_code, 404)
+        self.assertEqual(state.request_count, requests_before)
+
+
+class TestSubmissionWorker(TestCase):
+    def test_claim_respects_bot_concurrency(self):
+        target = Target.objects.create(name='queued', type=Target.SIDEREAL, ra=10.5, dec=-20.1)
+        for bot_id in ['1', '1', '1', '2']:
+            TNSSubmission.objects.create(target=target, bot_id=bot_id, payload=at_report())
+        worker = SubmissionWorker(threads=4, bot_concurrency=2, name='test')
+        claimed = worker.claim(10)
+        self.assertEqual(sorted(submission.bot_id for submission in claimed), ['1', '1', '2'])
+        self.assertEqual(worker.claim(10), [])
+        TNSSubmission.objects.filter(pk=claimed[0].pk).update(started=datetime.now(timezone.utc) - timedelta(hours=1))
+        self.assertEqual(worker.requeue_stale(), 1)
+        self.assertEqual(TNSSubmission.objects.get(pk=claimed[0].pk).status, TNSSubmission.STATUS_PENDING)
+
+
+def run_concurrently(*calls):
+    """ Run `calls` in threads that start together, each with its own database connection. Returns their results or
+    exceptions, in order
+    """
+    barrier = threading.Barrier(len(calls))
+    results = [None] * len(calls)
+
+    def run(index, call):
+        try:
+            barrier.wait()
+            results[index] = call()
+        except Exception as e:
+            results[index] = e
+        finally:
+            connection.close()
+
+    threads = [threading.Thread(target=run, args=item) for item in enumerate(calls)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+class TestConcurrency(TransactionTestCase):
+    def test_concurrent_claims_respect_bot_concurrency(self):
+        target = Target.objects.create(name='queued', type=Target.SIDEREAL, ra=10.5, dec=-20.1)
+        for bot_id in ['1'] * 6 + ['2'] * 6:
+            TNSSubmission.objects.create(target=target, bot_id=bot_id, payload=at_report())
+        workers = [SubmissionWorker(threads=4, bot_concurrency=2, name=name) for name in ['one', 'two']]
+        claimed = sum(run_concurrently(*[lambda worker=worker: worker.claim(10) for worker in workers]), [])
+        self.assertEqual(sorted(submission.bot_id for submission in claimed), ['1', '1', '2', '2'])
+        running = TNSSubmission.objects.filter(status=TNSSubmission.STATUS_RUNNING)
+        self.assertEqual(sorted(running.values_list('bot_id', flat=True)), ['1', '1', '2', '2'])
+
+    def test_concurrent_reports_of_one_transient(self):
+        first = Target.objects.create(name='first', type=Target.SIDEREAL, ra=10.5, dec=-20.1)
+        second = Target.objects.create(name='second', type=Target.SIDEREAL, ra=10.5, dec=-20.1 + 1 / 3600)
+        results = run_concurrently(lambda: start_submission(first.pk, 'a' * 64),
+                                   lambda: start_submission(second.pk, 'b' * 64))
+        # Only one of two reports of targets 1" apart is recorded, the other is a duplicate of it
+        started = [result for result in results if isinstance(result, TNSSubmission)]
+        duplicates = [result for result in results if isinstance(result, DuplicateSubmission)]
+        self.assertEqual((len(started), len(duplicates)), (1, 1))
+        self.assertEqual(duplicates[0].submission, started[0])
+        self.assertEqual(TNSSubmission.objects.count(), 1)
+
+
+class TestAutoReport(TestCase):
+    def setUp(self):
+        cache.clear()
+        autoreport._recent_triggers.clear()
+        self.server = start_server(StandInConfig(latency=0))
+        base_url = f'http://127.0.0.1:{self.server.server_port}/'
+        self.settings = override_settings(DATA_SERVICES={'TNS': {
+            **TNS_SETTINGS['TNS'], 'base_url': base_url, 'group_names': ['Test TOM'],
+            'filter_mapping': {'r': 'r-Sloan'}, 'instrument_mapping': {'Sinistro': 'LCO1m - Sinistro'},
+            'auto_report': {'enabled': True, 'debounce_seconds': 60}}})
+        self.settings.enable()
+        populate_tns_values()
+        self.now = datetime.now(timezone.utc)
+        self.target = Target.objects.create(name='ZTF24aaa', type=Target.SIDEREAL, ra=10.5, dec=-20.1)
+
+    def tearDown(self):
+        self.settings.disable()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def add_photometry(self, target, hours_ago, brightness=None, limit=None):
+        PhotometryReducedDatum.objects.create(target=target, timestamp=self.now - timedelta(hours=hours_ago),
+                                              brightness=brightness, brightness_error=0.05 if brightness else None,
+                                              limit=limit, bandpass='r', instrument='Sinistro')
+
+    def test_triggers_are_debounced(self):
+        for hours_ago in [3, 2, 1]:
+            self.add_photometry(self.target, hours_ago, brightness=18.5)
+        trigger_auto_report([self.target.pk, self.target.pk])
+        candidate = TNSAutoReportCandidate.objects.get()
+        self.assertEqual(candidate.target, self.target)
+        self.assertEqual(evaluate_auto_report_candidates(now=self.now), [])
+        self.assertTrue(TNSAutoReportCandidate.objects.exists())
+
+    def test_candidates_are_deleted_once_evaluated(self):
+        self.add_photometry(self.target, 3, brightness=18.5)
+        with patch('tom_tns.autoreport.get_tns_statuses', side_effect=RuntimeError('interrupted')), \
+                self.assertRaises(RuntimeError):
+            evaluate_auto_report_candidates(now=self.now + timedelta(minutes=2))
+        self.assertTrue(TNSAutoReportCandidate.objects.exists())
+
+        # Workers only look for due candidates once per debounce period
+        worker = SubmissionWorker(name='test')
+        with patch('tom_tns.submissions.evaluate_auto_report_candidates') as evaluate:
+            for _ in range(3):
+                worker.evaluate_auto_reports()
+        evaluate.assert_called_once_with()
+
+    def test_new_transient_is_reported(self):
+        reported = Target.objects.create(name='ZTF24aab', type=Target.SIDEREAL, ra=11.5, dec=-21.1)
+        TargetName.objects.create(target=reported, name='AT2024abc')
+        faint = Target.objects.create(name='ZTF24aac', type=Target.SIDEREAL, ra=12.5, dec=-22.1)
+        for target in [self.target, reported]:
+            self.add_photometry(target, 5, limit=20.5)
+            self.add_photometry(target, 3, brightness=18.5)
+            self.add_photometry(target, 2, brightness=18.4)
+        self.add_photometry(faint, 5, limit=20.5)
+        self.add_photometry(faint, 3, brightness=19.5)
+
+        submissions = evaluate_auto_report_candidates(now=self.now + timedelta(minutes=2))
+        self.assertEqual([submission.target for submission in submissions], [self.target])
+        self.assertFalse(TNSAutoReportCandidate.objects.exists())
+        report = submissions[0].payload['at_report']['0']
+        self.assertEqual(report['reporting_groupid'], '1')
+        self.assertEqual(report['non_detection']['limiting_flux'], 20.5)
+        self.assertEqual(report['photometry']['photometry_group']['0']['filterid'], '22')
+        self.assertEqual(report['photometry']['photometry_group']['0']['instrumentid'], '1')
+        # A queued report is not queued again
+        self.add_photometry(self.target, 1, brightness=18.3)
+        self.assertEqual(evaluate_auto_report_candidates(now=self.now + timedelta(hours=1)), [])
+
+
+class TestSpectra(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.target = Target.objects.create(name='AT 2024abc', type=Target.SIDEREAL, ra=10.5, dec=-20.1)
+        self.datum = SpectroscopyReducedDatum.objects.create(
+            target=self.target, timestamp=datetime(2024, 1, 2, 3, 4, 5, tzinfo=timezone.utc), instrument='FLOYDS',
+            wavelength=[5000.5, 4000.25], flux=[2e-16, 1e-16], error=[1e-17, 2e-17])
+
+    def test_spectrum_ascii(self):
+        self.assertEqual(spectrum_ascii([5000.5, 4000.25, 6000], [2e-16, 1e-16, float('nan')]),
+                         b'4000.2500 1.000000e-16\n5000.5000 2.000000e-16\n')
+
+    def test_spectrum_ascii_file_is_cached(self):
+        self.assertEqual(spectrum_datum_choices(self.target)[0][0], f'datum-{self.datum.pk}')
+        ascii_file = spectrum_ascii_file(self.datum.pk)
+        self.assertEqual(ascii_file.name, f'AT_2024abc_20240102T030405_{self.datum.pk}.txt')
+        self.assertEqual(ascii_file.open().read(),
+                         b'4000.2500 1.000000e-16 2.000000e-17\n5000.5000 2.000000e-16 1.000000e-17\n')
+        with self.assertNumQueries(1):
+            self.assertEqual(spectrum_ascii_file(self.datum.pk).read(), ascii_file.open().read())
+        # Re-reduced data is not served from the cache
+        SpectroscopyReducedDatum.objects.filter(pk=self.datum.pk).update(flux=[3e-16, 1e-16])
+        self.assertIn(b'5000.5000 3.000000e-16', spectrum_ascii_file(self.datum.pk).read())
+
+    def test_ascii_spectrum_errors(self):
+        self.assertEqual(ascii_spectrum_errors(ContentFile(b'# wavelength flux\n4000 1e-16\n\n4001 2e-16 # ok\n')), [])
+        self.assertEqual(ascii_spectrum_errors(ContentFile(b'4000 1\n4001 x\n3999 2\n4002 1 2\n4003 nan\n')), [
+            "line 2: not a number in '4001 x'",
+            'line 3: wavelength 3999 is not above the previous wavelength 4000, wavelengths must increase',
+            'line 4: expected 2 columns, found 3',
+            'line 5: values must be finite numbers'])
+
+    @override_settings(DATA_SERVICES=TNS_SETTINGS)
+    def test_classify_form_checks_spectrum_files(self):
+        cache.set('all_tns_values', standin_tns_values(), None)
+        cache.set('reverse_tns_values', reverse_tns_values(standin_tns_values()), None)
+        image = io.BytesIO()
+        fits.PrimaryHDU(np.zeros((20, 30), dtype='f4')).writeto(image)
+
+        def classify_form():
+            files = {'ascii_file_override': SimpleUploadedFile('spectrum.txt', b'4000 1\n4001 2 3\n'),
+                     'fits_file_override': SimpleUploadedFile('spectrum.fits', image.getvalue())}
+            form = TNSClassifyForm(data={'observer': 'Robot'}, files=files,
+                                   initial={'ascii_file_choices': [], 'fits_file_choices': [(None, '')]})
+            form.is_valid()
+            return form
+
+        with patch('tom_tns.spectra.ascii_spectrum_errors', wraps=ascii_spectrum_errors) as check:
+            for _ in range(2):
+                form = classify_form()
+                self.assertEqual(form.errors['ascii_file_override'], ['line 2: expected 2 columns, found 3'])
+                self.assertEqual(form.errors['fits_file_override'],
+                                 ['The FITS file holds no spectrum: HDU 0 is a 30 x 20 image'])
+        # The verdict is cached by file hash
+        self.assertEqual(check.call_count, 1)
+
+        # Generated files are checked too, and kept for the submission
+        choice = f'datum-{self.datum.pk}'
+        SpectroscopyReducedDatum.objects.filter(pk=self.datum.pk).update(wavelength=[4000.25, 4000.25])
+        with patch('tom_tns.forms.spectrum_ascii_file', wraps=spectrum_ascii_file) as generate:
+            form = TNSClassifyForm(data={'observer': 'Robot', 'ascii_file': choice},
+                                   initial={'ascii_file_choices': [(choice, 'generated')],
+                                            'fits_file_choices': [(None, '')]})
+            form.is_valid()
+            self.assertNotIn('ascii_file', form.errors)
+            self.assertEqual(form.get_spectrum_files()[0].read(), b'4000.2500 2.000000e-16 1.000000e-17\n')
+        generate.assert_called_once_with(self.datum.pk)
+
+
+class TestFitsSpectra(TestCase):
+    def fits_bytes(self, *hdus):
+        output = io.BytesIO()
+        fits.HDUList(list(hdus)).writeto(output)
+        return output.getvalue()
+
+    def fits_ascii(self, *hdus):
+        output = io.BytesIO()
+        fits_spectrum_ascii(io.BytesIO(self.fits_bytes(*hdus)), output)
+        return output.getvalue()
+
+    def test_image_spectra(self):
+        header = fits.Header({'CTYPE1': 'WAVE', 'CUNIT1': 'Angstrom', 'CRVAL1': 4000.0, 'CDELT1': 2.0, 'CRPIX1': 1.0})
+        science = fits.ImageHDU(np.array([1e-16, 2e-16, np.nan], dtype='f4'), header=header, name='SCI')
+        error = fits.ImageHDU(np.array([1e-17, 1e-17, 1e-17], dtype='f4'), header=header, name='ERR')
+        content = self.fits_ascii(fits.PrimaryHDU(), science, error)
+        self.assertEqual(content, b'4000.0000 1.000000e-16\n4002.0000 2.000000e-16\n')
+
+        # An IRAF multispec echelle with two orders, given in reverse order of wavelength
+        multispec = fits.PrimaryHDU(np.array([[[3.0, 4.0], [1.0, 2.0]]]), header=fits.Header({
+            'CTYPE1': 'MULTISPE', 'CTYPE2': 'MULTISPE', 'WAT0_001': 'system=multispec',
+            'WAT2_001': 'wtype=multispec spec1 = "1 1 0 6000. 1. 2 0. 1. 10." spec2 = "2 2 1 3.6 0.',
+            'WAT2_002': '1 2 0. 1. 10."'}))
+        content = self.fits_ascii(multispec)
+        self.assertEqual(content.decode().split(), ['3981.0717', '1.000000e+00', '5011.8723', '2.000000e+00',
+                                                    '6000.0000', '3.000000e+00', '6001.0000', '4.000000e+00'])
+
+    def test_overlapping_orders_are_sorted(self):
+        # The first order has a descending dispersion and overlaps the second one
+        wat = 'wtype=multispec spec1 = "1 1 0 5000. -1. 3 0. 1. 3." spec2 = "2 2 0 4999.5 1. 3 0. 1. 3."'
+        header = fits.Header({'CTYPE1': 'MULTISPE', 'CTYPE2': 'MULTISPE', 'WAT0_001': 'system=multispec'})
+        for card in range(0, len(wat), 68):
+            header[f'WAT2_{card // 68 + 1:03d}'] = wat[card:card + 68]
+        multispec = fits.PrimaryHDU(np.array([[1.0, 2.0, 3.0], [4.0, 5.0, 6.0]]), header=header)
+        rows = [line.split() for line in self.fits_ascii(multispec).decode().splitlines()]
+        self.assertEqual([(float(wavelength), float(flux)) for wavelength, flux in rows],
+                         [(4998.0, 3.0), (4999.0, 2.0), (5000.0, 1.0), (5000.5, 5.0), (5001.5, 6.0)])
+
+        # Rows of a table that aren't sorted by wavelength are sorted, dropping repeated wavelengths
+        table = fits.BinTableHDU.from_columns([fits.Column(name='WAVE', format='D', array=[4002.0, 4000.0, 4002.0]),
+                                               fits.Column(name='FLUX', format='D', array=[2.0, 1.0, 3.0])])
+        self.assertEqual(self.fits_ascii(fits.PrimaryHDU(), table),
+                         b'4000.0000 1.000000e+00\n4002.0000 2.000000e+00\n')
+
+    def test_table_spectrum(self):
+        table = fits.BinTableHDU.from_columns([
+            fits.Column(name='LOGLAM', format='D', array=[3.6, 3.65, 3.7]),
+            fits.Column(name='FLUX', format='D', array=[1.5, 2.0, 2.5]),
+            fits.Column(name='IVAR', format='D', array=[4.0, 0.0, 1.0]),
+        ])
+        content = self.fits_ascii(fits.PrimaryHDU(), table)
+        self.assertEqual(content, b'3981.0717 1.500000e+00 5.000000e-01\n5011.8723 2.500000e+00 1.000000e+00\n')
+
+    def test_fits_data_product_is_converted_once(self):
+        target = Target.objects.create(name='fits_target', type=Target.SIDEREAL, ra=10.5, dec=-20.1)
+        header = fits.Header({'CRVAL1': 4000.0, 'CDELT1': 2.0, 'CRPIX1': 1.0})
+        fits_file = self.fits_bytes(fits.PrimaryHDU(np.array([1.0, 2.0]), header=header))
+        with tempfile.TemporaryDirectory() as media_root, override_settings(MEDIA_ROOT=media_root):
+            data_product = DataProduct.objects.create(target=target, product_id='spectrum',
+                                                      data=SimpleUploadedFile('spectrum.fits', fits_file))
+            ascii_files, fits_files = spectrum_file_choices(target)
+            self.assertEqual(ascii_files, [(f'fits-{data_product.pk}', 'spectrum.txt (converted from FITS)')])
+            with patch('tom_tns.spectra.fits_spectrum_ascii', wraps=fits_spectrum_ascii) as convert:
+                self.assertEqual(fits_ascii_file(data_product.pk).read(),
+                                 b'4000.0000 1.000000e+00\n4002.0000 2.000000e+00\n')
+                self.assertEqual(fits_ascii_file(data_product.pk).name, 'spectrum.txt')
+            self.assertEqual(convert.call_count, 1)
+
+
+class TestFluxUnits(TestCase):
+    def test_unit_spellings(self):
+        self.assertEqual(normalize_unit('ABMag'), 'AB mag')
+        self.assertEqual(normalize_unit('erg/s/cm^2/A'), 'erg / s / cm² / Å')
+        self.assertIsNone(normalize_unit('counts'))
+        self.assertEqual(tns_unit_option('AB mag', standin_tns_values()['units'].items()), ('1', 'ABMag'))
+
+    def test_mixed_units_are_converted(self):
+        values, errors = convert_flux(
+            [AB_MAG_MJY, 1.0, 16.0, 2.0e-16, 5.0],
+            [0.1, 0.1, 0.05, None, 1.0],
+            from_units=['AB mag', 'mJy', 'Vega mag', 'erg/s/cm2/A', 'counts'],
+            to_unit='mJy', filters=['g', 'r', 'V-Johnson', 'g', 'r'])
+        np.testing.assert_allclose(values[:4], [1.0, 1.0, 10 ** (-0.4 * (16.02 - AB_MAG_MJY)),
+                                                2.0e-16 * 4830 ** 2 / 2.99792458e18 / 1e-26])
+        np.testing.assert_allclose(errors[:2], [0.1 / 1.0857362, 0.1], rtol=1e-6)
+        self.assertTrue(np.isnan(errors[3]))
+        # Unknown units can't be converted
+        self.assertTrue(np.isnan(values[4]))
+
+        magnitudes, _ = convert_flux([16.0, -1.0], from_units='Vega mag', to_unit='AB mag', filters='r')
+        self.assertAlmostEqual(magnitudes[0], 16.16)
+        magnitudes, _ = convert_flux([-1.0], from_units='mJy', to_unit='AB mag')
+        self.assertTrue(np.isnan(magnitudes[0]))
+
+
+class TestHermesBatches(TestCase):
+    def hermes_message(self, name, authors='Test TOM'):
+        return {'topic': 'hermes.test', 'title': f'{name} TNS discovery report', 'submit_to_tns': True,
+                'submitter': 'test@example.com', 'authors': authors,
+                'data': {'targets': [{'name': name, 'ra': 10.0, 'dec': -20.0}],
+                         'photometry': [{'target_name': name, 'brightness': 18.0}]}}
+
+    def test_batches(self):
+        hermes_messages = [self.hermes_message(name) for name in ['a', 'b', 'c']] + [self.hermes_message('d', 'Other')]
+        self.assertEqual(batch_hermes_messages(hermes_messages, max_targets=2), [[0, 1], [2], [3]])
+        size = len(json.dumps(hermes_messages[0]['data']))
+        self.assertEqual(batch_hermes_messages(hermes_messages, max_bytes=2 * size + 1), [[0, 1], [2], [3]])
+        # Classifications, with files, are not batched with discovery reports
+        self.assertEqual(batch_hermes_messages(hermes_messages[:3], files=[[], [Mock()], [Mock()]]), [[0], [1, 2]])
+
+    def test_objects_are_only_matched_by_name(self):
+        references = {'data': {'references': [{'source': 'tns_object', 'citation': 'AT2024a'},
+                                              {'source': 'tns_object', 'citation': 'AT2024b'}]}}
+        self.assertEqual(get_objects_from_response(references, ['a', 'b']), [None, None])
+        references['data']['references'][1]['target_name'] = 'a'
+        self.assertEqual(get_objects_from_response(references, ['a', 'b']), ['AT2024b', None])
+
+    def test_batched_submission(self):
+        server = start_server(StandInConfig(latency=0))
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        files = [[SimpleUploadedFile(f'{name}.txt', b'4000.0 1e-16\n')] for name in ['a', 'b', 'c']]
+        with override_settings(DATA_SHARING={'hermes': {'BASE_URL': f'http://127.0.0.1:{server.server_port}/'}}):
+            results = submit_batch_to_hermes([self.hermes_message(name) for name in ['a', 'b', 'c']], files)
+        self.assertEqual(results, [('AT202400001', ''), ('AT202400002', ''), ('AT202400003', '')])
+        self.assertEqual(server.RequestHandlerClass.state.request_count, 1)
+
+
+class TestFollowupPhotometry(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.server = start_server(StandInConfig(latency=0, processing_seconds=0))
+        base_url = f'http://127.0.0.1:{self.server.server_port}/'
+        self.settings = override_settings(DATA_SERVICES={'TNS': {
+            **TNS_SETTINGS['TNS'], 'base_url': base_url, 'group_names': ['Test TOM'], 'report_delay_seconds': 0.1,
+            'filter_mapping': {'r': 'r-Sloan', 'g': 'g-Sloan'}, 'instrument_mapping': {'LCO 1m': 'LCO1m - Sinistro'}}})
+        self.settings.enable()
+        populate_tns_values()
+        self.start = datetime.now(timezone.utc) - timedelta(days=2)
+        self.targets = []
+        for i, name in enumerate(['AT2024abc', 'AT2024abd', 'ZTF24aaa']):
+            target = Target.objects.create(name=name, type=Target.SIDEREAL, ra=10 + i, dec=-20)
+            for hours in range(3):
+                PhotometryReducedDatum.objects.create(
+                    target=target, timestamp=self.start + timedelta(hours=hours), bandpass='rg'[hours % 2],
+                    brightness=18 + hours if hours else None, brightness_error=0.1 if hours else None,
+                    limit=None if hours else 20.5, unit='ABMag', telescope='LCO 1m', instrument='Sinistro')
+            self.targets.append(target)
+
+    def tearDown(self):
+        self.settings.disable()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_batches_are_recorded_before_they_are_sent(self):
+        def send(data):
+            # The batch is in the ledger before the report leaves
+            self.assertEqual(set(TNSSubmission.objects.values_list('status', flat=True)),
+                             {TNSSubmission.STATUS_RUNNING})
+            return send_tns_report(data)
+
+        with patch('tom_tns.followup.send_tns_report', side_effect=send), \
+                patch('tom_tns.followup.get_tns_report_reply', side_effect=requests.exceptions.ReadTimeout('slow')):
+            submissions = report_followup_photometry(Target.objects.all())
+        # A sent batch whose reply wasn't had stays in flight with its report ID, and is not reported again
+        self.assertEqual({(submission.status, submission.report_id is not None) for submission in submissions},
+                         {(TNSSubmission.STATUS_PENDING, True)})
+        self.assertEqual(report_followup_photometry(Target.objects.all()), [])
+
+        # The tns_worker only gets the reply, without renaming the named objects
+        with patch('tom_tns.submissions.send_tns_report') as resend:
+            submission = process_submission(TNSSubmission.objects.get(pk=submissions[1].pk))
+        resend.assert_not_called()
+        self.assertEqual(submission.status, TNSSubmission.STATUS_SUCCEEDED)
+        self.assertEqual(Target.objects.get(pk=submission.target_id).name, 'AT2024abd')
+
+    def test_followup_photometry_in_one_bulk_report(self):
+        submissions = report_followup_photometry(Target.objects.all())
+        self.assertEqual([submission.target for submission in submissions], self.targets[:2])
+        self.assertEqual({submission.status for submission in submissions}, {TNSSubmission.STATUS_SUCCEEDED})
+        self.assertEqual(submissions[0].report_id, submissions[1].report_id)
+        groups = submissions[0].payload['at_report']['0']['photometry']['photometry_group']
+        self.assertEqual([(group['flux'], group['limiting_flux'], group['filterid'], group['instrumentid'])
+                          for group in groups.values()],
+                         [(None, 20.5, '22', '1'), (19.0, None, '21', '1'), (20.0, None, '22', '1')])
+
+        # Only photometry newer than the last report is reported next time
+        self.assertEqual(report_followup_photometry(Target.objects.all()), [])
+        PhotometryReducedDatum.objects.create(target=self.targets[1], timestamp=self.start + timedelta(hours=5),
+                                              bandpass='r', brightness=19.5, brightness_error=0.1)
+        submissions = report_followup_photometry(Target.objects.all())
+        self.assertEqual([submission.target for submission in submissions], [self.targets[1]])
+        self.assertEqual(len(submissions[0].payload['at_report']['0']['photometry']['photometry_group']), 1)
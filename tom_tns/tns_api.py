@@ -1,16 +1,34 @@
+import itertools
 import requests
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
 from urllib.parse import urljoin
 
 from django.core.cache import cache
 from django.conf import settings
 from django.contrib import messages
+from django.core.signals import setting_changed
 
+from tom_tns.deadline import request_timeout
+from tom_tns.metrics import increment, observe, time_request
+from tom_tns.tracing import trace_span
+
+import hashlib
 import json
+import re
+import threading
 import time
 import logging
 logger = logging.getLogger(__name__)
 
 
+# The TNS option values are cached for an hour. The state of their last download is cached without a timeout
+TNS_VALUES_TIMEOUT = 3600
+TNS_VALUES_STATE = 'tns_values_state'
+# Object lookups and searches that aren't made under a submission deadline time out after this many seconds
+LOOKUP_TIMEOUT = 10
+
+
 class BadTnsRequest(Exception):
     """ This Exception will be raised by errors during the TNS submission process """
     pass
@@ -67,26 +85,129 @@ def example_internal_name(name_format):
     return name_format['prefix'] + name_format['year_format'] + 'xxx' + name_format['postfix']
 
 
-def get_tns_credentials():
+# The credentials of the configured TNS bots, built once from the settings (see `get_tns_bots`)
+_tns_bots = None
+_tns_bots_lock = threading.Lock()
+# Turns for spreading requests over bots with the same remaining quota
+_bot_turns = itertools.count()
+# The bot pinned by `use_tns_bot` in this thread
+_local_bot = threading.local()
+
+
+def tns_marker(bot_id, bot_name):
+    return 'tns_marker' + json.dumps({'tns_id': bot_id, 'type': 'bot', 'name': bot_name})
+
+
+def _build_tns_bots():
+    try:
+        tns_info = settings.DATA_SERVICES['TNS']
+    except (KeyError, AttributeError, TypeError):
+        logger.error("TNS credentials not found in settings.py")
+        return []
+    shared = {key: value for key, value in tns_info.items() if key != 'bots'}
+    bots = []
+    for bot in [tns_info] + list(tns_info.get('bots', [])):
+        if not bot.get('api_key', None):
+            continue
+        credentials = shared | {'bot_id': bot.get('bot_id', None), 'bot_name': bot.get('bot_name', None),
+                                'api_key': bot['api_key']}
+        credentials['marker'] = tns_marker(credentials['bot_id'], credentials['bot_name'])
+        bots.append(credentials)
+    if not bots:
+        logger.error("TNS API key not found in settings.py")
+    return bots
+
+
+def get_tns_bots():
+    """
+    The credentials of each configured TNS bot: the bot of the TNS settings first, then those listed under `bots`.
+    They are built once and shared, so don't modify them.
+    """
+    global _tns_bots
+    if _tns_bots is None:
+        with _tns_bots_lock:
+            if _tns_bots is None:
+                _tns_bots = _build_tns_bots()
+    return _tns_bots
+
+
+def _clear_tns_bots(setting, **kwargs):
+    global _tns_bots
+    if setting == 'DATA_SERVICES':
+        _tns_bots = None
+
+
+setting_changed.connect(_clear_tns_bots)
+
+
+def get_tns_credentials(bot_id=None):
     """
     Get the TNS credentials from settings.py.
     This should include the bot_id, bot_name, api_key, base_url, and group_name.
+    Returns the credentials of the bot `bot_id` if it is configured, otherwise of the bot pinned with
+    `use_tns_bot` in this thread, otherwise of the first bot. Returns an empty dictionary if no bot is configured.
+    """
+    bots = get_tns_bots()
+    if bot_id is not None:
+        for bot in bots:
+            if str(bot['bot_id']) == str(bot_id):
+                return bot
+    pinned = getattr(_local_bot, 'bot', None)
+    if pinned is not None:
+        return pinned
+    return bots[0] if bots else {}
+
+
+@contextmanager
+def use_tns_bot(bot):
+    """
+    Make all TNS requests in this thread use the credentials of `bot` (credentials or a bot ID) while the block is
+    active, e.g. so that a report, its files and its reply polls come from the same bot.
     """
+    previous = getattr(_local_bot, 'bot', None)
+    _local_bot.bot = get_tns_credentials(bot) if not isinstance(bot, dict) else bot
     try:
-        tns_info = settings.DATA_SERVICES['TNS']
+        yield _local_bot.bot
+    finally:
+        _local_bot.bot = previous
 
-        # Build TNS Marker using Bot info if API key is present
-        if tns_info.get('api_key', None):
-            tns_info['marker'] = 'tns_marker' + json.dumps({'tns_id': tns_info.get('bot_id', None),
-                                                            'type': 'bot',
-                                                            'name': tns_info.get('bot_name', None)})
-        else:
-            logger.error("TNS API key not found in settings.py")
-            tns_info = {}
-    except (KeyError, AttributeError):
-        logger.error("TNS credentials not found in settings.py")
-        tns_info = {}
-    return tns_info
+
+def bot_quota_key(bot_id):
+    return f'tns_bot_quota_{bot_id}'
+
+
+def record_bot_quota(tns_info, response):
+    """ Remember the remaining rate limit quota of a bot from the headers of a TNS response, until it resets
+    """
+    remaining = response.headers.get('x-rate-limit-remaining')
+    if remaining is None or not tns_info:
+        return
+    try:
+        reset = max(int(float(response.headers.get('x-rate-limit-reset') or 60)), 1)
+        cache.set(bot_quota_key(tns_info['bot_id']), int(remaining), reset)
+    except ValueError:
+        pass
+
+
+def choose_tns_bot():
+    """
+    Returns the credentials of the bot with the most rate limit quota left, taking turns between bots with the same
+    quota (bots whose quota isn't known yet count as unlimited). Choosing a bot doesn't charge its quota, which is
+    only updated by `record_bot_quota` from the responses to the requests actually sent. The bot pinned with
+    `use_tns_bot` in this thread is always used if there is one.
+    """
+    pinned = getattr(_local_bot, 'bot', None)
+    bots = get_tns_bots()
+    if pinned is not None or len(bots) < 2:
+        return pinned or (bots[0] if bots else {})
+    turn = next(_bot_turns) % len(bots)
+    bots = bots[turn:] + bots[:turn]
+    quotas = cache.get_many([bot_quota_key(bot['bot_id']) for bot in bots])
+    return max(bots, key=lambda bot: quotas.get(bot_quota_key(bot['bot_id']), float('inf')))
+
+
+def report_bot_key(report_id):
+    return f'tns_report_bot_{report_id}'
 
 
 def get_tns_values(option_list):
@@ -94,6 +215,7 @@ def get_tns_values(option_list):
     Returns a list of tuples, each tuple containing the option value and the option label.
     """
     all_tns_values = cache.get("all_tns_values", {})
+    increment('tom_tns_values_cache_total', cache='values', result='hit' if all_tns_values else 'miss')
     if not all_tns_values:
         all_tns_values, _ = populate_tns_values()
     selected_values = all_tns_values.get(option_list, [])
@@ -111,6 +233,7 @@ def get_reverse_tns_values(option_list, value):
     Returns a tuple of the option value and the option label.
     """
     reversed_tns_values = cache.get("reverse_tns_values", {})
+    increment('tom_tns_values_cache_total', cache='reverse_values', result='hit' if reversed_tns_values else 'miss')
     if not reversed_tns_values:
         _, reversed_tns_values = populate_tns_values()
     try:
@@ -120,50 +243,100 @@ def get_reverse_tns_values(option_list, value):
 
 
 def populate_tns_values():
-    """pull all the values from the TNS API and Cache for an hour"""
-    all_tns_values = {}
-    reversed_tns_values = {}
+    """
+    Pull all the values from the TNS API (or Hermes) and cache them for an hour.
+    Refreshes are conditional: the last download is kept with its ETag, Last-Modified date and content hash, and a
+    response that is `304 Not Modified` or has the same content hash only extends the cache timeout of the values,
+    without parsing them again. When the values did change, only the reverse maps of the option lists that changed
+    are rebuilt.
+    """
+    state = cache.get(TNS_VALUES_STATE) or {}
     if submit_through_hermes():
         # Get the tns values from the HERMES api
-        hermes_tns_options_url = urljoin(settings.DATA_SHARING.get('hermes', {}).get(
-            'BASE_URL', ''), 'api/v0/tns_options/')
+        url = urljoin(settings.DATA_SHARING.get('hermes', {}).get('BASE_URL', ''), 'api/v0/tns_options/')
         headers = {'Authorization': f"Token {settings.DATA_SHARING.get('hermes', {}).get('HERMES_API_KEY', '')}"}
-        try:
-            resp = requests.get(hermes_tns_options_url, headers=headers)
-            resp.raise_for_status()
-            all_tns_values = resp.json()
-        except Exception as e:
-            logging.warning(f"Failed to retrieve tns values from Hermes: {repr(e)}")
+        endpoint, source = 'hermes/tns_options', ' from Hermes'
     else:
         # Need to spoof a web based user agent or TNS will block the request :(
         SPOOF_USER_AGENT = 'Mozilla/5.0 (X11; Linux i686; rv:110.0) Gecko/20100101 Firefox/110.0.'
-
         # Use sandbox URL if no url found in settings.py
-        tns_base_url = get_tns_credentials().get('base_url', 'https://sandbox.wis-tns.org/')
-        try:
-            resp = requests.get(urljoin(tns_base_url, 'api/get/values/'),
-                                headers={'user-agent': SPOOF_USER_AGENT})
-            resp.raise_for_status()
-            all_tns_values = resp.json().get('data', {})
+        url = urljoin(get_tns_credentials().get('base_url', 'https://sandbox.wis-tns.org/'), 'api/get/values/')
+        headers = {'user-agent': SPOOF_USER_AGENT}
+        endpoint, source = 'values', ''
+    if state.get('url') != url:
+        state = {}
+    if state.get('etag'):
+        headers['If-None-Match'] = state['etag']
+    if state.get('last_modified'):
+        headers['If-Modified-Since'] = state['last_modified']
+
+    try:
+        with time_request(endpoint) as timing:
+            resp = requests.get(url, headers=headers)
+            timing['status'] = resp.status_code
+        resp.raise_for_status()
+        content_hash = hashlib.sha256(resp.content).hexdigest() if resp.status_code != 304 else state.get('hash')
+        if state and content_hash == state.get('hash'):
+            increment('tom_tns_values_refresh_total', result='unchanged')
+            return cache_tns_values(state, touch=True)
+        all_tns_values = resp.json()
+        if not submit_through_hermes():
+            all_tns_values = all_tns_values.get('data', {})
+    except Exception as e:
+        logging.warning(f"Failed to retrieve tns values{source}: {repr(e)}")
+        return {}, {}
+    if not all_tns_values:
+        return {}, {}
+
+    increment('tom_tns_values_refresh_total', result='changed')
+    return cache_tns_values({
+        'url': url,
+        'etag': resp.headers.get('ETag'),
+        'last_modified': resp.headers.get('Last-Modified'),
+        'hash': content_hash,
+        'values': all_tns_values,
+        'reversed': reverse_tns_values(all_tns_values, state.get('values'), state.get('reversed')),
+        # A cheap key for noticing that the values were refreshed, without reading them all
+        'version': time.time(),
+    })
+
+
+def cache_tns_values(state, touch=False):
+    """
+    Cache the TNS values, their reverse maps and their version from the state of the last download for an hour.
+    With `touch`, values that are still cached only have their timeout extended.
+    Returns the values and their reverse maps.
+    """
+    for key, value in [('all_tns_values', state['values']), ('reverse_tns_values', state['reversed']),
+                       ('tns_values_version', state['version'])]:
+        if not (touch and cache.touch(key, TNS_VALUES_TIMEOUT)):
+            cache.set(key, value, TNS_VALUES_TIMEOUT)
+    # The state outlives the values, so that the next refresh can be conditional
+    cache.set(TNS_VALUES_STATE, state, None)
+    return state['values'], state['reversed']
 
-        except Exception as e:
-            logging.warning(f"Failed to retrieve tns values: {repr(e)}")
 
-    if all_tns_values:
-        reversed_tns_values = reverse_tns_values(all_tns_values)
-        cache.set("all_tns_values", all_tns_values, 3600)
-        cache.set("reverse_tns_values", reversed_tns_values, 3600)
-    return all_tns_values, reversed_tns_values
+def reverse_option_list(values):
+    if isinstance(values, list):
+        return {value: index for index, value in enumerate(values)}
+    return {v: k for k, v in values.items()}
 
 
-def reverse_tns_values(all_tns_values):
-    """reverse the values from the TNS API"""
+def reverse_tns_values(all_tns_values, previous_values=None, previous_reversed=None):
+    """
+    reverse the values from the TNS API. The reverse maps of option lists that are the same in `previous_values`
+    are reused from `previous_reversed`.
+    """
+    previous_values = previous_values or {}
+    previous_reversed = previous_reversed or {}
     reversed_tns_values = {}
     for key, values in all_tns_values.items():
-        if isinstance(values, list):
-            reversed_tns_values[key] = {value: index for index, value in enumerate(values)}
-        elif isinstance(values, dict):
-            reversed_tns_values[key] = {v: k for k, v in values.items()}
+        if not isinstance(values, (list, dict)):
+            continue
+        if key in previous_reversed and previous_values.get(key) == values:
+            reversed_tns_values[key] = previous_reversed[key]
+        else:
+            reversed_tns_values[key] = reverse_option_list(values)
     return reversed_tns_values
 
 
@@ -190,21 +363,26 @@ def build_file_dict(files):
     return file_load, new_files
 
 
-def pre_upload_files_to_tns(files):
+def pre_upload_files_to_tns(files, deadline=None):
     """
     Upload files to the Transient Name Server according to this manual:
     https://sandbox.wis-tns.org/sites/default/files/api/TNS_bulk_reports_manual.pdf
+    The upload times out at the `deadline` (a `tom_tns.deadline.Deadline`), if given.
     """
-    tns_credentials = get_tns_credentials()
+    tns_credentials = choose_tns_bot()
     file_load, new_files = build_file_dict(files)
     if not file_load:
         return None
     # build request parameters
     tns_marker = tns_credentials['marker']
     upload_data = {'api_key': tns_credentials['api_key']}
-    response = requests.post(urljoin(tns_credentials['base_url'], 'api/set/file-upload'),
-                             headers={'User-Agent': tns_marker},
-                             data=upload_data, files=file_load)
+    with time_request('file-upload') as timing:
+        response = requests.post(urljoin(tns_credentials['base_url'], 'api/set/file-upload'),
+                                 headers={'User-Agent': tns_marker},
+                                 data=upload_data, files=file_load,
+                                 timeout=request_timeout(deadline, 'uploading files'))
+        timing['status'] = response.status_code
+    record_bot_quota(tns_credentials, response)
     response.raise_for_status()
     # If successful, TNS returns a list of new filenames
     new_filenames = response.json().get('data', {})
@@ -220,20 +398,26 @@ def pre_upload_files_to_tns(files):
     return new_files
 
 
-def send_tns_report(data):
+def send_tns_report(data, deadline=None):
     """
     Send a JSON bulk report to the Transient Name Server according to this manual:
     https://sandbox.wis-tns.org/sites/default/files/api/TNS_bulk_reports_manual.pdf
     Returns a report ID if successful.
     This ID can be used to retrieve the report from the TNS.
+    The request times out at the `deadline`, if given.
     """
-    tns_info = get_tns_credentials()
+    tns_info = choose_tns_bot()
     json_data = {'api_key': tns_info['api_key'], 'data': data}
-    response = requests.post(urljoin(tns_info['base_url'], 'api/set/bulk-report'),
-                             headers={'User-Agent': tns_info['marker']},
-                             data=json_data)
+    with time_request('bulk-report') as timing:
+        response = requests.post(urljoin(tns_info['base_url'], 'api/set/bulk-report'),
+                                 headers={'User-Agent': tns_info['marker']},
+                                 data=json_data, timeout=request_timeout(deadline, 'sending the report'))
+        timing['status'] = response.status_code
+    record_bot_quota(tns_info, response)
     response.raise_for_status()
     report_id = response.json()['data']['report_id']
+    # Replies are polled by the bot that sent the report
+    cache.set(report_bot_key(report_id), tns_info['bot_id'], 60 * 60 * 24)
     logger.info(f'Sent TNS report ID {report_id:d}')
     return report_id
 
@@ -272,17 +456,47 @@ def parse_object_from_tns_response(response_json, request):
     return iau_name
 
 
-def get_tns_report_reply(report_id, request):
+def request_tns_report_reply(report_id, request, deadline=None):
+    """
+    Request the reply to a bulk report from the Transient Name Server once. Returns the IAU name of the reported
+    object, or None if the TNS is still processing the report. Raises BadTnsRequest if the report failed.
+    """
+    tns_info = get_tns_credentials(cache.get(report_bot_key(report_id)))
+    reply_data = {'api_key': tns_info['api_key'], 'report_id': report_id}
+    with time_request('bulk-report-reply') as timing:
+        response = requests.post(urljoin(tns_info['base_url'], 'api/get/bulk-report-reply'),
+                                 headers={'User-Agent': tns_info['marker']}, data=reply_data,
+                                 timeout=request_timeout(deadline, 'getting the report reply'))
+        timing['status'] = response.status_code
+    record_bot_quota(tns_info, response)
+    # A 404 response means the report has not been processed yet
+    if response.status_code == 404:
+        return None
+    # A 400 response means the report failed with certain errors
+    elif response.status_code == 400:
+        raise BadTnsRequest(f"TNS submission failed with feedback: "
+                            f"{response.json().get('data', {}).get('feedback', {})}")
+    # A 200 response means the report was successful, and we can parse out the object name
+    elif response.status_code == 200:
+        iau_name = parse_object_from_tns_response(response.json(), request)
+        if not iau_name:
+            raise BadTnsRequest(f'The TNS reply to report {report_id} has no recognized feedback')
+        return iau_name
+    raise BadTnsRequest(f"TNS submission failed with status code {response.status_code}")
+
+
+def get_tns_report_reply(report_id, request, deadline=None):
     """
     Get feedback from the Transient Name Server in response to a bulk report according to this manual:
     https://sandbox.wis-tns.org/sites/default/files/api/TNS_bulk_reports_manual.pdf
 
     Posts an informational message in a banner on the page using ``request``
+    If a `deadline` is given, requests and waits are capped by it, and DeadlineExceeded is raised rather than
+    waiting past it for the report to be processed.
     """
     tns_info = get_tns_credentials()
     max_attempts = tns_info.get('report_max_attempts', 10)
     delay_seconds = tns_info.get('report_delay_seconds')
-    reply_data = {'api_key': tns_info['api_key'], 'report_id': report_id}
     iau_name = None
     attempts = 0
     # TNS Submissions return immediately with an id, which you must then check to see if the message
@@ -290,25 +504,176 @@ def get_tns_report_reply(report_id, request):
     # between checks. By default, the delay between checks increases by 1s with each check. You can
     # alter both the number of checks and the delay by setting `report_max_attempts` and `report_delay_seconds`
     # in your TNS info in settings.py. Under normal circumstances, it should be processed within a few seconds.
-    while attempts < max_attempts:
-        response = requests.post(urljoin(tns_info['base_url'], 'api/get/bulk-report-reply'),
-                                 headers={'User-Agent': tns_info['marker']}, data=reply_data)
-        attempts += 1
-        if not delay_seconds:
-            delay_seconds = attempts  # increase delay time with each attempt
-        # A 404 response means the report has not been processed yet
-        if response.status_code == 404:
-            time.sleep(delay_seconds)
-        # A 400 response means the report failed with certain errors
-        elif response.status_code == 400:
-            raise BadTnsRequest(f"TNS submission failed with feedback: "
-                                f"{response.json().get('data', {}).get('feedback', {})}")
-        # A 200 response means the report was successful, and we can parse out the object name
-        elif response.status_code == 200:
-            iau_name = parse_object_from_tns_response(response.json(), request)
-            break
-        else:
-            raise BadTnsRequest(f"TNS submission failed with status code {response.status_code}")
+    try:
+        while attempts < max_attempts:
+            attempts += 1
+            iau_name = request_tns_report_reply(report_id, request, deadline)
+            if iau_name:
+                break
+            if not delay_seconds:
+                delay_seconds = attempts  # increase delay time with each attempt
+            increment('tom_tns_retries_total', endpoint='bulk-report-reply')
+            with trace_span('poll_wait', attempt=attempts):
+                if deadline is not None:
+                    deadline.sleep(delay_seconds, f'the reply to report {report_id}')
+                else:
+                    time.sleep(delay_seconds)
+    finally:
+        observe('tom_tns_report_reply_attempts', attempts)
     if not iau_name:
         raise BadTnsRequest(f"TNS submission failed to be processed within 10 seconds. The report_id = {report_id}")
     return iau_name
+
+
+# In-flight TNS lookups keyed by cache key, so that concurrent identical lookups share one request
+_inflight_lookups = {}
+_inflight_lock = threading.Lock()
+
+
+def tns_object_cache_ttls():
+    """
+    Returns the number of seconds TNS lookups are cached for, by kind of result: 'classified', 'unclassified' and
+    'missing'. Each can be set with `object_cache_ttl` in your TNS settings, e.g. {'classified': 86400}.
+    """
+    ttls = {'classified': 86400, 'unclassified': 3600, 'missing': 300}
+    ttls.update(getattr(settings, 'DATA_SERVICES', {}).get('TNS', {}).get('object_cache_ttl', {}))
+    return ttls
+
+
+def tns_object_cache_ttl(tns_object):
+    """
+    Returns the number of seconds a TNS object lookup should be cached for (see `tns_object_cache_ttls`).
+    Classified objects rarely change so are kept longer than unclassified ones, and failed lookups the shortest.
+    """
+    ttls = tns_object_cache_ttls()
+    if not tns_object:
+        return ttls['missing']
+    if tns_object.get('name_prefix', 'AT') != 'AT' or (tns_object.get('object_type') or {}).get('name'):
+        return ttls['classified']
+    return ttls['unclassified']
+
+
+def tns_objname(name):
+    """ Strip the prefix from an IAU name, e.g. AT 2024abc -> 2024abc, as expected by the TNS API
+    """
+    return re.sub(r'^[A-Za-z]+\s*(?=\d{4}[a-z]+$)', '', name.strip())
+
+
+def cached_tns_lookup(cache_key, fetch, ttl=tns_object_cache_ttl):
+    """
+    Read-through cache for TNS lookups.
+    Returns the cached result for `cache_key` if present. Otherwise calls `fetch()` and caches its result for
+    `ttl(result)` seconds. Concurrent calls for the same key in this process wait for the first call's result
+    rather than repeating the request.
+    """
+    cached = cache.get(cache_key)
+    if cached is not None:
+        # Empty results are cached as {} so that misses are cached too
+        return cached or None
+    with _inflight_lock:
+        future = _inflight_lookups.get(cache_key)
+        leader = future is None
+        if leader:
+            future = _inflight_lookups[cache_key] = Future()
+    if not leader:
+        return future.result()
+    try:
+        result = fetch()
+        cache.set(cache_key, result or {}, ttl(result))
+        future.set_result(result)
+        return result
+    except Exception as e:
+        future.set_exception(e)
+        raise
+    finally:
+        with _inflight_lock:
+            del _inflight_lookups[cache_key]
+
+
+def lookup_timeout():
+    """ The timeout of a single TNS query: `lookup_timeout` seconds (setting, default 10) """
+    return getattr(settings, 'DATA_SERVICES', {}).get('TNS', {}).get('lookup_timeout', LOOKUP_TIMEOUT)
+
+
+def _tns_get(endpoint, data, deadline=None):
+    """
+    Post a query to one of the TNS `api/get` endpoints and return its reply.
+    Depending on the API version, the reply is either the `data` section itself or `data['reply']`.
+    The request times out at the `deadline`, if given, or else after `lookup_timeout` seconds (setting, default 10).
+    """
+    tns_info = choose_tns_bot()
+    timeout = request_timeout(deadline, f'querying {endpoint}')
+    if timeout is None:
+        timeout = lookup_timeout()
+    with time_request(endpoint.replace('api/get/', '')) as timing:
+        response = requests.post(urljoin(tns_info['base_url'], endpoint),
+                                 headers={'User-Agent': tns_info['marker']},
+                                 data={'api_key': tns_info['api_key'], 'data': json.dumps(data)}, timeout=timeout)
+        timing['status'] = response.status_code
+    record_bot_quota(tns_info, response)
+    response.raise_for_status()
+    reply = response.json().get('data', {})
+    if isinstance(reply, dict) and 'reply' in reply:
+        reply = reply['reply']
+    return reply
+
+
+def search_tns(**query):
+    """
+    Search the TNS for objects using `api/get/search`, e.g. ``search_tns(ra=10.1, dec=-20.2, radius=5, units='arcsec')``
+    or ``search_tns(internal_name='ZTF24aaa')``. Results are cached for the unclassified object TTL.
+    Returns a list of dictionaries with the `objname`, `prefix` and `objid` of each match.
+    """
+    cache_key = 'tns_search_' + json.dumps(query, sort_keys=True).replace(' ', '')
+
+    def fetch():
+        reply = _tns_get('api/get/search', query)
+        return reply if isinstance(reply, list) else []
+
+    ttl = tns_object_cache_ttls()['unclassified']
+    return cached_tns_lookup(cache_key, fetch, ttl=lambda _: ttl) or []
+
+
+def get_tns_object(name):
+    """
+    Retrieve the details of a TNS object (name, classification, redshift, reporting groups, ...) with
+    `api/get/object`, going through a read-through cache with per-object TTLs (see `tns_object_cache_ttl`).
+    Returns the object dictionary, or None if the TNS has no such object.
+    """
+    objname = tns_objname(name)
+
+    def fetch():
+        reply = _tns_get('api/get/object', {'objname': objname, 'photometry': '0', 'spectra': '0'})
+        if isinstance(reply, dict) and reply.get('objname'):
+            return reply
+        return None
+
+    return cached_tns_lookup(f'tns_object_{objname}', fetch)
+
+
+def get_tns_objects(names, max_workers=None):
+    """
+    Retrieve many TNS objects at once. Cached objects are read in a single cache round trip and the remaining ones
+    are fetched with at most `max_workers` concurrent requests (`lookup_concurrency` in settings, defaulting to 4).
+    Returns a dictionary of the given names to their TNS object or None. Failed lookups are logged and return None.
+    """
+    objnames = {name: tns_objname(name) for name in names}
+    cached = cache.get_many([f'tns_object_{objname}' for objname in objnames.values()])
+    results = {}
+    missing = []
+    for name, objname in objnames.items():
+        if f'tns_object_{objname}' in cached:
+            results[name] = cached[f'tns_object_{objname}'] or None
+        else:
+            missing.append(name)
+    if missing:
+        max_workers = max_workers or settings.DATA_SERVICES.get('TNS', {}).get('lookup_concurrency', 4)
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {name: executor.submit(get_tns_object, name) for name in missing}
+        for name, future in futures.items():
+            try:
+                results[name] = future.result()
+            except (requests.exceptions.RequestException, ValueError) as e:
+                logger.warning(f'Failed to retrieve {name} from the TNS: {repr(e)}')
+                results[name] = None
+    return results
@@ -0,0 +1,119 @@
+import json
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+from django.conf import settings
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+_local = threading.local()
+_export_lock = threading.Lock()
+
+
+class SubmissionTrace:
+    """
+    A timeline of the phases of one TNS/Hermes submission.
+    Each span records its wall-clock duration and the CPU time spent by this thread during it, so that time spent
+    waiting on the network can be told apart from local processing.
+    """
+    def __init__(self, name, **attributes):
+        self.trace_id = uuid.uuid4().hex
+        self.name = name
+        self.attributes = attributes
+        self.started = datetime.now(timezone.utc)
+        self.start = time.perf_counter()
+        self.start_cpu = time.thread_time()
+        self.duration = None
+        self.cpu_time = None
+        self.spans = []
+        self.stack = []
+
+    @contextmanager
+    def span(self, name, **attributes):
+        record = {'name': name, 'parent': self.stack[-1]['name'] if self.stack else None,
+                  'start': time.perf_counter() - self.start, 'attributes': attributes}
+        self.spans.append(record)
+        self.stack.append(record)
+        start_cpu = time.thread_time()
+        try:
+            yield record['attributes']
+        except Exception as e:
+            record['error'] = repr(e)
+            raise
+        finally:
+            record['duration'] = time.perf_counter() - self.start - record['start']
+            record['cpu_time'] = time.thread_time() - start_cpu
+            self.stack.pop()
+
+    def finish(self):
+        self.duration = time.perf_counter() - self.start
+        self.cpu_time = time.thread_time() - self.start_cpu
+
+    def as_dict(self):
+        return {
+            'trace_id': self.trace_id,
+            'name': self.name,
+            'started': self.started.isoformat(),
+            'duration': self.duration,
+            'cpu_time': self.cpu_time,
+            'attributes': self.attributes,
+            'spans': self.spans,
+        }
+
+
+def current_trace():
+    """ Returns the SubmissionTrace active in this thread, if any
+    """
+    return getattr(_local, 'trace', None)
+
+
+@contextmanager
+def start_trace(name, **attributes):
+    """
+    Trace a submission. Spans opened with `trace_span` in this thread while the trace is active are added to it,
+    and the trace is exported when the block exits.
+    """
+    trace = SubmissionTrace(name, **attributes)
+    previous_trace = current_trace()
+    _local.trace = trace
+    try:
+        yield trace
+    finally:
+        _local.trace = previous_trace
+        trace.finish()
+        export_trace(trace)
+
+
+@contextmanager
+def trace_span(name, **attributes):
+    """
+    Record a phase of the active submission trace. Does nothing if no trace is active in this thread.
+    Yields a dictionary of span attributes that can be added to from within the block.
+    """
+    trace = current_trace()
+    if trace is None:
+        yield attributes
+        return
+    with trace.span(name, **attributes) as span_attributes:
+        yield span_attributes
+
+
+def export_trace(trace):
+    """
+    Append a finished trace as one JSON line to the file set by `trace_file` in the TNS settings.
+    Traces are not stored if no file is configured.
+    """
+    trace_file = getattr(settings, 'DATA_SERVICES', {}).get('TNS', {}).get('trace_file')
+    if not trace_file:
+        return
+    line = json.dumps(trace.as_dict(), default=str)
+    try:
+        with _export_lock, open(trace_file, 'a') as f:
+            f.write(line + '\n')
+    except OSError as e:
+        logger.warning(f'Failed to export TNS submission trace {trace.trace_id}: {repr(e)}')
@@ -0,0 +1,152 @@
+"""
+Conversion of photometry between the flux units of the TOM, the TNS and Hermes: AB and Vega magnitudes, mJy, and
+erg / s / cm² / Å. Conversions work on whole arrays, so that a light curve is converted with one call:
+
+    brightness, brightness_error = convert_flux(brightness, brightness_error, from_units=units, to_unit='AB mag',
+                                                filters=bandpasses)
+
+Vega magnitudes and erg / s / cm² / Å need per-filter zero points (the AB - Vega offset and the pivot wavelength
+of the filter). Defaults are provided for common filters, and can be extended with `vega_ab_offsets` and
+`pivot_wavelengths` in the TNS settings. Values that can't be converted are returned as NaN.
+"""
+import re
+
+import numpy as np
+from django.conf import settings
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+AB_MAG = 'AB mag'
+VEGA_MAG = 'Vega mag'
+MJY = 'mJy'
+FLAM = 'erg / s / cm² / Å'
+MAGNITUDE_UNITS = {AB_MAG, VEGA_MAG}
+UNIT_ALIASES = {
+    AB_MAG: ['abmag', 'ab', 'mag', 'magab', 'abmagnitude'],
+    VEGA_MAG: ['vegamag', 'vega', 'magvega', 'vegamagnitude'],
+    MJY: ['mjy', 'millijansky'],
+    FLAM: ['ergscm²å', 'ergscm2a', 'ergscm2å', 'ergcm2s1a1', 'ergcm2sec1a1', 'ergs1cm2a1', 'flam'],
+}
+_UNITS = {alias: unit for unit, aliases in UNIT_ALIASES.items() for alias in aliases + [unit.lower()]}
+
+# 1 mJy in erg / s / cm² / Hz, the AB magnitude of 1 mJy, and the speed of light in Å / s
+MJY_CGS = 1e-26
+AB_MAG_MJY = 2.5 * np.log10(3631e3)
+SPEED_OF_LIGHT = 2.99792458e18
+MAG_ERROR_FACTOR = 2.5 / np.log(10)
+
+# m_AB - m_Vega (Blanton & Roweis 2007 for SDSS, Breeveld et al. 2011 for Johnson-Cousins, 2MASS for JHK)
+VEGA_AB_OFFSETS = {
+    'U': 0.79, 'B': -0.09, 'V': 0.02, 'R': 0.21, 'I': 0.45, 'J': 0.91, 'H': 1.39, 'K': 1.85, 'Ks': 1.85,
+    'u': 0.91, 'g': -0.08, 'r': 0.16, 'i': 0.37, 'z': 0.54,
+}
+# Pivot wavelengths in Å
+PIVOT_WAVELENGTHS = {
+    'U': 3660, 'B': 4380, 'V': 5450, 'R': 6410, 'I': 7980, 'J': 12350, 'H': 16620, 'K': 21590, 'Ks': 21590,
+    'u': 3560, 'g': 4830, 'r': 6260, 'i': 7670, 'z': 9100, 'y': 9620, 'c': 5330, 'o': 6790, 'G': 6730,
+}
+
+
+def normalize_unit(name):
+    """ Returns the unit (one of AB_MAG, VEGA_MAG, MJY or FLAM) for a unit name in any common spelling, or None
+    """
+    if not name:
+        return None
+    return _UNITS.get(re.sub(r'[\s/()^*.\-]+', '', str(name)).lower())
+
+
+def filter_key(name):
+    """ The short name of a filter, e.g. r-Sloan -> r, V-Johnson -> V
+    """
+    return str(name).strip().split('-')[0].split(' ')[0]
+
+
+def zero_points(filters, table, setting):
+    """ Look up a per-filter zero point for an array of filter names, once per distinct filter. Unknown filters are NaN
+    """
+    table = table | getattr(settings, 'DATA_SERVICES', {}).get('TNS', {}).get(setting, {})
+    names, inverse = np.unique(np.asarray(filters, dtype=str), return_inverse=True)
+    values = np.array([table.get(name, table.get(filter_key(name), np.nan)) for name in names.tolist()], dtype=float)
+    return values[inverse.ravel()]
+
+
+def to_mjy(values, errors, unit, filters):
+    """ Convert values in `unit` to flux densities in mJy, with their errors
+    """
+    if unit in MAGNITUDE_UNITS:
+        ab_mag = values
+        if unit == VEGA_MAG:
+            ab_mag = values + zero_points(filters, VEGA_AB_OFFSETS, 'vega_ab_offsets')
+        flux = 10 ** (-0.4 * (ab_mag - AB_MAG_MJY))
+        return flux, flux * errors / MAG_ERROR_FACTOR
+    if unit == FLAM:
+        # f_nu = f_lambda * lambda^2 / c
+        scale = zero_points(filters, PIVOT_WAVELENGTHS, 'pivot_wavelengths') ** 2 / SPEED_OF_LIGHT / MJY_CGS
+        return values * scale, errors * scale
+    return values, errors
+
+
+def from_mjy(flux, errors, unit, filters):
+    """ Convert flux densities in mJy, with their errors, to `unit`
+    """
+    if unit in MAGNITUDE_UNITS:
+        with np.errstate(divide='ignore', invalid='ignore'):
+            positive = np.where(flux > 0, flux, np.nan)
+            mag = AB_MAG_MJY - 2.5 * np.log10(positive)
+            mag_errors = MAG_ERROR_FACTOR * errors / positive
+        if unit == VEGA_MAG:
+            mag = mag - zero_points(filters, VEGA_AB_OFFSETS, 'vega_ab_offsets')
+        return mag, mag_errors
+    if unit == FLAM:
+        scale = SPEED_OF_LIGHT * MJY_CGS / zero_points(filters, PIVOT_WAVELENGTHS, 'pivot_wavelengths') ** 2
+        return flux * scale, errors * scale
+    return flux, errors
+
+
+def convert_flux(values, errors=None, from_units=AB_MAG, to_unit=AB_MAG, filters=''):
+    """
+    Convert brightnesses (or limits) and their errors between flux units, in any common spelling (see
+    `normalize_unit`). `values`, `errors`, `from_units` and `filters` may be arrays of the same length, e.g. a light
+    curve with mixed units; each distinct source unit is converted in one vectorized pass. Missing values and errors
+    may be given as None. Values with an empty source unit are assumed to be in `to_unit` already.
+    Returns arrays of the converted values and errors, with NaN where a value is missing or can't be converted
+    (an unknown unit or filter, or a negative flux as a magnitude).
+    """
+    values = np.asarray(values, dtype=float)
+    errors = np.full(values.shape, np.nan) if errors is None else np.asarray(errors, dtype=float)
+    filters = np.broadcast_to(np.asarray(filters, dtype=str), values.shape)
+    from_units = np.broadcast_to(np.asarray(from_units, dtype=str), values.shape)
+    target = normalize_unit(to_unit)
+    if target is None:
+        raise ValueError(f'Unknown flux unit {to_unit!r}')
+
+    converted = np.full(values.shape, np.nan)
+    converted_errors = np.full(values.shape, np.nan)
+    for unit_name in np.unique(from_units).tolist():
+        mask = from_units == unit_name
+        unit = normalize_unit(unit_name) if unit_name else target
+        if unit is None:
+            logger.warning(f'Cannot convert photometry in unknown units {unit_name!r}')
+            continue
+        if unit == target:
+            converted[mask], converted_errors[mask] = values[mask], errors[mask]
+        elif unit in MAGNITUDE_UNITS and target in MAGNITUDE_UNITS:
+            # Only an offset between magnitude systems, the errors are unchanged
+            offsets = zero_points(filters[mask], VEGA_AB_OFFSETS, 'vega_ab_offsets')
+            converted[mask] = values[mask] + (offsets if unit == VEGA_MAG else -offsets)
+            converted_errors[mask] = errors[mask]
+        else:
+            flux, flux_errors = to_mjy(values[mask], errors[mask], unit, filters[mask])
+            converted[mask], converted_errors[mask] = from_mjy(flux, flux_errors, target, filters[mask])
+    return converted, converted_errors
+
+
+def tns_unit_option(unit, options):
+    """
+    Returns the (ID, label) of the TNS or Hermes unit option for a unit, given the options as (ID, label) pairs,
+    or None if there is no such option.
+    """
+    unit = normalize_unit(unit)
+    return next(((option_id, label) for option_id, label in options if normalize_unit(label) == unit), None)
@@ -0,0 +1,239 @@
+import threading
+from datetime import datetime
+
+from django.core.cache import cache
+
+from tom_tns.reports import TNS_DATETIME_FORMAT
+from tom_tns.tns_api import BadTnsRequest, populate_tns_values
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+# The TNS option lists whose IDs are referenced by each field of a bulk report
+ID_FIELDS = {
+    'reporting_groupid': 'groups',
+    'data_source_groupid': 'groups',
+    'groupid': 'groups',
+    'at_type': 'at_types',
+    'archiveid': 'archives',
+    'flux_unitid': 'units',
+    'filterid': 'filters',
+    'instrumentid': 'instruments',
+    'objtypeid': 'objtypes',
+    'spectypeid': 'spectra_types',
+}
+NONDETECTION_FIELDS = ['obsdate', 'limiting_flux', 'flux_unitid', 'filterid', 'instrumentid']
+
+
+class InvalidTnsReport(BadTnsRequest):
+    """ Raised when a bulk report fails validation before it is sent to the TNS. `errors` lists every problem found
+    """
+    def __init__(self, errors):
+        self.errors = errors
+        super().__init__('; '.join(errors))
+
+
+def is_set(value):
+    return value is not None and value != ''
+
+
+def is_number(value):
+    try:
+        float(value)
+    except (TypeError, ValueError):
+        return False
+    return True
+
+
+class ReportValidator:
+    """
+    Validates TNS bulk reports (as produced by the `generate_tns_report` methods of the TNS forms) against the bulk
+    report schema and a set of TNS option values, without contacting the TNS.
+    The sets of valid option IDs are built once when the validator is created.
+    """
+    def __init__(self, tns_values, version=None):
+        self.tns_values = tns_values
+        self.version = version
+        self.valid_ids = {}
+        for option_list, values in tns_values.items():
+            if isinstance(values, list):
+                self.valid_ids[option_list] = frozenset(str(i) for i in range(len(values)))
+            elif isinstance(values, dict):
+                self.valid_ids[option_list] = frozenset(str(key) for key in values)
+
+    def validate(self, report, now=None):
+        """ Returns a list of all errors found in the report, or an empty list if it is valid
+        """
+        now = now or datetime.utcnow()
+        errors = []
+        if not isinstance(report, dict) or not report:
+            return ['The report is empty']
+        for section, entries in report.items():
+            check = {'at_report': self.check_at_report,
+                     'classification_report': self.check_classification_report}.get(section)
+            if check is None:
+                errors.append(f'Unknown report section {section!r}')
+                continue
+            for key, entry in self.items(entries, section, errors):
+                check(entry, f'{section}.{key}', errors, now)
+        return errors
+
+    def items(self, entries, path, errors):
+        if not isinstance(entries, dict) or not entries:
+            errors.append(f'{path}: must contain at least one entry')
+            return []
+        return entries.items()
+
+    def check_id(self, entry, field, path, errors, required=True):
+        value = entry.get(field)
+        if not is_set(value):
+            if required:
+                errors.append(f'{path}.{field}: is required')
+            return
+        option_list = ID_FIELDS[field]
+        valid_ids = self.valid_ids.get(option_list)
+        # Option lists missing from the TNS values can't be checked
+        if valid_ids is not None and str(value) not in valid_ids:
+            errors.append(f'{path}.{field}: {value!r} is not a valid TNS {option_list} ID')
+
+    def check_required(self, entry, field, path, errors):
+        if not is_set(entry.get(field)):
+            errors.append(f'{path}.{field}: is required')
+
+    def check_number(self, entry, field, path, errors, required=False, minimum=None):
+        value = entry.get(field)
+        if not is_set(value):
+            if required:
+                errors.append(f'{path}.{field}: is required')
+            return None
+        if not is_number(value):
+            errors.append(f'{path}.{field}: {value!r} is not a number')
+            return None
+        if minimum is not None and float(value) < minimum:
+            errors.append(f'{path}.{field}: must be at least {minimum}')
+        return float(value)
+
+    def check_date(self, entry, field, path, errors, now, required=True):
+        value = entry.get(field)
+        if not is_set(value):
+            if required:
+                errors.append(f'{path}.{field}: is required')
+            return None
+        try:
+            date = datetime.strptime(value, TNS_DATETIME_FORMAT)
+        except (TypeError, ValueError):
+            errors.append(f'{path}.{field}: {value!r} is not a date in the format YYYY-MM-DD HH:MM:SS')
+            return None
+        if date > now:
+            errors.append(f'{path}.{field}: {value} is in the future')
+        return date
+
+    def check_coordinates(self, entry, path, errors):
+        for field, low, high in [('ra', 0, 360), ('dec', -90, 90)]:
+            value = entry.get(field)
+            value = value.get('value') if isinstance(value, dict) else None
+            if not is_set(value):
+                errors.append(f'{path}.{field}.value: is required')
+            elif not is_number(value):
+                errors.append(f'{path}.{field}.value: {value!r} is not a number')
+            elif not low <= float(value) <= high:
+                errors.append(f'{path}.{field}.value: {value} is outside the range [{low}, {high}]')
+
+    def check_at_report(self, entry, path, errors, now):
+        self.check_coordinates(entry, path, errors)
+        self.check_id(entry, 'reporting_groupid', path, errors)
+        self.check_id(entry, 'data_source_groupid', path, errors)
+        self.check_id(entry, 'at_type', path, errors)
+        self.check_required(entry, 'reporter', path, errors)
+        discovery_date = self.check_date(entry, 'discovery_datetime', path, errors, now)
+
+        # The last non-detection is given either by an archive search, or by a non-detection limit
+        nondetection = entry.get('non_detection') or {}
+        nondetection_path = f'{path}.non_detection'
+        nondetection_date = None
+        if is_set(nondetection.get('archiveid')) and is_set(nondetection.get('archival_remarks')):
+            self.check_id(nondetection, 'archiveid', nondetection_path, errors)
+        elif all(is_set(nondetection.get(field)) for field in NONDETECTION_FIELDS):
+            nondetection_date = self.check_date(nondetection, 'obsdate', nondetection_path, errors, now)
+            self.check_number(nondetection, 'limiting_flux', nondetection_path, errors)
+            self.check_id(nondetection, 'flux_unitid', nondetection_path, errors)
+            self.check_id(nondetection, 'filterid', nondetection_path, errors)
+            self.check_id(nondetection, 'instrumentid', nondetection_path, errors)
+            self.check_number(nondetection, 'exptime', nondetection_path, errors, minimum=0)
+            if nondetection_date and discovery_date and nondetection_date >= discovery_date:
+                errors.append(f'{nondetection_path}.obsdate: must be before the discovery date')
+        else:
+            errors.append(f'{nondetection_path}: must give either archiveid and archival_remarks, '
+                          f'or {", ".join(NONDETECTION_FIELDS)}')
+
+        photometry_groups = (entry.get('photometry') or {}).get('photometry_group')
+        group_path = f'{path}.photometry.photometry_group'
+        for key, group in self.items(photometry_groups, group_path, errors):
+            self.check_photometry(group, f'{group_path}.{key}', errors, now, nondetection_date)
+
+    def check_photometry(self, group, path, errors, now, nondetection_date):
+        obsdate = self.check_date(group, 'obsdate', path, errors, now)
+        if obsdate and nondetection_date and obsdate <= nondetection_date:
+            errors.append(f'{path}.obsdate: must be after the last non-detection')
+        flux = self.check_number(group, 'flux', path, errors)
+        limiting_flux = self.check_number(group, 'limiting_flux', path, errors)
+        if flux is None and limiting_flux is None:
+            errors.append(f'{path}: must give a flux or a limiting_flux')
+        if flux is not None:
+            self.check_number(group, 'flux_error', path, errors, minimum=0)
+        self.check_id(group, 'flux_unitid', path, errors)
+        self.check_id(group, 'filterid', path, errors)
+        self.check_id(group, 'instrumentid', path, errors)
+        self.check_number(group, 'exptime', path, errors, minimum=0)
+
+    def check_classification_report(self, entry, path, errors, now):
+        self.check_required(entry, 'name', path, errors)
+        self.check_required(entry, 'classifier', path, errors)
+        self.check_id(entry, 'objtypeid', path, errors)
+        self.check_id(entry, 'groupid', path, errors)
+        self.check_number(entry, 'redshift', path, errors, minimum=0)
+        spectra_groups = (entry.get('spectra') or {}).get('spectra-group')
+        group_path = f'{path}.spectra.spectra-group'
+        for key, group in self.items(spectra_groups, group_path, errors):
+            spectrum_path = f'{group_path}.{key}'
+            self.check_date(group, 'obsdate', spectrum_path, errors, now)
+            self.check_id(group, 'instrumentid', spectrum_path, errors)
+            self.check_id(group, 'spectypeid', spectrum_path, errors)
+            self.check_required(group, 'observer', spectrum_path, errors)
+            self.check_required(group, 'ascii_file', spectrum_path, errors)
+            self.check_number(group, 'exptime', spectrum_path, errors, minimum=0)
+
+
+_validator = None
+_validator_lock = threading.Lock()
+
+
+def get_report_validator():
+    """
+    Returns a ReportValidator for the cached TNS option values.
+    The validator is only rebuilt when the TNS values change.
+    """
+    global _validator
+    version = cache.get('tns_values_version')
+    with _validator_lock:
+        if version is not None and _validator is not None and _validator.version == version:
+            return _validator
+    tns_values = cache.get('all_tns_values')
+    if not tns_values:
+        tns_values, _ = populate_tns_values()
+        version = cache.get('tns_values_version')
+    with _validator_lock:
+        if _validator is None or _validator.tns_values != tns_values:
+            _validator = ReportValidator(tns_values)
+        _validator.version = version
+        return _validator
+
+
+def validate_tns_report(report):
+    """ Check a TNS bulk report before it is sent. Raises InvalidTnsReport listing every error found
+    """
+    errors = get_report_validator().validate(report)
+    if errors:
+        logger.warning(f'Invalid TNS report: {errors}')
+        raise InvalidTnsReport(errors)
@@ -1,22 +1,40 @@
 import requests.exceptions
 
-from django.urls import reverse_lazy
+from django.urls import reverse, reverse_lazy
 from django.views.generic.edit import FormView
-from django.views.generic.base import TemplateView
-from django.http import HttpResponseRedirect
+from django.views.generic.base import TemplateView, View
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseRedirect, Http404, JsonResponse, StreamingHttpResponse
 from django.contrib import messages
+from django.contrib.auth.mixins import LoginRequiredMixin
+from django.db import IntegrityError
 from guardian.mixins import PermissionListMixin
 
 from tom_tns import __version__
-from tom_tns.tns_api import (send_tns_report, get_tns_report_reply, get_tns_credentials,
-                             submit_through_hermes, BadTnsRequest)
+from tom_tns.deadline import DeadlineExceeded, submission_deadline
+from tom_tns.tns_api import (send_tns_report, get_tns_report_reply, get_tns_credentials, choose_tns_bot,
+                             use_tns_bot, submit_through_hermes, BadTnsRequest)
 from tom_tns.hermes_api import submit_to_hermes
-from tom_targets.models import Target, TargetName
+from tom_tns.ledger import (DuplicateSubmission, duplicate_message, find_duplicate_submission, finish_submission,
+                            start_submission, submission_hash)
+from tom_tns.metrics import get_metrics_sink, PrometheusSink
+from tom_tns.models import TNSSubmission
+from tom_tns.profiling import ProfiledViewMixin
+from tom_tns.renaming import rename_targets
+from tom_tns.replies import get_report_reply, reply_is_final, reply_settings, wait_for_report_reply, watch_report_reply
+from tom_tns.spectra import spectrum_file_choices
+from tom_tns.tracing import start_trace, trace_span
+from tom_tns.status import get_tns_status, TNS_STATUS_REPORTED, TNS_STATUS_CLASSIFIED
+from tom_tns.submissions import queue_submission, queue_submissions_enabled
+from tom_tns.validation import InvalidTnsReport, validate_tns_report
+from tom_targets.models import Target
+from tom_targets.permissions import targets_for_user
 
 import json
+import time
 
 
-class TNSFormView(PermissionListMixin, TemplateView):
+class TNSFormView(ProfiledViewMixin, PermissionListMixin, TemplateView):
     """
     This view is used to display the TNS report forms.
     The default form is the report form, but if the target name starts with AT, we switch to the classification form.
@@ -25,24 +43,26 @@ class TNSFormView(PermissionListMixin, TemplateView):
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
-        context['default_form'] = 'report'
         target = Target.objects.get(pk=self.kwargs['pk'])
         context['tns_configured'] = submit_through_hermes() or bool(get_tns_credentials())
         context['target'] = target
         context['version'] = __version__  # from tom_tns.__init__.py
+        # A report whose reply is followed live on the page, see TNSSubmitView.watch_reply
+        context['report_id'] = self.request.GET.get('report_id', '')
         # We want to establish a default tab to display.
         # by default, we start on report, but change to classify if the target name starts with AT.
         # If the target has an SN name, we warn the user that the target has likely been classified already.
-        for name in target.names:
-            if name.upper().startswith('AT'):
-                context['default_form'] = 'classify'
-            if name.upper().startswith('SN'):
-                context['default_form'] = 'supernova'
-                break
+        tns_status = get_tns_status(target)
+        if tns_status == TNS_STATUS_CLASSIFIED:
+            context['default_form'] = 'supernova'
+        elif tns_status == TNS_STATUS_REPORTED:
+            context['default_form'] = 'classify'
+        else:
+            context['default_form'] = 'report'
         return context
 
 
-class TNSSubmitView(FormView):
+class TNSSubmitView(ProfiledViewMixin, FormView):
     """
     This View is used to submit the TNS report forms.
     """
@@ -50,13 +70,8 @@ class TNSSubmitView(FormView):
         # Must override get_initial to pass in the file choice options or it will fail validation
         initial = super().get_initial()
         target = Target.objects.get(pk=self.kwargs['pk'])
-        ascii_files = []
-        fits_files = [(None, '')]
-        for data_product in target.dataproduct_set.all():
-            if data_product.get_file_extension().lower() in ['.ascii', '.txt']:
-                ascii_files.append((data_product.pk, data_product.get_file_name()))
-            elif data_product.get_file_extension().lower() in ['.fits', '.fits.fz']:
-                fits_files.append((data_product.pk, data_product.get_file_name()))
+        ascii_files, fits_files = spectrum_file_choices(target)
+        fits_files = [(None, '')] + fits_files
         initial['ascii_file_choices'] = ascii_files
         initial['fits_file_choices'] = fits_files
         return initial
@@ -64,6 +79,17 @@ class TNSSubmitView(FormView):
     def get_success_url(self):
         return reverse_lazy('targets:detail', kwargs=self.kwargs)
 
+    def post(self, request, *args, **kwargs):
+        # Trace the phases of each submission, so slow submissions can be broken down afterwards
+        # A report, its files and its reply polls all come from one bot, the one with the most quota left
+        with start_trace('tns_submission', target_id=self.kwargs['pk'], form=self.get_form_class().__name__,
+                         hermes=submit_through_hermes()), use_tns_bot(choose_tns_bot()):
+            return super().post(request, *args, **kwargs)
+
+    def get_form(self, form_class=None):
+        with trace_span('build_form'):
+            return super().get_form(form_class)
+
     def form_invalid(self, form):
         messages.error(self.request, 'The following error was encountered when submitting to the TNS: '
                                      f'{form.errors.as_json()}')
@@ -72,30 +98,191 @@ class TNSSubmitView(FormView):
     def form_valid(self, form):
         """
         If the Form is successfully constructed, we generate the TNS report and submit it to the TNS.
+        Each submission is recorded in the TNSSubmission ledger first, and is not sent if it repeats an earlier or
+        in-flight one (see `tom_tns.ledger`).
+        All requests and waits share the `submission_deadline_seconds` budget. Work left when it runs out is handed
+        to the `tns_worker` command: the whole submission if it wasn't sent yet, or the wait for the TNS reply.
         """
+        payload_hash = submission_hash(form)
+        # Spare building the report of an obvious duplicate: the check is repeated when the submission is recorded
+        with trace_span('find_duplicate_submission'):
+            duplicate = find_duplicate_submission(self.kwargs['pk'], payload_hash)
+        if duplicate is not None:
+            messages.info(self.request, duplicate_message(duplicate))
+            return HttpResponseRedirect(self.get_success_url())
+        if queue_submissions_enabled():
+            return self.queue_submission(form, payload_hash)
+        hermes = submit_through_hermes()
         try:
-            iau_name = None
-            if submit_through_hermes():
-                hermes_report, files = form.generate_hermes_report()
-                iau_name = submit_to_hermes(hermes_report, files, self.request)
+            submission = start_submission(
+                self.kwargs['pk'], payload_hash, self.request.user,
+                destination=TNSSubmission.DESTINATION_HERMES if hermes else TNSSubmission.DESTINATION_TNS,
+                bot_id='hermes' if hermes else str(get_tns_credentials().get('bot_id', '')))
+        except DuplicateSubmission as e:
+            messages.info(self.request, duplicate_message(e.submission))
+            return HttpResponseRedirect(self.get_success_url())
+        if submission is None:
+            messages.info(self.request, 'This report is already being submitted, so it was not sent again.')
+            return HttpResponseRedirect(self.get_success_url())
+        deadline = submission_deadline()
+        sending = False
+        iau_name, error = None, ''
+        try:
+            if hermes:
+                with trace_span('generate_hermes_report'):
+                    hermes_report, files = form.generate_hermes_report()
+                self.record_payload(submission, hermes_report)
+                sending = True
+                with trace_span('submit_to_hermes'):
+                    iau_name = submit_to_hermes(hermes_report, files, self.request, deadline)
+                if not iau_name:
+                    error = 'Hermes did not return a TNS object name'
             else:
                 # Build TNS Report
-                tns_report = form.generate_tns_report()
+                with trace_span('generate_tns_report'):
+                    tns_report = form.generate_tns_report(deadline)
+                # Reject malformed reports before they are sent
+                with trace_span('validate_tns_report'):
+                    validate_tns_report(tns_report)
+                self.record_payload(submission, tns_report)
                 # Submit TNS Report
-                report_id = send_tns_report(json.dumps(tns_report))
+                sending = True
+                with trace_span('send_tns_report'):
+                    submission.report_id = send_tns_report(json.dumps(tns_report), deadline)
+                    submission.save(update_fields=['report_id'])
+                if reply_settings()['live_replies']:
+                    return self.watch_reply(submission)
                 # Get IAU name from Report Reply
-                iau_name = get_tns_report_reply(report_id, self.request)
+                with trace_span('get_tns_report_reply', report_id=submission.report_id):
+                    iau_name = get_tns_report_reply(submission.report_id, self.request, deadline)
 
             if iau_name:
-                # update the target name in Tom DB
-                target = Target.objects.get(pk=self.kwargs['pk'])
-                if target.name != iau_name:
-                    old_name = target.name
-                    target.name = iau_name
-                    target.save()
-                    # Save old name as alias
-                    new_alias = TargetName(name=old_name, target=target)
-                    new_alias.save()
+                # update the target name in Tom DB, saving the old name as alias
+                with trace_span('rename_target', iau_name=iau_name):
+                    rename_targets({self.kwargs['pk']: iau_name})
+        except InvalidTnsReport as e:
+            error = e
+            messages.error(self.request, f'The TNS report is invalid: {e}')
+        except (DeadlineExceeded, requests.exceptions.Timeout) as e:
+            return self.hand_off(form, submission, sent=sending and not isinstance(
+                e, (DeadlineExceeded, requests.exceptions.ConnectTimeout)), error=e)
         except (requests.exceptions.HTTPError, BadTnsRequest) as e:
+            error = e
             messages.error(self.request, f'TNS returned an error: {e}')
+        except Exception as e:
+            finish_submission(submission, error=repr(e))
+            raise
+        finish_submission(submission, iau_name, error)
+        return HttpResponseRedirect(self.get_success_url())
+
+    def record_payload(self, submission, payload):
+        """ Record the report of a submission in the ledger, before it is sent """
+        submission.payload = payload
+        submission.save(update_fields=['payload'])
+
+    def watch_reply(self, submission):
+        """
+        Return to the TNS page without waiting for the reply, which the page then follows live from the
+        `tns/status/<report_id>` endpoint.
+        """
+        with trace_span('watch_reply', report_id=submission.report_id):
+            watch_report_reply(submission)
+        return HttpResponseRedirect(f"{reverse('tom_tns:report-tns', kwargs=self.kwargs)}"
+                                    f"?report_id={submission.report_id}")
+
+    def hand_off(self, form, submission, sent, error):
+        """
+        Hand a submission that ran out of time to the `tns_worker` command. A report that was accepted only needs its
+        reply; a report that wasn't sent is queued in full. A report that timed out while being sent may or may not
+        have reached the TNS or Hermes, so it is not sent again, and stays in flight in the ledger.
+        """
+        with trace_span('hand_off', report_id=submission.report_id):
+            if submission.report_id is not None:
+                submission.status = TNSSubmission.STATUS_PENDING
+                submission.worker = ''
+                submission.save(update_fields=['status', 'worker'])
+                messages.info(self.request, f'The TNS is still processing report {submission.report_id}. The target '
+                                            'will be renamed once it is processed.')
+            elif not sent:
+                submission.delete()
+                return self.queue_submission(form, submission.payload_hash)
+            else:
+                submission.error = repr(error)
+                submission.save(update_fields=['error'])
+                messages.warning(self.request, f'The submission timed out before the TNS replied ({error}). '
+                                               'Please check the TNS before submitting again.')
         return HttpResponseRedirect(self.get_success_url())
+
+    def queue_submission(self, form, payload_hash=''):
+        """
+        Queue the report for the `tns_worker` command instead of sending it from the web worker
+        """
+        try:
+            with trace_span('queue_submission'):
+                queue_submission(form, self.kwargs['pk'], self.request.user, payload_hash)
+            messages.info(self.request, 'Your TNS submission has been queued and will be sent shortly.')
+        except InvalidTnsReport as e:
+            messages.error(self.request, f'The TNS report is invalid: {e}')
+        except DuplicateSubmission as e:
+            messages.info(self.request, duplicate_message(e.submission))
+        except IntegrityError:
+            messages.info(self.request, 'This report is already being submitted, so it was not sent again.')
+        return HttpResponseRedirect(self.get_success_url())
+
+
+class TNSReplyStatusView(LoginRequiredMixin, View):
+    """
+    The status of the reply to a TNS report, as JSON, from the shared reply cache (see `tom_tns.replies`).
+    Only reports submitted from this TOM, of Targets the user may view, are served.
+    `?wait=<seconds>` long-polls until the report is processed, and requests that accept `text/event-stream` get
+    server-sent events: a `reply` event whenever the status changes, until it is final or `reply_stream_max_wait`
+    passes, after which the browser reconnects. Both hold a worker thread while they wait.
+    """
+    def get(self, request, *args, **kwargs):
+        report_id = self.kwargs['report_id']
+        submission = TNSSubmission.objects.filter(report_id=report_id).order_by('-created').first()
+        if submission is None or not targets_for_user(
+                request.user, Target.objects.filter(pk=submission.target_id), 'view_target').exists():
+            raise Http404('No such TNS report')
+        if 'text/event-stream' in request.headers.get('Accept', ''):
+            response = StreamingHttpResponse(self.events(report_id), content_type='text/event-stream')
+            response['Cache-Control'] = 'no-cache'
+            response['X-Accel-Buffering'] = 'no'
+            return response
+        try:
+            wait = float(request.GET.get('wait', 0))
+        except ValueError:
+            wait = 0
+        reply = wait_for_report_reply(report_id, wait) if wait > 0 else get_report_reply(report_id)
+        return JsonResponse(reply)
+
+    def events(self, report_id, interval=0.5):
+        config = reply_settings()
+        give_up = time.monotonic() + min(config['reply_stream_max_wait'], config['reply_max_wait'])
+        yield f'retry: {int(config["reply_poll_interval"] * 1000)}\n\n'
+        last = None
+        while True:
+            reply = get_report_reply(report_id)
+            if reply != last:
+                yield f'event: reply\ndata: {json.dumps(reply)}\n\n'
+                last = reply
+            if reply_is_final(reply) or time.monotonic() + interval >= give_up:
+                return
+            time.sleep(interval)
+
+
+class TNSMetricsView(View):
+    """
+    Serves the tom_tns metrics in the Prometheus text format when the `prometheus` metrics sink is in use.
+    Access requires a staff user, or the `metrics_token` from the TNS settings as a Bearer token.
+    """
+    def get(self, request, *args, **kwargs):
+        sink = get_metrics_sink()
+        if not isinstance(sink, PrometheusSink):
+            raise Http404('The Prometheus metrics sink is not enabled')
+        metrics_token = getattr(settings, 'DATA_SERVICES', {}).get('TNS', {}).get('metrics_token')
+        authorized = request.user.is_staff or (
+            metrics_token and request.headers.get('Authorization') == f'Bearer {metrics_token}')
+        if not authorized:
+            return HttpResponse(status=403)
+        return HttpResponse(sink.render(), content_type='text/plain; version=0.0.4; charset=utf-8')